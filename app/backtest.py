@@ -0,0 +1,313 @@
+"""
+Replay historical rc events through WaitTimeEstimator and measure accuracy.
+
+    python backtest.py --events export.jsonl
+    python backtest.py --from-datastore --csv by_group.csv
+    python backtest.py --events export.jsonl --grid decay_rate=0.6,0.8,1.0 \\
+        --grid iqr_factor=1.5,2.0,3.0 --workers 8
+
+Events are loaded once, then replayed in time order: each rc event is
+estimated as of its cinza time (rc_time - delta_t) against a ReplayStore that
+only holds the rc events completed before that instant, and compared with its
+actual delta_t. The rc room wait is left out of the estimate, since delta_t
+doesn't include it.
+
+Reported per (unit, color, slot) and overall:
+  n         events replayed
+  mae       mean absolute error (minutes)
+  bias      mean of estimate - actual (minutes)
+  coverage  share of events estimated from observed data, i.e. not off-hours
+            and not from the slot/color defaults
+
+--events takes a Parquet export directory written by export_events.py, or
+JSON lines / a JSON array of event items as stored in the events table (plain
+values, not DynamoDB-typed JSON); cinza items are ignored.
+"""
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+import numpy as np
+from data_store import iqr_median
+from models import WaitTimeEstimator
+from samples import SAMPLE_DTYPE, sample_fields
+
+# WaitTimeEstimator keyword arguments a grid can sweep, with their types
+PARAM_TYPES = {
+    "decay_rate": float,
+    "iqr_factor": float,
+    "smoothing_window_min": float,
+    "concept1_min_samples": int,
+    "concept3_min_samples": int,
+}
+
+# concepts that mean the estimate came from observed data
+DATA_CONCEPTS = {"same_day", "all_days", "same_weekday", "cross_unit"}
+
+
+class _SampleBuffer:
+    """Append-only sample batch; view() is a zero-copy slice of the filled part."""
+
+    def __init__(self):
+        self._buf = np.empty(16, dtype=SAMPLE_DTYPE)
+        self.n = 0
+
+    def append(self, fields: Tuple[float, int, int]):
+        if self.n == len(self._buf):
+            self._buf = np.concatenate([self._buf, np.empty(len(self._buf), dtype=SAMPLE_DTYPE)])
+        self._buf[self.n] = fields
+        self.n += 1
+
+    def view(self) -> np.ndarray:
+        return self._buf[:self.n]
+
+
+class ReplayStore:
+    """
+    The part of the DataStore API WaitTimeEstimator reads, served from memory
+    and grown one event at a time. IQR medians are memoized per (group,
+    sample count), so repeated queries between two new events are free.
+    """
+
+    def __init__(self):
+        self._groups: Dict[tuple, _SampleBuffer] = defaultdict(_SampleBuffer)
+        self._medians: Dict[tuple, Tuple[int, Optional[float]]] = {}
+        self._day_ordinals: Dict[str, int] = {}
+
+    def add(self, unit: str, color: str, slot: str, fields: Tuple[float, int, int]):
+        _, day_ord, weekday = fields
+        for key in (("day", unit, color, slot, day_ord),
+                    ("unit", unit, color, slot),
+                    ("weekday", unit, color, slot, weekday),
+                    ("all_units", color, slot)):
+            self._groups[key].append(fields)
+
+    def _samples(self, key: tuple) -> np.ndarray:
+        group = self._groups.get(key)
+        return group.view() if group is not None else np.empty(0, dtype=SAMPLE_DTYPE)
+
+    def _iqr_median(self, key: tuple, factor: float) -> Tuple[int, Optional[float]]:
+        samples = self._samples(key)
+        memo_key = (key, len(samples), factor)
+        result = self._medians.get(memo_key)
+        if result is None:
+            result = iqr_median(samples["delta_t"].astype(float), factor)
+            self._medians[memo_key] = result
+        return result
+
+    def _day_ordinal(self, day_str: str) -> int:
+        day_ord = self._day_ordinals.get(day_str)
+        if day_ord is None:
+            day_ord = self._day_ordinals[day_str] = date.fromisoformat(day_str).toordinal()
+        return day_ord
+
+    def iqr_median_unit_day_slot_color(self, unit, color, slot, day_str, factor, mode="fetch"):
+        return self._iqr_median(("day", unit, color, slot, self._day_ordinal(day_str)), factor)
+
+    def fetch_samples_unit_slot_color_all_days(self, unit, color, slot, mode="fetch"):
+        return self._samples(("unit", unit, color, slot))
+
+    def fetch_samples_unit_color_slot_weekday(self, unit, color, slot, weekday, mode="fetch"):
+        return self._samples(("weekday", unit, color, slot, weekday))
+
+    def iqr_median_color_slot_all_units(self, color, slot, factor, mode="fetch"):
+        return self._iqr_median(("all_units", color, slot), factor)
+
+
+# ---- loading
+
+def _epoch(iso: str) -> float:
+    return datetime.fromisoformat(iso.replace("Z", "+00:00")).timestamp()
+
+
+def prepare_events(items: Iterable[Mapping]) -> List[tuple]:
+    """
+    rc items -> (cinza_epoch, rc_epoch, unit, color, slot, sample fields),
+    sorted by cinza time. Items without delta_t/day/rc_time are skipped.
+    """
+    events = []
+    for item in items:
+        if item.get("event_type", "rc") != "rc" or not item.get("rc_time"):
+            continue
+        fields = sample_fields(item)
+        if fields is None:
+            continue
+        rc_epoch = _epoch(str(item["rc_time"]))
+        events.append((rc_epoch - fields[0] * 60.0, rc_epoch, item.get("unit"),
+                       item.get("risk_color"), item.get("slot"), fields))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def load_events(path: str) -> List[Mapping]:
+    if os.path.isdir(path):
+        # a Parquet export written by export_events.py
+        from export_events import read_events
+        return read_events(path)
+    with open(path) as f:
+        head = f.read(1)
+        f.seek(0)
+        if head == "[":
+            return json.load(f)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# ---- replay
+
+def replay(events: List[tuple], params: Optional[Dict] = None) -> List[tuple]:
+    """
+    Estimate every event as of its cinza time with only earlier rc events
+    visible. Returns (unit, color, slot, actual, estimate or None, covered).
+    """
+    store = ReplayStore()
+    estimator = WaitTimeEstimator(store, include_rc_room=False, **(params or {}))
+    by_rc_time = sorted(range(len(events)), key=lambda i: events[i][1])
+    visible = 0
+    results = []
+    for cinza_epoch, _, unit, color, slot, fields in events:
+        while visible < len(by_rc_time) and events[by_rc_time[visible]][1] < cinza_epoch:
+            _, _, v_unit, v_color, v_slot, v_fields = events[by_rc_time[visible]]
+            store.add(v_unit, v_color, v_slot, v_fields)
+            visible += 1
+        query_time = datetime.fromtimestamp(cinza_epoch, timezone.utc)
+        est, info = estimator.estimate_wait_time_detailed(unit, color, query_time)
+        if isinstance(est, str):  # off-hours
+            results.append((unit, color, slot, fields[0], None, False))
+        else:
+            covered = bool(DATA_CONCEPTS.intersection(info["concepts_used"]))
+            results.append((unit, color, slot, fields[0], float(est), covered))
+    return results
+
+
+def summarize(results: List[tuple], by_group: bool = True) -> Dict[tuple, Dict]:
+    """{(unit, color, slot) or ("ALL",): {n, mae, bias, coverage}}."""
+    groups = defaultdict(list)
+    for row in results:
+        groups[("ALL",)].append(row)
+        if by_group:
+            groups[row[:3]].append(row)
+    summary = {}
+    for key, rows in groups.items():
+        errors = [est - actual for _, _, _, actual, est, _ in rows if est is not None]
+        summary[key] = {
+            "n": len(rows),
+            "mae": float(np.mean(np.abs(errors))) if errors else math.nan,
+            "bias": float(np.mean(errors)) if errors else math.nan,
+            "coverage": sum(row[5] for row in rows) / len(rows),
+        }
+    return summary
+
+
+# ---- grid sweep
+
+_worker_events: List[tuple] = []
+
+
+def _init_worker(events):
+    global _worker_events
+    _worker_events = events
+
+
+def _run_params(params: Dict) -> Tuple[Dict, Dict]:
+    return params, summarize(replay(_worker_events, params), by_group=False)[("ALL",)]
+
+
+def parse_grid(specs: List[str]) -> List[Dict]:
+    """['decay_rate=0.6,0.8', 'iqr_factor=2'] -> every combination as kwargs."""
+    axes = []
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        if name not in PARAM_TYPES:
+            raise ValueError(f"unknown parameter {name!r}, expected one of {sorted(PARAM_TYPES)}")
+        axes.append([(name, PARAM_TYPES[name](v)) for v in values.split(",")])
+    return [dict(combo) for combo in itertools.product(*axes)]
+
+
+def sweep(events: List[tuple], grid: List[Dict], workers: int) -> List[Tuple[Dict, Dict]]:
+    """Overall metrics per parameter set, best MAE first."""
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(events,)) as pool:
+        results = pool.map(_run_params, grid, chunksize=1)
+    return sorted(results, key=lambda r: r[1]["mae"])
+
+
+# ---- output
+
+def print_summary(summary: Dict[tuple, Dict], top: int):
+    overall = summary.pop(("ALL",))
+    rows = sorted(summary.items(), key=lambda kv: -kv[1]["n"])
+    print(f"{'unit':<32} {'color':<5} {'slot':<12} {'n':>7} {'mae':>7} {'bias':>7} {'cover':>6}")
+    for (unit, color, slot), m in rows[:top]:
+        print(f"{str(unit)[:32]:<32} {str(color):<5} {str(slot):<12} {m['n']:>7} "
+              f"{m['mae']:>7.1f} {m['bias']:>7.1f} {m['coverage']:>6.1%}")
+    if len(rows) > top:
+        print(f"... {len(rows) - top} more groups (use --csv for all)")
+    print(f"\noverall: n={overall['n']} mae={overall['mae']:.2f} bias={overall['bias']:.2f} "
+          f"coverage={overall['coverage']:.1%}")
+
+
+def write_csv(path: str, summary: Dict[tuple, Dict]):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["unit", "color", "slot", "n", "mae", "bias", "coverage"])
+        for key, m in sorted(summary.items(), key=lambda kv: [str(k) for k in kv[0]]):
+            unit, color, slot = key if len(key) == 3 else (key[0], "", "")
+            writer.writerow([unit, color, slot, m["n"], m["mae"], m["bias"], m["coverage"]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--events", help="event export: Parquet directory (export_events.py), "
+                                         "JSON lines or JSON array")
+    source.add_argument("--from-datastore", action="store_true",
+                        help="scan the configured DataStore once instead")
+    parser.add_argument("--grid", action="append", default=[], metavar="PARAM=V1,V2,...",
+                        help=f"sweep a parameter, repeatable; one of {', '.join(PARAM_TYPES)}")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--csv", help="write per-group metrics here")
+    parser.add_argument("--top", type=int, default=30, help="groups to print")
+    args = parser.parse_args()
+
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as e:
+        parser.error(str(e))
+
+    t0 = time.perf_counter()
+    if args.from_datastore:
+        from data_store import create_datastore
+        items = create_datastore()._scan_events()
+    else:
+        items = load_events(args.events)
+    events = prepare_events(items)
+    print(f"loaded {len(events)} rc events in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    if not events:
+        return
+
+    t0 = time.perf_counter()
+    if args.grid:
+        results = sweep(events, grid, min(args.workers, len(grid)))
+        print(f"{len(grid)} parameter sets in {time.perf_counter() - t0:.1f}s\n", file=sys.stderr)
+        print(f"{'mae':>7} {'bias':>7} {'cover':>6}  params")
+        for params, m in results:
+            print(f"{m['mae']:>7.2f} {m['bias']:>7.2f} {m['coverage']:>6.1%}  "
+                  + " ".join(f"{k}={v}" for k, v in params.items()))
+        return
+
+    summary = summarize(replay(events))
+    print(f"replayed in {time.perf_counter() - t0:.1f}s\n", file=sys.stderr)
+    if args.csv:
+        write_csv(args.csv, summary)
+    print_summary(summary, args.top)
+
+
+if __name__ == "__main__":
+    main()
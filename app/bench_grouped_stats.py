@@ -0,0 +1,83 @@
+"""
+Throughput benchmark for the grouped stats kernels.
+
+    python bench_grouped_stats.py                  # 2000 groups, ~50 samples each
+    python bench_grouped_stats.py --groups 20000 --per-group 30 --repeat 5
+
+The grouped kernels are timed against a Python loop over groups calling the
+per-array functions (apply_iqr_filter + np.median, weighted_median).
+tests/test_grouped_stats.py uses the same data and loops to check that they
+agree.
+"""
+import argparse
+import time
+import numpy as np
+from config import IQR_OUTLIER_FACTOR
+from utils import apply_iqr_filter, weighted_median, grouped_iqr_median, grouped_weighted_median
+
+
+def make_data(rng, n_groups, per_group):
+    sizes = rng.poisson(per_group, n_groups)
+    sizes[: min(3, n_groups)] = [0, 1, 2][: min(3, n_groups)]  # edge cases up front
+    group_ids = np.repeat(np.arange(n_groups), sizes)
+    # waits in minutes with a heavy tail and some rounding, so ties happen
+    values = np.round(rng.lognormal(3.5, 0.6, len(group_ids)), 1)
+    weights = rng.uniform(0.05, 1.0, len(group_ids))
+    perm = rng.permutation(len(group_ids))
+    return values[perm], weights[perm], group_ids[perm]
+
+
+def loop_iqr_median(values, group_ids, n_groups, factor):
+    medians, counts = np.full(n_groups, np.nan), np.zeros(n_groups, dtype=np.int64)
+    for g in range(n_groups):
+        kept = apply_iqr_filter(values[group_ids == g], factor)
+        if len(kept):
+            medians[g], counts[g] = np.median(kept), len(kept)
+    return medians, counts
+
+
+def loop_weighted_median(values, weights, group_ids, n_groups):
+    medians, counts = np.full(n_groups, np.nan), np.zeros(n_groups, dtype=np.int64)
+    for g in range(n_groups):
+        mask = group_ids == g
+        if mask.any():
+            medians[g], counts[g] = weighted_median(values[mask], weights[mask]), mask.sum()
+    return medians, counts
+
+
+def best_of(repeat, fn, *args):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--per-group", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    values, weights, group_ids = make_data(rng, args.groups, args.per_group)
+    factor = IQR_OUTLIER_FACTOR
+    print(f"{args.groups} groups, {len(values)} values\n")
+
+    print(f"{'kernel':<24} {'loop s':>9} {'grouped s':>10} {'speedup':>8} {'values/s':>12}")
+    for name, loop_fn, grouped_fn, fn_args in [
+        ("iqr median", loop_iqr_median, grouped_iqr_median, (values, group_ids, args.groups, factor)),
+        ("weighted median", loop_weighted_median, grouped_weighted_median,
+         (values, weights, group_ids, args.groups)),
+    ]:
+        t_loop = best_of(args.repeat, loop_fn, *fn_args)
+        t_grouped = best_of(args.repeat, grouped_fn, *fn_args)
+        print(f"{name:<24} {t_loop:>9.4f} {t_grouped:>10.4f} {t_loop / t_grouped:>7.1f}x "
+              f"{len(values) / t_grouped:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
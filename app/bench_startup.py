@@ -0,0 +1,73 @@
+"""
+Import-time and startup benchmark for the API.
+
+    python bench_startup.py            # 10 cold imports of main
+    python bench_startup.py -n 20 --top 15
+
+Each run starts a fresh interpreter so module caches don't hide the cost.
+Nothing here talks to AWS: importing main must not need the network.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STARTUP_SNIPPET = """
+import time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+main.preload()
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+"""
+
+
+def run_once():
+    env = dict(os.environ, PRELOAD_WARM="0")
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET], cwd=HERE, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    wall = time.perf_counter() - t0
+    import_s, preload_s = (float(x) for x in out.split()[-2:])
+    return wall, import_s, preload_s
+
+
+def top_imports(n):
+    """Slowest modules imported directly by main (python -X importtime)."""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=HERE,
+                         capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|")
+        # nesting shows up as two spaces of indentation per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            rows.append((int(cum_us), name.strip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=10, help="cold starts to time")
+    ap.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    args = ap.parse_args()
+
+    runs = [run_once() for _ in range(args.n)]
+    for label, idx in (("process wall", 0), ("import main", 1), ("preload()", 2)):
+        vals = [r[idx] * 1000 for r in runs]
+        print(f"{label:>14}: median {statistics.median(vals):8.1f} ms   min {min(vals):8.1f} ms")
+
+    print("\nslowest imports made by main:")
+    for cum_us, name in top_imports(args.top):
+        print(f"{cum_us / 1000:10.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
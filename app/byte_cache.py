@@ -0,0 +1,123 @@
+import sys
+import threading
+from typing import Dict
+import numpy as np
+from cachetools import LRUCache, TTLCache
+
+# Rough per-entry bookkeeping: key tuple, cache links, array/list header
+ENTRY_OVERHEAD_BYTES = 256
+
+
+def entry_size(value) -> int:
+    """Approximate resident bytes of a cached value (sample batches, unit lists)."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes + ENTRY_OVERHEAD_BYTES
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value) + ENTRY_OVERHEAD_BYTES
+    return sys.getsizeof(value) + ENTRY_OVERHEAD_BYTES
+
+
+class _ByteStats:
+    """
+    Capacity in bytes (maxsize) plus eviction counters for the caches below.
+    cachetools caches are not thread-safe, and even a lookup reorders the LRU
+    links, so every access goes through one (re-entrant) lock: these caches
+    are shared by the request threadpool and the concept-fetch pool.
+    """
+
+    def _init_stats(self):
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.rejected = 0
+
+    def popitem(self):
+        # only called when an insert needs room: that's an eviction
+        with self._lock:
+            item = super().popitem()
+            self.evictions += 1
+            return item
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            try:
+                super().__setitem__(key, value)
+            except ValueError:
+                # a single value larger than the whole cache is not kept
+                self.pop(key, None)
+                self.rejected += 1
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+
+    def __len__(self):
+        with self._lock:
+            return super().__len__()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super().get(key, default)
+
+    def pop(self, key, *default):
+        with self._lock:
+            return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            return super().setdefault(key, default)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+
+    def _stats(self) -> Dict[str, int]:
+        # caller holds the lock
+        return {
+            "entries": super().__len__(),
+            "resident_bytes": self.currsize,
+            "max_bytes": self.maxsize,
+            "evictions": self.evictions,
+            "rejected": self.rejected,
+        }
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return self._stats()
+
+
+class ByteLRUCache(_ByteStats, LRUCache):
+    """LRUCache bounded by the total entry_size() of its values."""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(maxsize=max_bytes, getsizeof=entry_size)
+        self._init_stats()
+
+
+class ByteTTLCache(_ByteStats, TTLCache):
+    """
+    TTLCache bounded by the total entry_size() of its values. Expired entries
+    are dropped first, then the least recently used ones until a new value fits.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        super().__init__(maxsize=max_bytes, ttl=ttl, getsizeof=entry_size)
+        self._init_stats()
+        self.expirations = 0
+
+    def expire(self, time=None):
+        with self._lock:
+            expired = super().expire(time)
+            self.expirations += len(expired)
+            return expired
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats(), expirations=self.expirations)
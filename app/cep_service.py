@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+import httpx
+from cachetools import TTLCache
+from config import (
+    CEP_ABERTO_TOKEN,
+    CEP_ABERTO_URL,
+    CEP_CACHE_PATH,
+    CEP_CACHE_TTL_S,
+    CEP_CACHE_MAX_ENTRIES,
+    CEP_HTTP_TIMEOUT_S,
+    CEP_HTTP_RETRIES,
+    CEP_HTTP_RETRY_BACKOFF_S,
+    CEP_NEGATIVE_TTL_S,
+    CEP_LOOKUP_CONCURRENCY,
+)
+
+logger = logging.getLogger(__name__)
+
+# Answers worth another try: rate limiting and server-side failures
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def normalize_cep(cep: str) -> str:
+    """'74463-330' / '74463330' / ' 74.463-330 ' -> '74463330'."""
+    digits = re.sub(r"\D", "", cep or "")
+    if len(digits) != 8:
+        raise ValueError(f"Invalid CEP: {cep!r}")
+    return digits
+
+
+class CepCache:
+    """
+    Persistent CEP -> CEP Aberto payload cache in a small SQLite file, shared
+    by the workers of a host. Entries expire after `ttl_s` (postal codes
+    barely change, so this is long) and the least recently used ones are
+    evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path: str = CEP_CACHE_PATH, ttl_s: int = CEP_CACHE_TTL_S,
+                 max_entries: int = CEP_CACHE_MAX_ENTRIES):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cep_cache ("
+                " cep TEXT PRIMARY KEY, payload TEXT NOT NULL,"
+                " fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cep_cache_accessed ON cep_cache (accessed_at)")
+
+    def get(self, cep: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT payload FROM cep_cache WHERE cep = ? AND fetched_at > ?", (cep, now - self.ttl_s)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE cep_cache SET accessed_at = ? WHERE cep = ?", (now, cep))
+        return json.loads(row[0])
+
+    def put(self, cep: str, payload: Dict):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cep_cache (cep, payload, fetched_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (cep, json.dumps(payload), now, now),
+            )
+            # LRU eviction beyond max_entries
+            self._conn.execute(
+                "DELETE FROM cep_cache WHERE cep IN ("
+                " SELECT cep FROM cep_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+class CepService:
+    """
+    CEP lookups and geocoding through CEP Aberto, with one pooled async HTTP
+    client (keep-alive, timeouts, retries) per worker and a persistent
+    CepCache in front of it. The cache's sqlite calls run in worker threads,
+    off the event loop. Concurrent lookups of the same CEP share one request,
+    and unknown CEPs are remembered for negative_ttl_s.
+    """
+
+    def __init__(self, base_url: str = CEP_ABERTO_URL, token: Optional[str] = CEP_ABERTO_TOKEN,
+                 cache: Optional[CepCache] = None, transport: Optional[httpx.AsyncBaseTransport] = None,
+                 retries: int = CEP_HTTP_RETRIES, retry_backoff_s: float = CEP_HTTP_RETRY_BACKOFF_S,
+                 negative_ttl_s: float = CEP_NEGATIVE_TTL_S):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.retries = retries
+        self.retry_backoff_s = retry_backoff_s
+        self._cache = cache
+        self._cache_lock = threading.Lock()
+        self._transport = transport
+        self._client = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._semaphore = None
+        self._unknown = TTLCache(maxsize=CEP_CACHE_MAX_ENTRIES, ttl=negative_ttl_s)
+
+    @property
+    def cache(self) -> CepCache:
+        # first used from a worker thread, so two lookups may race to open it
+        with self._cache_lock:
+            if self._cache is None:
+                self._cache = CepCache()
+        return self._cache
+
+    def _http(self) -> httpx.AsyncClient:
+        # created lazily inside the worker's event loop (and after any fork)
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Token token={self.token}"},
+                timeout=httpx.Timeout(CEP_HTTP_TIMEOUT_S),
+                limits=httpx.Limits(max_connections=CEP_LOOKUP_CONCURRENCY,
+                                    max_keepalive_connections=CEP_LOOKUP_CONCURRENCY),
+                transport=self._transport,
+            )
+            self._semaphore = asyncio.Semaphore(CEP_LOOKUP_CONCURRENCY)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get_json(self, path: str, params: Dict):
+        client = self._http()
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self._semaphore:
+                    resp = await client.get(path, params=params)
+                if resp.status_code not in RETRY_STATUSES or last:
+                    resp.raise_for_status()
+                    return resp.json()
+                logger.info("CEP Aberto answered %s for %s, retrying", resp.status_code, params)
+            except httpx.TransportError as e:
+                # timeouts and connection errors
+                if last:
+                    raise
+                logger.info("CEP Aberto request failed for %s (%s), retrying", params, e)
+            await asyncio.sleep(self.retry_backoff_s * 2 ** attempt)
+
+    async def _fetch(self, cep: str) -> Optional[Dict]:
+        cached = await asyncio.to_thread(lambda: self.cache.get(cep))
+        if cached is not None:
+            return cached
+        payload = await self._get_json("/cep", {"cep": cep})
+        # CEP Aberto answers unknown CEPs with an empty object
+        if not payload:
+            self._unknown[cep] = True
+            return None
+        await asyncio.to_thread(lambda: self.cache.put(cep, payload))
+        return payload
+
+    async def lookup(self, cep: str) -> Optional[Dict]:
+        """CEP Aberto payload for `cep`, or None if the CEP doesn't exist."""
+        cep = normalize_cep(cep)
+        if cep in self._unknown:
+            return None
+        future = self._inflight.get(cep)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(cep))
+            self._inflight[cep] = future
+            future.add_done_callback(lambda _: self._inflight.pop(cep, None))
+        return await asyncio.shield(future)
+
+    async def lookup_many(self, ceps: Iterable[str]) -> Dict[str, Optional[Dict]]:
+        """Resolve many CEPs concurrently; failures map to None and are logged."""
+        ceps = list(dict.fromkeys(ceps))
+        results = await asyncio.gather(*(self.lookup(c) for c in ceps), return_exceptions=True)
+        out = {}
+        for cep, result in zip(ceps, results):
+            if isinstance(result, Exception):
+                logger.warning("CEP lookup failed for %s: %s", cep, result)
+                result = None
+            out[cep] = result
+        return out
+
+    async def geocode(self, cep: str) -> Optional[Tuple[float, float]]:
+        """(latitude, longitude) for a CEP, None when unknown or not geocoded."""
+        payload = await self.lookup(cep)
+        if not payload or payload.get("latitude") is None or payload.get("longitude") is None:
+            return None
+        return float(payload["latitude"]), float(payload["longitude"])
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 RISK_COLORS = ['b', 'g', 'y', 'o', 'r']
 
@@ -61,5 +62,132 @@ MIN_WAIT_MINUTES = 5
 
 DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE", "wait_time_events")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+# e.g. http://localhost:8000 for DynamoDB Local (empty = AWS)
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None
 CEP_ABERTO_TOKEN = os.getenv("CEP_ABERTO_TOKEN")
-TEMPORAL_DECAY_RATE = 0.8
\ No newline at end of file
+TEMPORAL_DECAY_RATE = 0.8
+
+# Warm sample data in the gunicorn master before forking workers
+PRELOAD_WARM = os.getenv("PRELOAD_WARM", "0") == "1"
+
+# Local snapshot of rc events for warm restarts (empty = disabled)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+# How often (s) a worker pulls events newer than the snapshot's high-water mark
+SNAPSHOT_REFRESH_S = int(os.getenv("SNAPSHOT_REFRESH_S", "60"))
+# Snapshots older than this (s) are rebuilt with a full scan
+SNAPSHOT_MAX_AGE_S = int(os.getenv("SNAPSHOT_MAX_AGE_S", str(24 * 60 * 60)))
+# Re-read this many seconds before the high-water mark to absorb clock skew
+SNAPSHOT_OVERLAP_S = 300
+
+# Local change log used to invalidate cached samples across the workers of a
+# host as soon as an event is ingested (empty = disabled)
+CHANGE_LOG_PATH = os.getenv("CHANGE_LOG_PATH", os.path.join(tempfile.gettempdir(), "bd-chronos-changes.log"))
+# Sample cache TTL (s). With every writer on one host publishing to the change
+# log this only bounds staleness from other hosts and can be raised a lot.
+EST_CACHE_TTL = int(os.getenv("EST_CACHE_TTL", "720"))
+# Sample cache capacity in bytes per worker (least recently used entries go first)
+EST_CACHE_MAX_BYTES = int(os.getenv("EST_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Bytes kept as a last-resort fallback once entries leave the sample cache
+STALE_CACHE_MAX_BYTES = int(os.getenv("STALE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Estimate endpoints round query_time down to this many minutes, so polling
+# clients share one cached, serialized response per bucket
+RESPONSE_BUCKET_MIN = int(os.getenv("RESPONSE_BUCKET_MIN", "5"))
+# Server-side lifetime of a cached response (s); it is also dropped as soon as
+# this worker sees new data
+RESPONSE_CACHE_TTL_S = int(os.getenv("RESPONSE_CACHE_TTL_S", "60"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Cache-Control max-age sent to clients (s); they revalidate with If-None-Match after that
+RESPONSE_MAX_AGE_S = int(os.getenv("RESPONSE_MAX_AGE_S", "30"))
+
+# Default latency budget for /estimate (ms); concept fetches that would
+# exceed it are skipped and the estimate falls back to cached data/defaults
+ESTIMATE_BUDGET_MS = int(os.getenv("ESTIMATE_BUDGET_MS", "1500"))
+# Per-slot estimates are reused for the rest of the day until new data
+# arrives; this only bounds how long data from other hosts can go unseen
+SLOT_ESTIMATE_CACHE_TTL_S = int(os.getenv("SLOT_ESTIMATE_CACHE_TTL_S", "60"))
+SLOT_ESTIMATE_CACHE_MAXSIZE = 50000
+
+# Threads running budgeted concept fetches
+ESTIMATE_FETCH_WORKERS = int(os.getenv("ESTIMATE_FETCH_WORKERS", "16"))
+
+# DynamoDB client tuning (see dynamo.DynamoAccess)
+DYNAMODB_MAX_POOL_CONNECTIONS = int(os.getenv("DYNAMODB_MAX_POOL_CONNECTIONS", "50"))
+DYNAMODB_CONNECT_TIMEOUT_S = 2
+DYNAMODB_READ_TIMEOUT_S = 10
+# Segments used for bulk scans (warm-up, snapshot rebuilds, unit listing)
+DYNAMODB_SCAN_SEGMENTS = int(os.getenv("DYNAMODB_SCAN_SEGMENTS", "4"))
+
+# Unit sharding (see sharding.py): base URLs of every estimator node,
+# comma-separated and identical on all of them. Empty = no sharding, every
+# node serves every unit.
+SHARD_NODES = os.getenv("SHARD_NODES", "")
+# This node's entry in SHARD_NODES
+SHARD_SELF = os.getenv("SHARD_SELF", "")
+# Points per node on the hash ring; more = more even split
+SHARD_VNODES = 64
+# Forwarded /estimate calls and gathers from the other nodes
+SHARD_TIMEOUT_S = float(os.getenv("SHARD_TIMEOUT_S", "5"))
+# How often the other nodes' Concept 4 histograms are refetched (s)
+SHARD_HIST_REFRESH_S = int(os.getenv("SHARD_HIST_REFRESH_S", "60"))
+# Concept 4 histogram bins (minutes); sharded medians are within about half
+# a bin of the unsharded ones
+SHARD_HIST_BIN_MIN = 0.5
+SHARD_HIST_MAX_MIN = 24 * 60
+
+# Admin endpoints (/admin/...) require this value in the X-Admin-Token
+# header; unset = admin endpoints disabled
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Sampling profiler and slow-request capture (see profiler.py). The workers
+# of a host share the control file and write their data under this directory.
+PROFILER_DIR = os.getenv("PROFILER_DIR", os.path.join(tempfile.gettempdir(), "bd-chronos-profiler"))
+PROFILER_INTERVAL_MS = 20
+PROFILER_MAX_SECONDS = 600
+# Requests slower than this are captured with their per-phase timings (0 = off)
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", "1000"))
+# Per-worker slow request log size before it is rotated
+SLOW_REQUEST_LOG_MAX_BYTES = 1024 * 1024
+
+# Storage backend: "dynamodb" or "sqlite" (single node / tests, see sql_store.py)
+DATASTORE_BACKEND = os.getenv("DATASTORE_BACKEND", "dynamodb")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "chronos.db")
+# Pseudonym salt; when unset it is read from Secrets Manager ("pseudonym/bd")
+PSEUDONYM_SALT = os.getenv("PSEUDONYM_SALT")
+
+# Stored route times (/route_times) expire after this many seconds
+ROUTE_TIMES_TTL_S = 48 * 60 * 60
+# DynamoDB layout of user_route_times:
+#   "legacy" - one item per (user, unit), written with batch_writer
+#   "packed" - one item per user holding every unit; reads fall back to
+#              legacy items and repack them (lazy migration)
+#   "dual"   - write both, read packed first; safe to roll back to "legacy"
+# Defaults to "dual" so a mixed-version rollout (or a rollback) still finds
+# legacy items. Once every node writes packed items and the legacy ones have
+# had ROUTE_TIMES_TTL_S to expire, set it to "packed" to stop the double writes.
+ROUTE_TIMES_LAYOUT = os.getenv("ROUTE_TIMES_LAYOUT", "dual")
+# Per-worker read-through cache of a user's route times (s)
+ROUTE_TIMES_CACHE_TTL_S = int(os.getenv("ROUTE_TIMES_CACHE_TTL_S", "30"))
+ROUTE_TIMES_CACHE_MAXSIZE = 10000
+
+# CEP Aberto client and local cache (see cep_service.py)
+CEP_ABERTO_URL = os.getenv("CEP_ABERTO_URL", "https://www.cepaberto.com/api/v3")
+CEP_CACHE_PATH = os.getenv("CEP_CACHE_PATH", os.path.join(tempfile.gettempdir(), "bd-chronos-cep.db"))
+CEP_CACHE_TTL_S = int(os.getenv("CEP_CACHE_TTL_S", str(180 * 24 * 60 * 60)))
+CEP_CACHE_MAX_ENTRIES = int(os.getenv("CEP_CACHE_MAX_ENTRIES", "100000"))
+CEP_HTTP_TIMEOUT_S = 5
+# Retries of a timed out / refused / 429 / 5xx request, with exponential backoff (s)
+CEP_HTTP_RETRIES = int(os.getenv("CEP_HTTP_RETRIES", "2"))
+CEP_HTTP_RETRY_BACKOFF_S = 0.2
+# Unknown CEPs are remembered per worker for a short while only (s)
+CEP_NEGATIVE_TTL_S = int(os.getenv("CEP_NEGATIVE_TTL_S", "600"))
+# Parallel requests to CEP Aberto per worker (it rate-limits aggressively)
+CEP_LOOKUP_CONCURRENCY = int(os.getenv("CEP_LOOKUP_CONCURRENCY", "4"))
+
+# Parquet export of the events table (see export_events.py)
+EXPORT_PATH = os.getenv("EXPORT_PATH", "events_export")
+# Rows per Parquet file written by an export run
+EXPORT_ROWS_PER_FILE = int(os.getenv("EXPORT_ROWS_PER_FILE", "100000"))
+# Cap on rows held across all partitions; past it the largest ones are flushed early
+EXPORT_MAX_BUFFERED_ROWS = int(os.getenv("EXPORT_MAX_BUFFERED_ROWS", "500000"))
+# Partitions with at least this many files get merged into one by --compact
+EXPORT_COMPACT_MIN_FILES = int(os.getenv("EXPORT_COMPACT_MIN_FILES", "8"))
@@ -1,46 +1,339 @@
-import pandas as pd
-from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict
-from config import RISK_COLORS, MAX_WAIT_MINUTES, MIN_WAIT_MINUTES, TIME_SLOTS, DYNAMODB_TABLE, AWS_REGION, DEFAULT_WAIT_BY_COLOR
-from utils import assign_time_slot, compute_iqr, to_date, get_secret
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
+import numpy as np
+from datetime import date, datetime, timezone
+from typing import Callable, Iterator, Optional, List, Dict, Sequence, Tuple
+from config import (
+    MAX_WAIT_MINUTES, MIN_WAIT_MINUTES, TIME_SLOTS, DYNAMODB_TABLE,
+    SNAPSHOT_PATH, SNAPSHOT_REFRESH_S, SNAPSHOT_MAX_AGE_S, SNAPSHOT_OVERLAP_S,
+    CHANGE_LOG_PATH, EST_CACHE_TTL, EST_CACHE_MAX_BYTES, STALE_CACHE_MAX_BYTES, DATASTORE_BACKEND, PSEUDONYM_SALT,
+    ROUTE_TIMES_TTL_S, ROUTE_TIMES_LAYOUT, ROUTE_TIMES_CACHE_TTL_S, ROUTE_TIMES_CACHE_MAXSIZE
+)
+from utils import assign_time_slot, get_secret, apply_iqr_filter
+from samples import SAMPLE_ATTRIBUTES, samples_from_items, sample_fields
+from snapshot import EventIndex, EVENT_ATTRIBUTES
+from invalidation import ChangeLog, sample_cache_keys
+from dynamo import DynamoAccess
 from decimal import Decimal
 import hashlib
 import os
-from dateutil import parser
-import pytz
-import json
 import logging
 from zoneinfo import ZoneInfo
-import json
 import time
+import threading
+from byte_cache import ByteLRUCache, ByteTTLCache
 from cachetools import TTLCache
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
- # 5 min cache
+# Key of the packed user_route_times item (ROUTE_TIMES_LAYOUT "packed"/"dual")
+PACKED_ROUTES_PREFIX = "packed#"
+PACKED_ROUTES_UNIT = "*"
+
+def ingest_time() -> str:
+    """Server time for an item's ingested_at, ISO-8601 UTC like event_time."""
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds").replace("+00:00", "Z")
 
 def hash_pseudonym(pseudonym: str, salt: str) -> str:
     # Combine pseudonym and salt, encode, hash
     to_hash = f"{salt}{pseudonym}".encode("utf-8")
     return hashlib.sha256(to_hash).hexdigest()
 
+def _decimal(value) -> Optional[Decimal]:
+    return Decimal(str(value)) if value is not None else None
+
+def iqr_median(values: np.ndarray, factor: float) -> Tuple[int, Optional[float]]:
+    """(count, median) of the values left after the IQR outlier filter."""
+    kept = apply_iqr_filter(values, factor)
+    return len(kept), (float(np.median(kept)) if len(kept) else None)
+
+
 class DataStore:
+    """
+    Storage interface used by the API and the estimator.
+
+    This class holds everything that does not depend on where events live:
+    the event ingestion rules, sample caching, the snapshot index and
+    cross-worker invalidation. Backends (DynamoDataStore below,
+    sql_store.SqlDataStore) implement the storage primitives marked with
+    NotImplementedError. Use create_datastore() to get the configured one.
+    """
+
     def __init__(self):
-        #opa
-        # Each row: pseudonym, unit, cinza_time, rc_time, risk_color, delta_t, slot, day
-        # self.df = pd.DataFrame(columns=[
-        #     "pseudonym", "unit", "cinza_time", "rc_time", "risk_color", "delta_t", "slot", "day"
-        # ])
-        self.dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
-        self.units_table = self.dynamodb.Table("units")
-        self.table = self.dynamodb.Table(DYNAMODB_TABLE)
-        self.user_route_table = self.dynamodb.Table("user_route_times")
-        self.secret = get_secret("pseudonym/bd")["key_salt"]
-        self.est_cache = TTLCache(maxsize=320000, ttl=720) 
+        # The salt is fetched on first use: importing this module must not touch the network
+        self._secret = None
+        # Bounded by bytes, not entries: one cross-unit batch can outweigh
+        # thousands of per-day ones
+        self.est_cache = ByteTTLCache(EST_CACHE_MAX_BYTES, ttl=EST_CACHE_TTL)
+        # Last batch seen per key, regardless of TTL: fallback when the backend
+        # is too slow for a request's latency budget
+        self.stale_cache = ByteLRUCache(STALE_CACHE_MAX_BYTES)
+        # Local index of all rc events when running from a snapshot (see load_snapshot)
+        self.events: Optional[EventIndex] = None
+        self._events_checked_at = 0.0
+        # Held for every change to the index; the scans that feed it run
+        # outside, single-flighted by _events_refresh_lock
+        self._events_lock = threading.Lock()
+        self._events_refresh_lock = threading.Lock()
+        # Changes applied while a scan runs, replayed over its results so an
+        # older scanned row can't undo them
+        self._changes_during_scan: Optional[List[Tuple[str, Dict]]] = None
+        # Cross-worker invalidation channel (see invalidation.ChangeLog)
+        self.changes = ChangeLog(CHANGE_LOG_PATH) if CHANGE_LOG_PATH else None
+        self._changes_lock = threading.Lock()
+        # Bumped whenever this worker learns about new or removed data; cached
+        # API responses are keyed on it (see response_cache.ResponseCache)
+        self.generation = 0
+        self._generation_lock = threading.Lock()
+        # Set on sharded nodes (see sharding.py): events of units it rejects
+        # are neither indexed nor cached here
+        self.unit_filter: Optional[Callable[[str], bool]] = None
+        # The shard layout unit_filter comes from, recorded in the snapshot: an
+        # index built under another layout lacks the units this node gained
+        self.shard_layout: Optional[Dict] = None
+        # Read-through cache of get_user_route_times; this worker's own writes
+        # replace the entry, other workers' writes show up within the TTL
+        self.route_cache = TTLCache(maxsize=ROUTE_TIMES_CACHE_MAXSIZE, ttl=ROUTE_TIMES_CACHE_TTL_S)
+        self._route_lock = threading.Lock()
+
+    @property
+    def secret(self) -> str:
+        if self._secret is None:
+            self._secret = PSEUDONYM_SALT or get_secret("pseudonym/bd")["key_salt"]
+        return self._secret
+
+    def reset_connections(self):
+        """Drop backend connections, e.g. in a freshly forked worker. Caches are kept."""
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Size and eviction counters of this worker's sample caches."""
+        return {"est_cache": self.est_cache.stats(), "stale_cache": self.stale_cache.stats()}
+
+    # ---- storage primitives, implemented by the backends
+
+    def _unit_events(self, hashed_pseudonym: str, unit: str) -> List[Dict]:
+        """Every stored event (cinza and rc) of this pseudonym at this unit."""
+        raise NotImplementedError
+
+    def _put_event(self, item: Dict):
+        raise NotImplementedError
+
+    def _delete_event(self, hashed_pseudonym: str, event_id: str):
+        raise NotImplementedError
+
+    def _scan_events(self, since: Optional[str] = None,
+                     attributes: Sequence[str] = EVENT_ATTRIBUTES) -> List[Dict]:
+        """
+        rc items (their `attributes`) ingested after `since`, or all of them.
+        Items written before ingested_at existed go by their event_time.
+        """
+        raise NotImplementedError
+
+    def iter_event_pages(self, since: Optional[str] = None,
+                         attributes: Sequence[str] = EVENT_ATTRIBUTES) -> Iterator[List[Dict]]:
+        """Same items as _scan_events, in pages; backends that can stream override this."""
+        yield self._scan_events(since, attributes)
+
+    def _scan_event_units(self) -> List[str]:
+        """Distinct units that have any event."""
+        raise NotImplementedError
+
+    def _query_samples(self, color: str, slot: str, unit: Optional[str] = None,
+                       day_str: Optional[str] = None) -> np.ndarray:
+        """Sample batch of rc events for (unit or all units, color, slot[, day])."""
+        raise NotImplementedError
+
+    def _put_route_times(self, user_phone: str, results: List[Dict], timestamp: str, ttl: int):
+        """Store every route result of a user, replacing the previous ones."""
+        raise NotImplementedError
+
+    def _get_route_times(self, user_phone: str) -> List[Dict]:
+        """[{unit, travel_time_min, timestamp}] stored for this user."""
+        raise NotImplementedError
+
+    def register_unit(self, unit: str, address: Optional[str] = None,
+                      postal_code: Optional[str] = None,
+                      latitude: Optional[float] = None,
+                      longitude: Optional[float] = None) -> Dict:
+        raise NotImplementedError
+
+    def get_all_units_with_locations(self) -> List[Dict]:
+        raise NotImplementedError
+
+    # ---- route times
+
+    def store_user_route_times(self, user_phone, results):
+        timestamp = datetime.now(timezone.utc).isoformat()
+        self._put_route_times(user_phone, results, timestamp, int(time.time()) + ROUTE_TIMES_TTL_S)
+        routes = [{"unit": r["unit"], "travel_time_min": r["travel_time_min"], "timestamp": timestamp}
+                  for r in results]
+        with self._route_lock:
+            self.route_cache[user_phone] = routes
+
+    def get_user_route_times(self, user_phone: str) -> List[Dict]:
+        with self._route_lock:
+            routes = self.route_cache.get(user_phone)
+        if routes is None:
+            routes = self._get_route_times(user_phone)
+            with self._route_lock:
+                self.route_cache[user_phone] = routes
+        return routes
+
+    def warm(self):
+        """
+        Bulk-load every rc sample with a single scan and fill the all-days and
+        cross-unit cache entries from it. Meant to run once in the gunicorn
+        master so workers inherit the data copy-on-write.
+        """
+        if SNAPSHOT_PATH:
+            self.load_snapshot()
+            return
+        items = self._own_events(self._scan_events())
+        by_unit = {}
+        by_color_slot = {}
+        for item in items:
+            color, slot = item.get('risk_color'), item.get('slot')
+            by_unit.setdefault((item.get('unit'), color, slot), []).append(item)
+            by_color_slot.setdefault((color, slot), []).append(item)
+        for (unit, color, slot), items in by_unit.items():
+            self._store_samples(("unit_slot_color_all_days", unit, color, slot), samples_from_items(items))
+        for (color, slot), items in by_color_slot.items():
+            self._store_samples(("color_slot_all_units", color, slot), samples_from_items(items))
+        logger.info("warmed %d unit and %d cross-unit sample batches", len(by_unit), len(by_color_slot))
+
+    def load_snapshot(self, path: str = SNAPSHOT_PATH):
+        """
+        Serve samples from a local event index: memory-map the snapshot at
+        `path` and fetch only events newer than its high-water mark. Without a
+        usable (or with a too old) snapshot the index is built from a full scan.
+        """
+        with self._events_refresh_lock:
+            self._start_scan()
+            try:
+                index = EventIndex.load(path) if path else None
+                if index is not None and time.time() - index.saved_at > SNAPSHOT_MAX_AGE_S:
+                    # rc items can be deleted upstream and deletions never show up in an
+                    # incremental fetch, so old snapshots are rebuilt from scratch
+                    logger.info("snapshot at %s is too old, rebuilding", path)
+                    index = None
+                if index is not None and index.shard_layout != self.shard_layout:
+                    logger.info("snapshot at %s was built for another shard layout, rebuilding", path)
+                    index = None
+                if index is None:
+                    index = EventIndex(shard_layout=self.shard_layout)
+                    items = self._own_events(self._scan_events())
+                else:
+                    items = self._own_events(self._scan_events(since=index.high_water_iso(SNAPSHOT_OVERLAP_S)))
+                with self._events_lock:
+                    index.merge(items)
+                    self._replay_scan_changes(index)
+                    self.events = index
+            finally:
+                self._stop_scan()
+            self.bump_generation()
+            self._events_checked_at = time.time()
+        logger.info("event index ready: %d rc events", len(index))
+        return index
+
+    def bump_generation(self):
+        """Mark cached data as outdated; request threads and the shard refresher all call this."""
+        with self._generation_lock:
+            self.generation += 1
+
+    def _maybe_refresh_events(self):
+        if time.time() - self._events_checked_at < SNAPSHOT_REFRESH_S:
+            return
+        if not self._events_refresh_lock.acquire(blocking=False):
+            return  # another thread is already refreshing
+        try:
+            since = self._start_scan()
+            items = self._own_events(self._scan_events(since=since))
+            with self._events_lock:
+                added = self.events.merge(items)
+                self._replay_scan_changes(self.events)
+            if added:
+                self.bump_generation()
+            self._events_checked_at = time.time()
+        finally:
+            self._stop_scan()
+            self._events_refresh_lock.release()
+
+    def _start_scan(self) -> Optional[str]:
+        """Start recording index changes for a scan; returns the scan's `since`."""
+        with self._events_lock:
+            self._changes_during_scan = []
+            return self.events.high_water_iso(SNAPSHOT_OVERLAP_S) if self.events is not None else None
+
+    def _replay_scan_changes(self, index: EventIndex):
+        # caller holds _events_lock
+        for op, item in self._changes_during_scan or ():
+            self._change_index(index, op, item)
+
+    def _stop_scan(self):
+        with self._events_lock:
+            self._changes_during_scan = None
+
+    @staticmethod
+    def _change_index(index: EventIndex, op: str, item: Dict):
+        if op == "rc":
+            index.merge([item])
+        elif op == "discard":
+            index.discard(item["pseudonym"], item["event_id"])
+
+    def _own_events(self, items: List[Dict]) -> List[Dict]:
+        if self.unit_filter is None:
+            return items
+        return [item for item in items if self.unit_filter(item.get("unit"))]
+
+    def save_snapshot(self, path: str = SNAPSHOT_PATH):
+        if self.events is not None and path:
+            with self._events_lock:
+                self.events.save(path)
+
+    def _record_change(self, op: str, item: Dict):
+        """Apply an event change to this worker's caches and tell the other workers."""
+        self._apply_change(op, item)
+        if self.changes is not None:
+            message = {k: item.get(k) for k in EVENT_ATTRIBUTES if item.get(k) is not None}
+            self.changes.publish({"op": op, "pid": os.getpid(), "item": message})
+
+    def _apply_change(self, op: str, item: Dict):
+        unit = item.get("unit")
+        units = self.est_cache.get(("units",))
+        if op == "unit" and units is not None and unit in units:
+            # sent for every cinza whose sender didn't know the unit; nothing new here
+            return
+        self.bump_generation()
+        if units is not None and unit not in units:
+            self.est_cache.pop(("units",), None)
+        if self.unit_filter is not None and not self.unit_filter(unit):
+            return
+        fields = sample_fields(item)
+        weekday = fields[2] if fields else None
+        if op in ("rc", "discard"):
+            for key in sample_cache_keys(unit, item.get("risk_color"), item.get("slot"),
+                                         item.get("day"), weekday):
+                self.est_cache.pop(key, None)
+        with self._events_lock:
+            if self._changes_during_scan is not None:
+                self._changes_during_scan.append((op, item))
+            if self.events is not None:
+                self._change_index(self.events, op, item)
+
+    def sync_changes(self):
+        """Apply changes published by other workers since the last call (one stat() if none)."""
+        if self.changes is None:
+            return
+        with self._changes_lock:
+            messages, reset = self.changes.poll()
+        if reset:
+            logger.info("change log rotated, dropping cached samples")
+            self.est_cache.clear()
+            self.bump_generation()
+        pid = os.getpid()
+        for message in messages:
+            if message.get("pid") != pid:
+                self._apply_change(message.get("op"), message.get("item") or {})
 
     def ingest_event(self, pseudonym: str, unit: str, event_type: str,
                     risk_color: Optional[str], timestamp: datetime):
@@ -50,20 +343,14 @@ class DataStore:
         timestamp_str = timestamp.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
         hashed_pseudonym = hash_pseudonym(pseudonym, self.secret)
 
-        response = self.table.query(
-            KeyConditionExpression=Key("pseudonym").eq(hashed_pseudonym) & Key("event_id").begins_with(f"{unit}#")
-        )
+        items = self._unit_events(hashed_pseudonym, unit)
 
-        items = response.get("Items", [])
         if event_type == "cinza":
             if items:
                 for item in items:
-                    self.table.delete_item(
-                        Key={
-                            "pseudonym": hashed_pseudonym,
-                            "event_id": item["event_id"]
-                        }
-                    )
+                    self._delete_event(hashed_pseudonym, item["event_id"])
+                    if item["event_type"] == "rc":
+                        self._record_change("discard", item)
 
             # Persist cinza event
             item = {
@@ -72,9 +359,14 @@ class DataStore:
                 "unit": unit,
                 "cinza_time": timestamp_str,
                 "event_time": timestamp_str,
+                "ingested_at": ingest_time(),
                 "event_type": "cinza"
             }
-            self.table.put_item(Item=item)
+            self._put_event(item)
+            # other workers may hold a units list without it even when ours is cold
+            units = self.est_cache.get(("units",))
+            if units is None or unit not in units:
+                self._record_change("unit", item)
             return None
         
         elif event_type == "rc":
@@ -84,12 +376,8 @@ class DataStore:
             
             for item in items:
                 if item["event_type"] == "rc":
-                    self.table.delete_item(
-                        Key={
-                            "pseudonym": hashed_pseudonym,
-                            "event_id": item["event_id"],
-                        }
-                    )
+                    self._delete_event(hashed_pseudonym, item["event_id"])
+                    self._record_change("discard", item)
                 if item["event_type"] == "cinza":
                     cinza_entry = item
                     cinza_time = datetime.fromisoformat(cinza_entry["cinza_time"])
@@ -115,36 +403,279 @@ class DataStore:
                 "delta_t": Decimal(str(delta_t)),
                 "slot": slot,
                 "day": day_str,
+                "ingested_at": ingest_time(),
                 "event_type": "rc"
             }
-            self.table.put_item(Item=item)
+            self._put_event(item)
+            self._record_change("rc", item)
             return delta_t
         else:
             return None
     
     def list_units(self):
         # This is an MVP approach - scan table and extract unique units.
-        response = self.table.scan(
+        self.sync_changes()
+        key = ("units",)
+        units = self.est_cache.get(key)
+        if units is not None:
+            return units
+        units = self._scan_event_units()
+        self.est_cache[key] = units
+        return units
+
+    def _load_samples(self, color: str, slot: str, unit: Optional[str] = None,
+                      day_str: Optional[str] = None) -> np.ndarray:
+        if self.events is not None:
+            self._maybe_refresh_events()
+            day_ord = date.fromisoformat(day_str).toordinal() if day_str else None
+            return self.events.select(unit, color, slot, day_ord)
+
+        return self._query_samples(color, slot, unit=unit, day_str=day_str)
+
+    def _cached_samples(self, key: tuple, mode: str) -> Optional[np.ndarray]:
+        """
+        Cache lookup shared by the fetchers. mode is "fetch" (normal),
+        "cached" (never hit the backend) or "stale" (like cached, but fall back
+        to the last batch seen for the key even if it expired or was invalidated).
+        """
+        batch = self.est_cache.get(key)
+        if batch is not None:
+            return batch
+        if mode == "stale":
+            return self.stale_cache.get(key)
+        return None
+
+    def _store_samples(self, key: tuple, batch: np.ndarray) -> np.ndarray:
+        self.est_cache[key] = batch
+        self.stale_cache[key] = batch
+        return batch
+
+    # Fetch samples for a specific unit, day, slot, and color
+    def fetch_samples_unit_day_slot_color(self, unit: str, color: str,
+                                          slot: str, day_str: str, mode: str = "fetch") -> Optional[np.ndarray]:
+        self.sync_changes()
+        key = ("unit_day_slot_color", unit, color, slot, day_str)
+        batch = self._cached_samples(key, mode)
+        if batch is not None or mode != "fetch":
+            return batch
+        return self._store_samples(key, self._load_samples(color, slot, unit=unit, day_str=day_str))
+
+    # Fetch samples for same unit, slot, color across all days
+    def fetch_samples_unit_slot_color_all_days(self, unit: str, color: str,
+                                               slot: str, mode: str = "fetch") -> Optional[np.ndarray]:
+        self.sync_changes()
+        key = ("unit_slot_color_all_days", unit, color, slot)
+        batch = self._cached_samples(key, mode)
+        if batch is not None or mode != "fetch":
+            return batch
+        return self._store_samples(key, self._load_samples(color, slot, unit=unit))
+
+    # Fetch samples for same unit, slot, color, and weekday
+    def fetch_samples_unit_color_slot_weekday(self, unit: str, color: str,
+                                              slot: str, weekday: int, mode: str = "fetch") -> Optional[np.ndarray]:
+        self.sync_changes()
+        key = ("unit_color_slot_weekday", unit, color, slot, weekday)
+        batch = self._cached_samples(key, mode)
+        if batch is not None:
+            return batch
+        # Same scan as the all-days concept, so filter that batch instead of scanning again
+        all_days = self.fetch_samples_unit_slot_color_all_days(unit, color, slot, mode)
+        if all_days is None:
+            return None
+        return self._store_samples(key, all_days[all_days["weekday"] == weekday])
+
+    # Fetch samples across all units for a given slot and color
+    def fetch_samples_color_slot_all_units(self, color: str, slot: str, mode: str = "fetch") -> Optional[np.ndarray]:
+        self.sync_changes()
+        key = ("color_slot_all_units", color, slot)
+        batch = self._cached_samples(key, mode)
+        if batch is not None or mode != "fetch":
+            return batch
+        return self._store_samples(key, self._load_samples(color, slot))
+
+    # ---- per-concept aggregates; backends with an engine can push these down
+
+    def iqr_median_unit_day_slot_color(self, unit: str, color: str, slot: str, day_str: str,
+                                       factor: float, mode: str = "fetch") -> Optional[Tuple[int, Optional[float]]]:
+        """(count, median) of the IQR-filtered same-day samples; None if unavailable in this mode."""
+        batch = self.fetch_samples_unit_day_slot_color(unit, color, slot, day_str, mode)
+        return None if batch is None else iqr_median(batch["delta_t"], factor)
+
+    def iqr_median_color_slot_all_units(self, color: str, slot: str, factor: float,
+                                        mode: str = "fetch") -> Optional[Tuple[int, Optional[float]]]:
+        """(count, median) of the IQR-filtered cross-unit samples; None if unavailable in this mode."""
+        batch = self.fetch_samples_color_slot_all_units(color, slot, mode)
+        return None if batch is None else iqr_median(batch["delta_t"], factor)
+
+
+class DynamoDataStore(DataStore):
+    """DataStore backed by the DynamoDB tables wait_time_events, units and user_route_times."""
+
+    def __init__(self):
+        super().__init__()
+        # Connections are created on first use; boto3 sessions must not be
+        # shared across a gunicorn fork (see gunicorn.conf.py).
+        self.dynamo = DynamoAccess()
+
+    @property
+    def table(self):
+        return self.dynamo.table(DYNAMODB_TABLE)
+
+    @property
+    def units_table(self):
+        return self.dynamo.table("units")
+
+    @property
+    def user_route_table(self):
+        return self.dynamo.table("user_route_times")
+
+    def reset_connections(self):
+        self.dynamo.reset()
+
+    def _unit_events(self, hashed_pseudonym: str, unit: str) -> List[Dict]:
+        from boto3.dynamodb.conditions import Key
+        return self.dynamo.query_all(
+            DYNAMODB_TABLE,
+            KeyConditionExpression=Key("pseudonym").eq(hashed_pseudonym) & Key("event_id").begins_with(f"{unit}#")
+        )
+
+    def _put_event(self, item: Dict):
+        self.table.put_item(Item=item)
+
+    def _delete_event(self, hashed_pseudonym: str, event_id: str):
+        self.table.delete_item(
+            Key={
+                "pseudonym": hashed_pseudonym,
+                "event_id": event_id
+            }
+        )
+
+    def _event_scan_args(self, since: Optional[str], attributes: Sequence[str]) -> Dict:
+        from boto3.dynamodb.conditions import Attr
+        condition = Attr('event_type').eq('rc')
+        if since is not None:
+            condition = condition & (Attr('ingested_at').gt(since) |
+                                     (Attr('ingested_at').not_exists() & Attr('event_time').gt(since)))
+        names = {f"#a{i}": a for i, a in enumerate(attributes)}
+        return dict(
+            FilterExpression=condition,
+            ProjectionExpression=", ".join(names),
+            ExpressionAttributeNames=names,
+        )
+
+    def _scan_events(self, since: Optional[str] = None,
+                     attributes: Sequence[str] = EVENT_ATTRIBUTES) -> List[Dict]:
+        return self.dynamo.parallel_scan(DYNAMODB_TABLE, **self._event_scan_args(since, attributes))
+
+    def iter_event_pages(self, since: Optional[str] = None,
+                         attributes: Sequence[str] = EVENT_ATTRIBUTES) -> Iterator[List[Dict]]:
+        return self.dynamo.iter_parallel_scan(DYNAMODB_TABLE, **self._event_scan_args(since, attributes))
+
+    def _scan_event_units(self) -> List[str]:
+        items = self.dynamo.parallel_scan(
+            DYNAMODB_TABLE,
             ProjectionExpression="#u",
             ExpressionAttributeNames={"#u": "unit"}
         )
-        items = response.get('Items', [])
-        units = set(item['unit'] for item in items)
-        return list(units)
+        return list(set(item['unit'] for item in items))
 
-    def store_user_route_times(self, user_phone, results):
-        # Calculate ttl for 48 hours from now
-        ttl_value = int(time.time()) + 48 * 60 * 60
-
-        with self.user_route_table.batch_writer() as batch:
-            for r in results:
-                batch.put_item(Item={
-                    "user_phone": user_phone,
-                    "unit": r["unit"],
-                    "travel_time_min": Decimal(str(r["travel_time_min"])) if r["travel_time_min"] is not None else None,
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "ttl": ttl_value  # <--- add this line!
-                })
+    def _query_samples(self, color: str, slot: str, unit: Optional[str] = None,
+                       day_str: Optional[str] = None) -> np.ndarray:
+        from boto3.dynamodb.conditions import Attr
+        condition = Attr('risk_color').eq(color) & Attr('slot').eq(slot) & Attr('event_type').eq('rc')
+        if unit is not None:
+            condition = Attr('unit').eq(unit) & condition
+        if day_str is not None:
+            condition = condition & Attr('day').eq(day_str)
+        # Only read the attributes the estimator needs
+        names = {f"#a{i}": a for i, a in enumerate(SAMPLE_ATTRIBUTES)}
+        items = self.dynamo.scan_all(
+            DYNAMODB_TABLE,
+            FilterExpression=condition,
+            ProjectionExpression=", ".join(names),
+            ExpressionAttributeNames=names,
+        )
+        return samples_from_items(items)
+
+    # ---- route times: legacy layout is one item per (user_phone, unit);
+    # packed layout is one item per user, keyed (user_phone=PACKED_ROUTES_PREFIX
+    # + phone, unit=PACKED_ROUTES_UNIT) so legacy queries never see it
+
+    def _put_route_times(self, user_phone: str, results: List[Dict], timestamp: str, ttl: int):
+        if ROUTE_TIMES_LAYOUT in ("packed", "dual"):
+            self.user_route_table.put_item(Item=self._packed_route_item(user_phone, results, timestamp, ttl))
+        if ROUTE_TIMES_LAYOUT in ("legacy", "dual"):
+            with self.user_route_table.batch_writer() as batch:
+                for r in results:
+                    batch.put_item(Item={
+                        "user_phone": user_phone,
+                        "unit": r["unit"],
+                        "travel_time_min": _decimal(r["travel_time_min"]),
+                        "timestamp": timestamp,
+                        "ttl": ttl,
+                    })
+
+    def _get_route_times(self, user_phone: str) -> List[Dict]:
+        if ROUTE_TIMES_LAYOUT == "legacy":
+            return self._get_legacy_route_times(user_phone)[0]
+        item = self.user_route_table.get_item(
+            Key={"user_phone": PACKED_ROUTES_PREFIX + user_phone, "unit": PACKED_ROUTES_UNIT}
+        ).get("Item")
+        packed = None
+        # DynamoDB deletes expired items up to days late
+        if item is not None and int(item["ttl"]) > time.time():
+            packed = [{"unit": unit, "travel_time_min": minutes, "timestamp": item["timestamp"]}
+                      for unit, minutes in item["routes"].items()]
+            if ROUTE_TIMES_LAYOUT == "packed":
+                return packed
+        routes, ttl = self._get_legacy_route_times(user_phone)
+        if packed is not None:
+            # dual: instances still on the legacy layout may have written after
+            # the packed item; timestamps are all UTC isoformat() strings
+            newest_legacy = max((r["timestamp"] for r in routes if r["timestamp"]), default=None)
+            return routes if newest_legacy is not None and newest_legacy > item["timestamp"] else packed
+        if routes and ROUTE_TIMES_LAYOUT == "packed":
+            self._migrate_route_times(user_phone, routes, ttl)
+        return routes
+
+    def _get_legacy_route_times(self, user_phone: str) -> Tuple[List[Dict], Optional[int]]:
+        """Legacy items of a user and the latest ttl among them."""
+        from boto3.dynamodb.conditions import Key
+        items = self.dynamo.query_all(
+            "user_route_times",
+            KeyConditionExpression=Key("user_phone").eq(user_phone)
+        )
+        routes = [{"unit": i["unit"], "travel_time_min": i.get("travel_time_min"), "timestamp": i.get("timestamp")}
+                  for i in items]
+        ttls = [int(i["ttl"]) for i in items if i.get("ttl") is not None]
+        return routes, (max(ttls) if ttls else None)
+
+    def _migrate_route_times(self, user_phone: str, routes: List[Dict], ttl: Optional[int]):
+        """Repack legacy items under their own expiry; the legacy items are left to expire."""
+        from boto3.dynamodb.conditions import Attr
+        if ttl is not None and ttl <= time.time():
+            return
+        timestamps = [r["timestamp"] for r in routes if r["timestamp"]]
+        timestamp = min(timestamps) if timestamps else datetime.now(timezone.utc).isoformat()
+        try:
+            self.user_route_table.put_item(
+                Item=self._packed_route_item(user_phone, routes, timestamp,
+                                             ttl if ttl is not None else int(time.time()) + ROUTE_TIMES_TTL_S),
+                # a concurrent /route_times POST wins over the migration
+                ConditionExpression=Attr("user_phone").not_exists(),
+            )
+        except self.user_route_table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    @staticmethod
+    def _packed_route_item(user_phone: str, results: List[Dict], timestamp: str, ttl: int) -> Dict:
+        return {
+            "user_phone": PACKED_ROUTES_PREFIX + user_phone,
+            "unit": PACKED_ROUTES_UNIT,
+            "routes": {r["unit"]: _decimal(r["travel_time_min"]) for r in results},
+            "timestamp": timestamp,
+            "ttl": ttl,
+        }
 
     # Unit registration
     def register_unit(self, unit: str, address: Optional[str] = None,
@@ -163,123 +694,14 @@ class DataStore:
 
     # List registered units
     def get_all_units_with_locations(self) -> List[Dict]:
-        resp = self.units_table.scan()
-        return resp.get("Items", [])
-
-    # Retrieve stored route times for a user
-    def get_user_route_times(self, user_phone: str) -> List[Dict]:
-        resp = self.user_route_table.query(
-            KeyConditionExpression=Key("user_phone").eq(user_phone)
-        )
-        return resp.get("Items", [])
+        return self.dynamo.scan_all("units")
 
-    # Fetch samples for a specific unit, day, slot, and color
-    def fetch_samples_unit_day_slot_color_df(self, unit: str, color: str,
-                                             slot: str, day_str: str) -> pd.DataFrame:
-        key = ("unit_day_slot_color", unit, color, slot, day_str)
-        if key in self.est_cache:
-            print("YES cache")
-            return self.est_cache[key]
-        print("NOT cache")
-        resp = self.table.scan(
-            FilterExpression=Attr('unit').eq(unit)
-                            & Attr('risk_color').eq(color)
-                            & Attr('slot').eq(slot)
-                            & Attr('day').eq(day_str)
-                            & Attr('event_type').eq('rc')
-        )
-        items = resp.get('Items', [])
-        if not items:
-            df = pd.DataFrame(columns=['delta_t', 'day'])
-            self.est_cache[key] = df
-            return df
-        
-        df = pd.DataFrame(items)
-        df['delta_t'] = df['delta_t'].astype(float)
-        
-        self.est_cache[key] = df
 
-        return df[['delta_t', 'day']]
-
-    # Fetch samples for same unit, slot, color across all days
-    def fetch_samples_unit_slot_color_all_days_df(self, unit: str, color: str,
-                                                  slot: str) -> pd.DataFrame:
-        key = ("unit_slot_color_all_days", unit, color, slot)
-        if key in self.est_cache:
-            return self.est_cache[key]
-        
-        resp = self.table.scan(
-            FilterExpression=Attr('unit').eq(unit)
-                            & Attr('risk_color').eq(color)
-                            & Attr('slot').eq(slot)
-                            & Attr('event_type').eq('rc')
-        )
-        items = resp.get('Items', [])
-        if not items:
-            df = pd.DataFrame(columns=['delta_t', 'day'])
-            self.est_cache[key] = df
-            return df
-        
-        df = pd.DataFrame(items)
-        df['delta_t'] = df['delta_t'].astype(float)
-
-        self.est_cache[key] = df
-
-        return df[['delta_t', 'day']]
-
-    # Fetch samples for same unit, slot, color, and weekday
-    def fetch_samples_unit_color_slot_weekday_df(self, unit: str, color: str,
-                                                 slot: str, weekday: int) -> pd.DataFrame:
-        key = ("unit_color_slot_weekday", unit, color, slot, weekday)
-        if key in self.est_cache:
-            return self.est_cache[key]
-        
-        resp = self.table.scan(
-            FilterExpression=Attr('unit').eq(unit)
-                            & Attr('risk_color').eq(color)
-                            & Attr('slot').eq(slot)
-                            & Attr('event_type').eq('rc')
-        )
-        items = resp.get('Items', [])
-        if not items:
-            df = pd.DataFrame(columns=['delta_t', 'day'])
-            self.est_cache[key] = df
-            return df
-        
-        df = pd.DataFrame(items)
-        df['rc_time'] = pd.to_datetime(
-            df['rc_time'],
-            format='ISO8601'
-        )
-
-        # filter on the weekday
-        df = df[df['rc_time'].dt.weekday == weekday]
-        df['delta_t'] = df['delta_t'].astype(float)
-
-        self.est_cache[key] = df
-
-        return df[['delta_t', 'day']]
-
-    # Fetch samples across all units for a given slot and color
-    def fetch_samples_color_slot_all_units_df(self, color: str, slot: str) -> pd.DataFrame:
-        key = ("color_slot_all_units", color, slot)
-        if key in self.est_cache:
-            return self.est_cache[key]
-        
-        resp = self.table.scan(
-            FilterExpression=Attr('risk_color').eq(color)
-                            & Attr('slot').eq(slot)
-                            & Attr('event_type').eq('rc')
-        )
-        items = resp.get('Items', [])
-        if not items:
-            df = pd.DataFrame(columns=['delta_t'])
-            self.est_cache[key] = df
-            return df
-        
-        df = pd.DataFrame(items)
-        df['delta_t'] = df['delta_t'].astype(float)
-
-        self.est_cache[key] = df
-        
-        return df[['delta_t']]
\ No newline at end of file
+def create_datastore(backend: str = DATASTORE_BACKEND) -> DataStore:
+    """The DataStore for the configured backend ("dynamodb" or "sqlite")."""
+    if backend == "dynamodb":
+        return DynamoDataStore()
+    if backend == "sqlite":
+        from sql_store import SqlDataStore
+        return SqlDataStore()
+    raise ValueError(f"Unknown DATASTORE_BACKEND: {backend!r}")
@@ -0,0 +1,175 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+from config import (
+    AWS_REGION,
+    DYNAMODB_ENDPOINT_URL,
+    DYNAMODB_MAX_POOL_CONNECTIONS,
+    DYNAMODB_CONNECT_TIMEOUT_S,
+    DYNAMODB_READ_TIMEOUT_S,
+    DYNAMODB_SCAN_SEGMENTS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DynamoAccess:
+    """
+    Shared DynamoDB access for DataStore. boto3 is imported on first use, so
+    processes that never reach DynamoDB (the sqlite backend) don't load it.
+
+    One boto3 session and resource per process, created under a lock
+    (sessions are not thread-safe), so every thread shares one botocore
+    client and its connection pool; the client is thread-safe. Table objects
+    are still kept per thread. scan_all / query_all follow LastEvaluatedKey
+    so results are never cut at 1 MB, and parallel_scan splits bulk loads
+    into Segment/TotalSegments.
+    """
+
+    def __init__(self, region: str = AWS_REGION):
+        self.region = region
+        self._resource = None
+        self._resource_lock = threading.Lock()
+        self._local = threading.local()
+        # bumped by reset(); threads drop their Table objects when it changes
+        self._generation = 0
+        # long-lived so segment threads are reused between scans
+        self._scan_pool = None
+        self._scan_pool_lock = threading.Lock()
+
+    def reset(self):
+        """Forget the resource and its client, e.g. in a freshly forked worker."""
+        with self._resource_lock:
+            self._resource = None
+            self._generation += 1
+        # threads don't survive a fork; the next parallel scan starts a new pool
+        self._scan_pool = None
+
+    def resource(self):
+        with self._resource_lock:
+            if self._resource is None:
+                import boto3
+                from botocore.config import Config
+                config = Config(
+                    max_pool_connections=DYNAMODB_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                    connect_timeout=DYNAMODB_CONNECT_TIMEOUT_S,
+                    read_timeout=DYNAMODB_READ_TIMEOUT_S,
+                    retries={"max_attempts": 5, "mode": "adaptive"},
+                )
+                session = boto3.session.Session()
+                self._resource = session.resource("dynamodb", region_name=self.region,
+                                                  endpoint_url=DYNAMODB_ENDPOINT_URL, config=config)
+            return self._resource
+
+    def table(self, name: str):
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            local.tables = {}
+            local.generation = self._generation
+        tables = local.tables
+        if name not in tables:
+            resource = self.resource()
+            with self._resource_lock:
+                tables[name] = resource.Table(name)
+        return tables[name]
+
+    def scan_pages(self, table_name: str, **kwargs) -> Iterator[List[Dict]]:
+        """Items of a scan one page at a time (kwargs are passed to Table.scan)."""
+        table = self.table(table_name)
+        while True:
+            resp = table.scan(**kwargs)
+            yield resp.get("Items", [])
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key:
+                return
+            kwargs["ExclusiveStartKey"] = last_key
+
+    def scan_all(self, table_name: str, **kwargs) -> List[Dict]:
+        """Every page of a scan (kwargs are passed to Table.scan)."""
+        return [item for page in self.scan_pages(table_name, **kwargs) for item in page]
+
+    def query_all(self, table_name: str, **kwargs) -> List[Dict]:
+        """Every page of a query (kwargs are passed to Table.query)."""
+        table = self.table(table_name)
+        items = []
+        while True:
+            resp = table.query(**kwargs)
+            items.extend(resp.get("Items", []))
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key:
+                return items
+            kwargs["ExclusiveStartKey"] = last_key
+
+    def _pool(self, segments: int) -> ThreadPoolExecutor:
+        with self._scan_pool_lock:
+            if self._scan_pool is None or self._scan_pool._max_workers < segments:
+                if self._scan_pool is not None:
+                    # scans already running on the old pool finish there
+                    self._scan_pool.shutdown(wait=False)
+                self._scan_pool = ThreadPoolExecutor(max_workers=segments, thread_name_prefix="dynamo-scan")
+            return self._scan_pool
+
+    def parallel_scan(self, table_name: str, segments: Optional[int] = None, **kwargs) -> List[Dict]:
+        """Full scan split into `segments` Segment/TotalSegments scans run concurrently."""
+        segments = segments or DYNAMODB_SCAN_SEGMENTS
+        if segments <= 1:
+            return self.scan_all(table_name, **kwargs)
+
+        def scan_segment(segment: int) -> List[Dict]:
+            return self.scan_all(table_name, Segment=segment, TotalSegments=segments, **kwargs)
+
+        parts = list(self._pool(segments).map(scan_segment, range(segments)))
+        return [item for part in parts for item in part]
+
+    def iter_parallel_scan(self, table_name: str, segments: Optional[int] = None,
+                           max_pending_pages: int = 16, **kwargs) -> Iterator[List[Dict]]:
+        """
+        Like parallel_scan, but yields pages as the segments return them, so a
+        consumer can stream the whole table without holding it in memory.
+        Segments pause while `max_pending_pages` pages wait to be consumed.
+        """
+        segments = segments or DYNAMODB_SCAN_SEGMENTS
+        if segments <= 1:
+            yield from self.scan_pages(table_name, **kwargs)
+            return
+
+        pages = queue.Queue(maxsize=max_pending_pages)
+        stop = threading.Event()
+        done = object()
+
+        def scan_segment(segment: int):
+            try:
+                for page in self.scan_pages(table_name, Segment=segment, TotalSegments=segments, **kwargs):
+                    while not stop.is_set():
+                        try:
+                            pages.put(page, timeout=0.5)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+            finally:
+                pages.put(done)
+
+        futures = [self._pool(segments).submit(scan_segment, s) for s in range(segments)]
+        try:
+            remaining = segments
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                else:
+                    yield page
+            for future in futures:
+                future.result()  # re-raise scan errors
+        finally:
+            stop.set()
+            # unblock segments still waiting to put their end marker
+            while any(not f.done() for f in futures):
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
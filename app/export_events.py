@@ -0,0 +1,249 @@
+"""
+Export rc events to Parquet, partitioned by day and unit.
+
+    python export_events.py                      # incremental, from the watermark
+    python export_events.py --full               # ignore the watermark
+    python export_events.py --compact            # export, then merge small files
+    python export_events.py --compact-only
+
+Layout (hive style, readable by pyarrow.dataset, DuckDB, Spark, ...):
+
+    <root>/day=2025-06-04/unit=UPA%20Urias%20Magalh%C3%A3es/part-<run>-<n>.parquet
+    <root>/_watermark.json
+
+The table is streamed page by page (a parallel scan on DynamoDB). Rows are
+buffered per partition up to EXPORT_ROWS_PER_FILE; past
+EXPORT_MAX_BUFFERED_ROWS in all (many small partitions), the largest
+partitions are flushed early, so memory stays bounded. Each run starts from
+the watermark (the newest ingested_at exported, the server's write time)
+minus SNAPSHOT_OVERLAP_S, so a row whose client event_time is long past still
+goes out with the run after it was written. The overlap re-exports some rows, and read_events()
+drops those exact duplicates. The watermark only moves once every file of a
+run is in place.
+
+The live table keeps only the latest rc per pseudonym and unit, so the
+export also accumulates history that DynamoDB no longer has.
+
+Needs pyarrow (not part of the API image).
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import quote
+import numpy as np
+from config import (
+    EXPORT_PATH, EXPORT_ROWS_PER_FILE, EXPORT_MAX_BUFFERED_ROWS, EXPORT_COMPACT_MIN_FILES, SNAPSHOT_OVERLAP_S
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+WATERMARK_FILE = "_watermark.json"
+PARTITION_KEYS = ("day", "unit")
+EXPORT_ATTRIBUTES = ("pseudonym", "event_id", "unit", "event_type", "risk_color", "slot", "delta_t",
+                     "day", "cinza_time", "rc_time", "event_time", "ingested_at")
+# what goes into the files; day and unit live in the directory names
+FILE_COLUMNS = tuple(a for a in EXPORT_ATTRIBUTES if a not in PARTITION_KEYS)
+
+
+def _schema():
+    # explicit, so files written before a column existed read it as nulls
+    import pyarrow as pa
+    return pa.schema([(c, pa.float64() if c == "delta_t" else pa.string()) for c in FILE_COLUMNS])
+
+
+def partition_dir(root: str, day: str, unit: str) -> str:
+    return os.path.join(root, f"day={day}", f"unit={quote(unit, safe='')}")
+
+
+def _write_file(path: str, rows: List[Dict]):
+    """Write rows atomically: readers never see a partial file."""
+    import pyarrow as pa
+    columns = {c: [r.get(c) for r in rows] for c in FILE_COLUMNS}
+    columns["delta_t"] = [None if v is None else float(v) for v in columns["delta_t"]]
+    table = pa.table(columns, schema=_schema())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_atomic(table, path)
+
+
+def _write_atomic(table, path: str):
+    import pyarrow.parquet as pq
+    # dot-prefixed so dataset readers skip it while it's being written
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(table, tmp, compression="zstd")
+    os.replace(tmp, path)
+
+
+# ---- watermark
+
+def read_watermark(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, WATERMARK_FILE)) as f:
+            wm = json.load(f)
+    except FileNotFoundError:
+        return None
+    # watermarks written before ingested_at existed hold an event_time
+    return wm.get("ingested_at") or wm.get("event_time")
+
+
+def write_watermark(root: str, ingested_at: str, rows: int):
+    path = os.path.join(root, WATERMARK_FILE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"ingested_at": ingested_at, "rows": rows, "exported_at": time.time()}, f)
+    os.replace(tmp, path)
+
+
+def _minus_overlap(ts: str, overlap_s: int) -> str:
+    # ISO-8601 UTC with a 'Z' suffix, as written by ingest_event
+    dt = datetime.fromisoformat(ts.replace("Z", "+00:00")) - timedelta(seconds=overlap_s)
+    return dt.isoformat(timespec="microseconds").replace("+00:00", "Z")
+
+
+# ---- export
+
+def export(datastore, root: str = EXPORT_PATH, full: bool = False,
+           rows_per_file: int = EXPORT_ROWS_PER_FILE, overlap_s: int = SNAPSHOT_OVERLAP_S,
+           max_buffered_rows: int = EXPORT_MAX_BUFFERED_ROWS) -> int:
+    """Stream rc events newer than the watermark into Parquet. Returns rows written."""
+    watermark = None if full else read_watermark(root)
+    since = _minus_overlap(watermark, overlap_s) if watermark else None
+    logger.info("exporting events %s", f"since {since}" if since else "(full)")
+
+    run = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    buffers: Dict[tuple, List[Dict]] = defaultdict(list)
+    buffered = 0
+    seq = 0
+    written = 0
+    high_water = watermark
+
+    def flush(key):
+        nonlocal buffered, seq, written
+        rows = buffers.pop(key)
+        _write_file(os.path.join(partition_dir(root, *key), f"part-{run}-{seq}.parquet"), rows)
+        buffered -= len(rows)
+        seq += 1
+        written += len(rows)
+
+    for page in datastore.iter_event_pages(since, EXPORT_ATTRIBUTES):
+        for item in page:
+            day, unit = item.get("day"), item.get("unit")
+            if not day or not unit:
+                continue
+            key = (day, unit)
+            buffers[key].append(item)
+            buffered += 1
+            # the same value the scan selects on: items from before
+            # ingested_at existed only have their event_time
+            ingested = item.get("ingested_at") or item.get("event_time")
+            if ingested and (high_water is None or ingested > high_water):
+                high_water = ingested
+            if len(buffers[key]) >= rows_per_file:
+                flush(key)
+        if buffered > max_buffered_rows:
+            # flush down to half the cap, largest first, so this doesn't run for every page
+            for key in sorted(buffers, key=lambda k: len(buffers[k]), reverse=True):
+                if buffered <= max_buffered_rows // 2:
+                    break
+                flush(key)
+    for key in list(buffers):
+        flush(key)
+
+    if high_water is not None:
+        write_watermark(root, high_water, written)
+    logger.info("exported %d rows into %d files, watermark %s", written, seq, high_water)
+    return written
+
+
+# ---- reading and compaction
+
+def _dedupe(table):
+    """Drop exact re-exports (same pseudonym, event_id and event_time)."""
+    import pyarrow.compute as pc
+    if table.num_rows == 0:
+        return table
+    keys = pc.binary_join_element_wise(
+        table["pseudonym"], table["event_id"], table["event_time"], "\x1f")
+    _, first = np.unique(keys.to_numpy(zero_copy_only=False), return_index=True)
+    first.sort()
+    return table.take(first)
+
+
+def read_table(root: str = EXPORT_PATH, filter_expr=None):
+    """
+    The export as one pyarrow Table (day and unit included), duplicates
+    removed. `filter_expr` is a pyarrow.dataset expression, e.g.
+    ds.field("day") >= "2025-01-01", and prunes partitions before reading.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    partitioning = ds.partitioning(pa.schema([("day", pa.string()), ("unit", pa.string())]), flavor="hive")
+    schema = pa.schema(list(_schema()) + [pa.field(k, pa.string()) for k in PARTITION_KEYS])
+    dataset = ds.dataset(root, schema=schema, format="parquet", partitioning=partitioning,
+                         exclude_invalid_files=True, ignore_prefixes=["_", "."])
+    return _dedupe(dataset.to_table(filter=filter_expr))
+
+
+def read_events(root: str = EXPORT_PATH) -> List[Dict]:
+    """The export as event items, the shape _scan_events returns."""
+    return read_table(root).to_pylist()
+
+
+def _partitions(root: str) -> Iterable[str]:
+    for day_dir in sorted(os.listdir(root)):
+        if not day_dir.startswith("day="):
+            continue
+        for unit_dir in sorted(os.listdir(os.path.join(root, day_dir))):
+            if unit_dir.startswith("unit="):
+                yield os.path.join(root, day_dir, unit_dir)
+
+
+def compact(root: str = EXPORT_PATH, min_files: int = EXPORT_COMPACT_MIN_FILES) -> int:
+    """
+    Merge every partition holding at least `min_files` files into a single
+    deduplicated file. The merged file is in place before the old ones are
+    removed; a reader in between sees duplicates, which read_events drops.
+    Returns the number of partitions compacted.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    compacted = 0
+    for part in _partitions(root):
+        files = sorted(f for f in os.listdir(part) if f.endswith(".parquet"))
+        if len(files) < max(min_files, 2):
+            continue
+        paths = [os.path.join(part, f) for f in files]
+        table = pa.concat_tables([pq.read_table(p, schema=_schema()) for p in paths])
+        table = _dedupe(table.combine_chunks()).sort_by("event_time")
+        _write_atomic(table, os.path.join(part, f"compacted-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet"))
+        for path in paths:
+            os.remove(path)
+        compacted += 1
+    logger.info("compacted %d partitions", compacted)
+    return compacted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=EXPORT_PATH)
+    parser.add_argument("--full", action="store_true", help="ignore the watermark and export everything")
+    parser.add_argument("--compact", action="store_true", help="compact partitions after exporting")
+    parser.add_argument("--compact-only", action="store_true")
+    parser.add_argument("--min-files", type=int, default=EXPORT_COMPACT_MIN_FILES)
+    args = parser.parse_args()
+
+    if not args.compact_only:
+        from data_store import create_datastore
+        export(create_datastore(), args.root, full=args.full)
+    if args.compact or args.compact_only:
+        compact(args.root, args.min_files)
+
+
+if __name__ == "__main__":
+    main()
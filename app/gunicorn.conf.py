@@ -0,0 +1,23 @@
+# gunicorn settings, picked up automatically from the working directory.
+# The app is imported once in the master (preload_app) and workers are forked
+# from it, so modules, slot tables and warmed sample data are shared
+# copy-on-write instead of being rebuilt by every worker.
+import gc
+
+bind = "0.0.0.0:8080"
+workers = 4
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+
+def when_ready(server):
+    import main
+    main.preload()
+    # Keep the preloaded objects out of the GC's generations so collections in
+    # the workers don't touch (and un-share) their pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import main
+    main.datastore.reset_connections()
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A line is written with a single O_APPEND write; keeping it under PIPE_BUF
+# means concurrent writers never interleave within a line.
+MAX_MESSAGE_BYTES = 4096
+
+
+class ChangeLog:
+    """
+    Append-only file used as a local pub/sub channel between the workers of
+    one host. publish() appends a JSON line; poll() returns the lines other
+    writers (and this one) appended since the last poll. Polling is one
+    stat() when nothing changed, so it can run on every cache lookup.
+
+    When the file grows past max_bytes the writer that notices rotates it.
+    Readers then see a new inode and get reset=True from poll(): messages may
+    have been missed, so they should drop everything they cached.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 8 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._inode = None
+        self._offset = 0
+        try:
+            st = os.stat(path)
+            # start at the end: older messages predate this process' caches
+            self._inode, self._offset = st.st_ino, st.st_size
+        except FileNotFoundError:
+            pass
+
+    def publish(self, message: Dict):
+        line = (json.dumps(message, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+        if len(line) > MAX_MESSAGE_BYTES:
+            logger.warning("change log message too large (%d bytes), dropped", len(line))
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > self.max_bytes:
+            try:
+                os.replace(self.path, self.path + ".1")
+            except FileNotFoundError:
+                pass  # somebody else rotated first
+
+    def poll(self) -> Tuple[List[Dict], bool]:
+        """(new messages, reset). reset means the log was rotated under us."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return [], False
+        reset = False
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            reset = self._inode is not None
+            self._inode, self._offset = st.st_ino, 0
+        if st.st_size == self._offset:
+            return [], reset
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read(st.st_size - self._offset)
+        # a writer may be mid-line; leave the partial tail for the next poll
+        end = data.rfind(b"\n") + 1
+        self._offset += end
+        messages = []
+        for line in data[:end].splitlines():
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                logger.warning("skipping malformed change log line")
+        return messages, reset
+
+
+def sample_cache_keys(unit: str, color: Optional[str], slot: Optional[str],
+                      day_str: Optional[str], weekday: Optional[int]) -> List[tuple]:
+    """The DataStore.est_cache keys whose samples include an rc event with these attributes."""
+    return [
+        ("unit_day_slot_color", unit, color, slot, day_str),
+        ("unit_slot_color_all_days", unit, color, slot),
+        ("unit_color_slot_weekday", unit, color, slot, weekday),
+        ("color_slot_all_units", color, slot),
+    ]
@@ -0,0 +1,446 @@
+"""
+End-to-end load test: start the API the way it is deployed (gunicorn with
+uvicorn workers) against a local datastore, replay a traffic mix and report
+throughput, latency percentiles and error rates per endpoint.
+
+    python loadtest.py                                   # default mix, 60 s
+    python loadtest.py --mix shift-change --curve burst --duration 180
+    python loadtest.py --mix polling=all_estimates:10,annotate:1 --rate 80
+    python loadtest.py --save-baseline base.json
+    python loadtest.py --compare base.json               # exit 1 on regressions
+    python loadtest.py --url http://127.0.0.1:8080       # an already running server
+
+Backends:
+  sqlite    (default) DATASTORE_BACKEND=sqlite on a fresh temp database
+  dynamodb  DynamoDB Local / moto server at --endpoint-url; tables are
+            created if missing
+
+Arrivals are open loop: every endpoint gets a Poisson process with rate
+--rate x its share of the mix x the curve multiplier at that instant, so a
+slow server builds up queueing instead of silently lowering the load.
+Requests beyond --max-inflight are counted as dropped.
+
+Endpoints that call third parties (/route_times POST, /cep_lookup,
+/register_unit with a postal code) are not part of the mixes.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+from zoneinfo import ZoneInfo
+import httpx
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# endpoint -> share of the traffic
+MIXES = {
+    "default": {"all_estimates": 4, "estimate": 3, "annotate": 2, "units": 0.5,
+                "route_times_get": 0.3, "register_unit": 0.1, "health": 0.1},
+    # n8n / frontend polling the listing, little else
+    "polling": {"all_estimates": 10, "estimate": 1, "annotate": 0.5, "health": 0.1},
+    # a shift change: a wave of check-ins/check-outs on top of the polling
+    "shift-change": {"annotate": 6, "all_estimates": 4, "estimate": 2, "units": 0.2},
+}
+
+# curve(t, duration) -> rate multiplier
+CURVES: Dict[str, Callable[[float, float], float]] = {
+    "steady": lambda t, d: 1.0,
+    # 0.2x -> 2x linearly over the run
+    "ramp": lambda t, d: 0.2 + 1.8 * t / d,
+    # 10 s at 4x every minute, 0.5x in between
+    "burst": lambda t, d: 4.0 if t % 60 < 10 else 0.5,
+    # one slow wave peaking mid-run
+    "wave": lambda t, d: 0.25 + 1.75 * np.sin(np.pi * t / d) ** 2,
+}
+
+COLORS = ["b", "g", "y", "o", "r"]
+METRICS = ("rps", "p50", "p95", "p99", "error_rate")
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """A preset name or 'endpoint:weight,...' (optionally prefixed by 'name=')."""
+    if spec in MIXES:
+        return MIXES[spec]
+    spec = spec.split("=", 1)[-1]
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        if name not in REQUESTS:
+            raise ValueError(f"unknown endpoint {name!r}, expected one of {sorted(REQUESTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# ---- simulated clients
+
+class Traffic:
+    """Builds requests for each endpoint; annotate alternates cinza/rc per pseudonym."""
+
+    def __init__(self, units: List[str], pseudonyms: int, rng: random.Random, clock: Optional[str] = None):
+        self.units = units
+        self.rng = rng
+        self.pseudonyms = [f"load-{i}" for i in range(pseudonyms)]
+        self.waiting = {}  # pseudonym -> unit of its open cinza
+        self.offset = timedelta(0)
+        if clock:
+            # simulated clock starting today at HH:MM in Sao Paulo
+            real = datetime.now(ZoneInfo("America/Sao_Paulo"))
+            hour, minute = map(int, clock.split(":"))
+            self.offset = real.replace(hour=hour, minute=minute, second=0, microsecond=0) - real
+
+    def now(self) -> str:
+        return (datetime.now(timezone.utc) + self.offset).isoformat().replace("+00:00", "Z")
+
+    def annotate(self):
+        pseudonym = self.rng.choice(self.pseudonyms)
+        unit = self.waiting.pop(pseudonym, None)
+        if unit is None:
+            unit = self.rng.choice(self.units)
+            self.waiting[pseudonym] = unit
+            body = {"pseudonym": pseudonym, "unit": unit, "event_type": "cinza", "timestamp": self.now()}
+        else:
+            body = {"pseudonym": pseudonym, "unit": unit, "event_type": "rc",
+                    "risk_color": self.rng.choice(COLORS), "timestamp": self.now()}
+        return "POST", "/annotate", {"json": body}
+
+    def estimate(self):
+        body = {"unit": self.rng.choice(self.units), "risk_color": self.rng.choice(COLORS),
+                "query_time": self.now()}
+        return "POST", "/estimate", {"json": body}
+
+    def all_estimates(self):
+        return "GET", "/all_estimates", {"params": {"query_time": self.now()}}
+
+    def units_list(self):
+        return "GET", "/units", {}
+
+    def route_times_get(self):
+        return "GET", f"/route_times/5562{self.rng.randrange(10 ** 7):07d}", {}
+
+    def register_unit(self):
+        body = {"unit": self.rng.choice(self.units), "latitude": -16.68 + self.rng.uniform(-0.1, 0.1),
+                "longitude": -49.25 + self.rng.uniform(-0.1, 0.1)}
+        return "POST", "/register_unit", {"json": body}
+
+    def health(self):
+        return "GET", "/health", {}
+
+
+REQUESTS = {
+    "annotate": Traffic.annotate,
+    "estimate": Traffic.estimate,
+    "all_estimates": Traffic.all_estimates,
+    "units": Traffic.units_list,
+    "route_times_get": Traffic.route_times_get,
+    "register_unit": Traffic.register_unit,
+    "health": Traffic.health,
+}
+
+
+# ---- server
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _create_dynamodb_tables(endpoint_url: str):
+    import boto3
+    resource = boto3.resource("dynamodb", endpoint_url=endpoint_url,
+                              region_name=os.getenv("AWS_REGION", "us-east-1"))
+    existing = {t.name for t in resource.tables.all()}
+    tables = {
+        os.getenv("DYNAMODB_TABLE", "wait_time_events"): [("pseudonym", "HASH"), ("event_id", "RANGE")],
+        "units": [("unit", "HASH")],
+        "user_route_times": [("user_phone", "HASH"), ("unit", "RANGE")],
+    }
+    for name, keys in tables.items():
+        if name in existing:
+            continue
+        resource.create_table(
+            TableName=name,
+            KeySchema=[{"AttributeName": a, "KeyType": k} for a, k in keys],
+            AttributeDefinitions=[{"AttributeName": a, "AttributeType": "S"} for a, _ in keys],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+
+def _tail(path: str, lines: int = 20) -> str:
+    with open(path) as f:
+        return "".join(f.readlines()[-lines:])
+
+
+def start_server(args, workdir: str, extra_env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        PSEUDONYM_SALT="loadtest",
+        CHANGE_LOG_PATH=os.path.join(workdir, "changes.log"),
+        CEP_CACHE_PATH=os.path.join(workdir, "cep.db"),
+        SNAPSHOT_PATH="",
+        PRELOAD_WARM="0",
+    )
+    if args.backend == "sqlite":
+        env.update(DATASTORE_BACKEND="sqlite", SQLITE_PATH=os.path.join(workdir, "chronos.db"))
+    else:
+        env.update(DATASTORE_BACKEND="dynamodb", DYNAMODB_ENDPOINT_URL=args.endpoint_url,
+                   AWS_ACCESS_KEY_ID=env.get("AWS_ACCESS_KEY_ID", "local"),
+                   AWS_SECRET_ACCESS_KEY=env.get("AWS_SECRET_ACCESS_KEY", "local"))
+        _create_dynamodb_tables(args.endpoint_url)
+    env.update(extra_env or {})
+
+    bind = f"127.0.0.1:{args.port}"
+    if args.server == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app",
+               "--bind", bind, "--workers", str(args.workers)]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+               "--port", str(args.port), "--workers", str(args.workers)]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}:\n{_tail(log.name)}")
+        try:
+            if httpx.get(f"http://{bind}/health", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    stop_server(proc)
+    raise RuntimeError(f"server not healthy after {args.startup_timeout}s:\n{_tail(log.name)}")
+
+
+def stop_server(proc: subprocess.Popen):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=15)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+# ---- load
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.dropped = defaultdict(int)
+
+    def add(self, endpoint: str, latency_ms: float, status: str):
+        self.latencies[endpoint].append(latency_ms)
+        self.statuses[endpoint][status] += 1
+
+    def summary(self, duration_s: float) -> Dict[str, Dict]:
+        out = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            lat = np.array(values)
+            statuses = dict(self.statuses[endpoint])
+            errors = sum(n for s, n in statuses.items() if not s.startswith(("2", "3")))
+            p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+            out[endpoint] = {
+                "requests": len(lat), "rps": len(lat) / duration_s,
+                "p50": float(p50), "p95": float(p95), "p99": float(p99), "max": float(lat.max()),
+                "error_rate": errors / len(lat), "dropped": self.dropped[endpoint],
+                "statuses": statuses,
+            }
+        return out
+
+
+async def seed(client: httpx.AsyncClient, units: List[str], events_per_unit: int, rng: random.Random):
+    """Register units and give them completed cinza/rc cycles spread over the past weeks."""
+    sem = asyncio.Semaphore(32)
+
+    async def cycle(i: int, unit: str):
+        start = datetime.now(timezone.utc) - timedelta(days=rng.uniform(0, 28), hours=rng.uniform(0, 12))
+        end = start + timedelta(minutes=rng.lognormvariate(4, 0.5))
+        pseudonym = f"seed-{unit}-{i}"
+        async with sem:
+            await client.post("/annotate", json={"pseudonym": pseudonym, "unit": unit, "event_type": "cinza",
+                                                 "timestamp": start.isoformat()})
+            await client.post("/annotate", json={"pseudonym": pseudonym, "unit": unit, "event_type": "rc",
+                                                 "risk_color": rng.choice(COLORS), "timestamp": end.isoformat()})
+
+    await asyncio.gather(*(client.post("/register_unit", json={"unit": u, "latitude": -16.68, "longitude": -49.25})
+                           for u in units))
+    await asyncio.gather(*(cycle(i, u) for u in units for i in range(events_per_unit)))
+
+
+async def run_load(base_url: str, args, mix: Dict[str, float]) -> Dict[str, Dict]:
+    rng = random.Random(args.seed)
+    units = [f"Load Unit {i:02d}" for i in range(args.units)]
+    traffic = Traffic(units, args.pseudonyms, rng, args.clock)
+    recorder = Recorder()
+    curve = CURVES[args.curve]
+    curve_endpoints = set(args.curve_endpoints.split(",")) if args.curve_endpoints else set(mix)
+    total_weight = sum(mix.values())
+    limits = httpx.Limits(max_connections=args.max_inflight, max_keepalive_connections=args.max_inflight)
+    inflight = asyncio.Semaphore(args.max_inflight)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        if args.seed_events:
+            t0 = time.perf_counter()
+            await seed(client, units, args.seed_events, rng)
+            print(f"seeded {len(units)} units x {args.seed_events} cycles in {time.perf_counter() - t0:.1f}s",
+                  file=sys.stderr)
+
+        async def one(endpoint: str):
+            method, path, kwargs = REQUESTS[endpoint](traffic)
+            t0 = time.perf_counter()
+            try:
+                resp = await client.request(method, path, **kwargs)
+                status = str(resp.status_code)
+            except httpx.TimeoutException:
+                status = "timeout"
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            finally:
+                inflight.release()
+            recorder.add(endpoint, (time.perf_counter() - t0) * 1000, status)
+
+        async def arrivals(endpoint: str, share: float, started: float, tasks: set):
+            while True:
+                t = time.monotonic() - started
+                if t >= args.duration:
+                    return
+                factor = curve(t, args.duration) if endpoint in curve_endpoints else 1.0
+                rate = args.rate * share * factor
+                if rate <= 0:
+                    await asyncio.sleep(0.1)
+                    continue
+                await asyncio.sleep(rng.expovariate(rate))
+                if inflight.locked():
+                    recorder.dropped[endpoint] += 1
+                    continue
+                await inflight.acquire()
+                task = asyncio.create_task(one(endpoint))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        tasks = set()
+        started = time.monotonic()
+        await asyncio.gather(*(arrivals(e, w / total_weight, started, tasks) for e, w in mix.items() if w > 0))
+        if tasks:
+            await asyncio.wait(tasks)
+        duration = time.monotonic() - started
+    return recorder.summary(duration)
+
+
+# ---- report and baseline
+
+def print_report(summary: Dict[str, Dict]):
+    print(f"{'endpoint':<16} {'reqs':>7} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'errors':>7} {'dropped':>8}")
+    for endpoint, m in summary.items():
+        print(f"{endpoint:<16} {m['requests']:>7} {m['rps']:>7.1f} {m['p50']:>8.1f} {m['p95']:>8.1f} "
+              f"{m['p99']:>8.1f} {m['max']:>8.1f} {m['error_rate']:>7.2%} {m['dropped']:>8}")
+        odd = {s: n for s, n in m["statuses"].items() if not s.startswith(("2", "3"))}
+        if odd:
+            print(f"{'':<16} statuses: {odd}")
+
+
+def compare(summary: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> bool:
+    """Print the change per endpoint and metric; False if anything regressed beyond tolerance."""
+    ok = True
+    print(f"\n{'endpoint':<16} {'metric':<10} {'baseline':>10} {'now':>10} {'change':>8}")
+    for endpoint, m in summary.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        for metric in METRICS:
+            old, new = base[metric], m[metric]
+            if metric == "error_rate":
+                regressed = new > old + 0.01
+                change = f"{(new - old) * 100:+.2f}pp"
+            else:
+                rel = (new - old) / old if old else 0.0
+                # throughput regresses downwards, latency upwards
+                regressed = rel < -tolerance if metric == "rps" else rel > tolerance
+                change = f"{rel:+.1%}"
+            flag = "  <-- regression" if regressed else ""
+            ok &= not regressed
+            print(f"{endpoint:<16} {metric:<10} {old:>10.2f} {new:>10.2f} {change:>8}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="test this running server instead of starting one")
+    parser.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=0, help="0 = pick a free port")
+    parser.add_argument("--backend", choices=("sqlite", "dynamodb"), default="sqlite")
+    parser.add_argument("--endpoint-url", default="http://127.0.0.1:8000",
+                        help="DynamoDB Local / moto server for --backend dynamodb")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--mix", default="default",
+                        help=f"one of {', '.join(MIXES)} or endpoint:weight,... ({', '.join(REQUESTS)})")
+    parser.add_argument("--curve", choices=sorted(CURVES), default="steady")
+    parser.add_argument("--curve-endpoints", help="apply the curve only to these endpoints (comma separated)")
+    parser.add_argument("--rate", type=float, default=50, help="mean requests/s across the mix at 1x")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of load")
+    parser.add_argument("--max-inflight", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=30, help="per request (s)")
+    parser.add_argument("--clock", metavar="HH:MM",
+                        help="Sao Paulo time the simulated clock starts at (default: real time); "
+                             "outside the slots estimates are 'off-hours'")
+    parser.add_argument("--units", type=int, default=20)
+    parser.add_argument("--pseudonyms", type=int, default=2000)
+    parser.add_argument("--seed-events", type=int, default=30, help="historical cycles per unit, 0 to skip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH", help="baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    proc = None
+    with tempfile.TemporaryDirectory(prefix="chronos-load-") as workdir:
+        try:
+            if args.url:
+                base_url = args.url.rstrip("/")
+            else:
+                args.port = args.port or _free_port()
+                proc = start_server(args, workdir)
+                base_url = f"http://127.0.0.1:{args.port}"
+            summary = asyncio.run(run_load(base_url, args, mix))
+        finally:
+            if proc is not None:
+                stop_server(proc)
+
+    print_report(summary)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare")},
+                       "endpoints": summary}, f, indent=2)
+        print(f"\nbaseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        shape = ("server", "workers", "backend", "mix", "curve", "curve_endpoints", "rate", "duration", "units")
+        differs = [k for k in shape if baseline["args"].get(k) != getattr(args, k)]
+        if differs:
+            print(f"\nwarning: baseline was recorded with different {', '.join(differs)}")
+        if not compare(summary, baseline["endpoints"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,35 @@
-from fastapi import FastAPI, Query, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Query, Depends, HTTPException, status, Request, Response
 from schema import (
-    AnnotateEventRequest, EstimateRequest, EstimateResponse, HealthCheckResponse, 
+    AnnotateEventRequest, EstimateRequest, EstimateResponse, HealthCheckResponse, CacheStatsResponse,
     AllEstimatesResponse, UnitEstimates, RegisterUnitRequest, RegisterUnitResponse,
-    RouteTimeRequest, RouteTimeResponse, RouteTimeResult
+    RouteTimeRequest, RouteTimeResponse, RouteTimeResult, CepBatchRequest, CepBatchResponse
 )
-from data_store import DataStore
+from data_store import create_datastore
 from models import WaitTimeEstimator
+from cep_service import CepService, normalize_cep
+from response_cache import ResponseCache, bucket_time, json_response
+from sharding import ShardRouter, CrossUnitHistograms, FORWARDED_HEADER, encode_histograms
+import profiler
+from tracing import phase
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime, timezone
-from utils import get_route_time
-import requests
-import httpx
-from config import CEP_ABERTO_TOKEN
+import os
+import time
+from utils import get_route_time, parse_hhmm
+from config import PRELOAD_WARM, SNAPSHOT_PATH, TIME_SLOTS, RC_TIME_SLOTS, ESTIMATE_BUDGET_MS
 
 app = FastAPI()
-datastore = DataStore()
-estimator = WaitTimeEstimator(datastore)
+datastore = create_datastore()
+# None unless SHARD_NODES is set (see sharding.py)
+router = ShardRouter.from_config()
+cross_unit = None
+if router is not None:
+    datastore.unit_filter = router.owns
+    datastore.shard_layout = router.layout()
+    cross_unit = CrossUnitHistograms(datastore, router)
+estimator = WaitTimeEstimator(datastore, cross_unit=cross_unit)
+cep_service = CepService()
+response_cache = ResponseCache()
 
 from fastapi.middleware.cors import CORSMiddleware
 import logging
@@ -31,20 +46,67 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# per-phase timings of slow requests, admin-toggled sampling profiler
+profiler.install(app)
+
+def preload():
+    """
+    Build read-only state once in the gunicorn master (see gunicorn.conf.py)
+    so forked workers share it copy-on-write instead of rebuilding it.
+    """
+    for start, end in TIME_SLOTS:
+        parse_hhmm(start), parse_hhmm(end)
+    for start, end, _ in RC_TIME_SLOTS:
+        parse_hhmm(start), parse_hhmm(end)
+    if PRELOAD_WARM or SNAPSHOT_PATH:
+        datastore.list_units()
+        datastore.warm()
+        # persist what the master just caught up on for the next restart
+        datastore.save_snapshot()
+    # boto3 connections must not cross the fork
+    datastore.reset_connections()
+
+@app.on_event("startup")
+def load_snapshot():
+    # Already done in the gunicorn master when preloading
+    if SNAPSHOT_PATH and datastore.events is None:
+        datastore.load_snapshot()
+
+@app.on_event("shutdown")
+def save_snapshot():
+    datastore.save_snapshot()
+
+@app.on_event("shutdown")
+async def close_cep_client():
+    await cep_service.aclose()
 
 @app.get("/health", response_model=HealthCheckResponse)
 def health():
     return HealthCheckResponse(status="ok")
 
+@app.get("/cache_stats", response_model=CacheStatsResponse)
+def cache_stats():
+    return CacheStatsResponse(pid=os.getpid(), response_cache=response_cache.stats(), **datastore.cache_stats())
+
 @app.post("/register_unit", response_model=RegisterUnitResponse)
-def register_unit(req: RegisterUnitRequest):
-    # For simplicity, skip geocoding if no lat/lng given
-    item = datastore.register_unit(
+async def register_unit(req: RegisterUnitRequest):
+    latitude, longitude = req.latitude, req.longitude
+    if (latitude is None or longitude is None) and req.postal_code:
+        # Geocode from the CEP; the unit is registered without a location if that fails
+        try:
+            coords = await cep_service.geocode(req.postal_code)
+        except Exception as e:
+            logger.warning("geocoding %s failed: %s", req.postal_code, e)
+            coords = None
+        if coords:
+            latitude, longitude = coords
+    item = await run_in_threadpool(
+        datastore.register_unit,
         unit=req.unit,
         address=req.address,
         postal_code=req.postal_code,
-        latitude=Decimal(str(req.latitude)),
-        longitude=Decimal(str(req.longitude))
+        latitude=Decimal(str(latitude)) if latitude is not None else None,
+        longitude=Decimal(str(longitude)) if longitude is not None else None
     )
     return RegisterUnitResponse(
         success=True,
@@ -66,27 +128,59 @@ def annotate_event(event: AnnotateEventRequest):
     return {"message": "Event processed.", "delta_t": dt}
 
 @app.post("/estimate", response_model=EstimateResponse)
-def estimate_wait_time(req: EstimateRequest):
-    est = estimator.estimate_wait_time(
-        unit=req.unit,
-        risk_color=req.risk_color,
-        query_time=req.query_time
-    )
-    return EstimateResponse(
-        estimated_wait=est
-    )
+def estimate_wait_time(req: EstimateRequest, request: Request):
+    if router is not None and FORWARDED_HEADER not in request.headers and not router.owns(req.unit):
+        return forward_estimate(req, request)
+    budget_ms = req.budget_ms if req.budget_ms is not None else ESTIMATE_BUDGET_MS
+    query_time = bucket_time(req.query_time)
+    datastore.sync_changes()
 
-@app.get("/all_estimates", response_model=AllEstimatesResponse)
-def all_estimates(query_time: datetime = Query(...)):
-    units = datastore.list_units()
+    def build():
+        est, info = estimator.estimate_wait_time_detailed(
+            unit=req.unit,
+            color=req.risk_color,
+            query_time=query_time,
+            deadline=time.monotonic() + budget_ms / 1000.0
+        )
+        degraded = bool(info["skipped"] or info["stale"])
+        return EstimateResponse(
+            estimated_wait=est,
+            concepts_used=info["concepts_used"],
+            skipped_concepts=info["skipped"],
+            stale_concepts=info["stale"],
+            degraded=degraded
+        ), not degraded
+
+    key = ("estimate", req.unit, req.risk_color, query_time.isoformat(), datastore.generation)
+    return json_response(request, *response_cache.get_or_build(key, build))
+
+def forward_estimate(req: EstimateRequest, request: Request) -> Response:
+    """Answer /estimate from the node owning the unit, conditional headers included."""
+    node = router.owner(req.unit)
+    headers = {"If-None-Match": request.headers["if-none-match"]} if "if-none-match" in request.headers else {}
+    try:
+        with phase("shard:forward"):
+            upstream = router.request(node, "POST", "/estimate", json=req.model_dump(mode="json"), headers=headers)
+    except Exception as e:
+        logger.warning("forwarding /estimate for %s to %s failed: %s", req.unit, node, e)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="unit owner unreachable")
+    passthrough = {k: upstream.headers[k] for k in ("content-type", "etag", "cache-control") if k in upstream.headers}
+    return Response(content=upstream.content, status_code=upstream.status_code, headers=passthrough)
+
+def unit_estimates(units, query_time: datetime):
+    """(UnitEstimates per unit, degraded) within one ESTIMATE_BUDGET_MS budget."""
+    # one budget for the whole listing; slow units fall back to cached/default data
+    deadline = time.monotonic() + ESTIMATE_BUDGET_MS / 1000.0
     estimates = []
+    degraded = False
     for unit in units:
         # ola
         # logger.info(f"\nunit {unit}, blue")
         # blue_est = estimator.estimate_wait_time(unit, 'b', query_time)
         blue_est = 0
         # logger.info(f"\nunit {unit}, green")
-        green_est = estimator.estimate_wait_time(unit, 'g', query_time)
+        green_est, info = estimator.estimate_wait_time_detailed(unit, 'g', query_time, deadline)
+        degraded = degraded or bool(info["skipped"] or info["stale"])
         # logger.info(f"\nunit {unit}, yellow")
         # yellow_est = estimator.estimate_wait_time(unit, 'y', query_time)
         yellow_est = 0
@@ -106,8 +200,57 @@ def all_estimates(query_time: datetime = Query(...)):
                 red=red_est
             )
         )
-    estimates.sort(key=lambda x: x.green)
-    return AllEstimatesResponse(estimates=estimates, query_time=query_time)
+    return estimates, degraded
+
+@app.get("/all_estimates", response_model=AllEstimatesResponse)
+def all_estimates(request: Request, query_time: datetime = Query(...), local: bool = Query(False)):
+    # Responses only change with the bucket and with new data, so polling
+    # clients are served from the response cache (or get a 304)
+    query_time = bucket_time(query_time)
+    datastore.sync_changes()
+    # on a sharded node, local=true lists only the units this node owns
+    # (that's how the other nodes gather it)
+    local = router is not None and (local or FORWARDED_HEADER in request.headers)
+
+    def build():
+        units = datastore.list_units()
+        if router is None:
+            estimates, degraded = unit_estimates(units, query_time)
+            unavailable = []
+        elif local:
+            estimates, degraded = unit_estimates([u for u in units if router.owns(u)], query_time)
+            unavailable = []
+        else:
+            estimates, degraded, unavailable = gather_estimates(units, query_time)
+        estimates.sort(key=lambda x: x.green)
+        response = AllEstimatesResponse(estimates=estimates, query_time=query_time, unavailable_units=unavailable)
+        return response, not (degraded or unavailable)
+
+    key = ("all_estimates", query_time.isoformat(), local, datastore.generation)
+    return json_response(request, *response_cache.get_or_build(key, build))
+
+def gather_estimates(units, query_time: datetime):
+    """This node's units computed here, every other node's fetched from it in parallel."""
+    pending = router.gather_async("/all_estimates", {"query_time": query_time.isoformat(), "local": "true"})
+    estimates, degraded = unit_estimates([u for u in units if router.owns(u)], query_time)
+    reached = set()
+    for node, future in pending.items():
+        with phase("shard:gather"):
+            payload = future.result()
+        if payload is None:
+            continue
+        reached.add(node)
+        estimates.extend(UnitEstimates(**e) for e in payload["estimates"])
+        degraded = degraded or bool(payload.get("unavailable_units"))
+    unavailable = sorted(u for u in units if router.owner(u) not in reached and not router.owns(u))
+    return estimates, degraded, unavailable
+
+@app.get("/shard/histograms")
+def shard_histograms():
+    """This node's Concept 4 histograms, merged by the other nodes (see sharding.py)."""
+    if cross_unit is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="sharding is off")
+    return dict(encode_histograms(cross_unit.local_histograms()), node=router.self_node)
 
 @app.post("/route_times")
 def route_times(req: RouteTimeRequest):
@@ -118,12 +261,13 @@ def route_times(req: RouteTimeRequest):
         lat, lng = unit_info.get("lat"), unit_info.get("lng")
         if lat is None or lng is None:
             continue
-        travel_time = get_route_time(
-            req.latitude,
-            req.longitude,
-            lat,
-            lng
-        )
+        with phase("waze"):
+            travel_time = get_route_time(
+                req.latitude,
+                req.longitude,
+                lat,
+                lng
+            )
         print(f"travel_time: {travel_time}")
         results.append(
             {
@@ -159,8 +303,24 @@ def list_units():
     return {"units": [{"unit": i["unit"]} for i in items if "unit" in i]}
 
 @app.get("/cep_lookup")
-def cep_lookup(cep: str):
-    url = f"https://www.cepaberto.com/api/v3/cep?cep={cep}"
-    headers = {"Authorization": f"Token token={CEP_ABERTO_TOKEN}"}
-    resp = requests.get(url, headers=headers)
-    return resp.json()
\ No newline at end of file
+async def cep_lookup(cep: str):
+    try:
+        payload = await cep_service.lookup(cep)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        logger.warning("CEP lookup failed for %s: %s", cep, e)
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="CEP lookup failed")
+    # CEP Aberto answers unknown CEPs with an empty object
+    return payload or {}
+
+@app.post("/cep_lookup/batch", response_model=CepBatchResponse)
+async def cep_lookup_batch(req: CepBatchRequest):
+    valid, invalid = [], []
+    for cep in req.ceps:
+        try:
+            valid.append(normalize_cep(cep))
+        except ValueError:
+            invalid.append(cep)
+    results = await cep_service.lookup_many(valid)
+    return CepBatchResponse(results=results, invalid=invalid)
\ No newline at end of file
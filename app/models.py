@@ -1,8 +1,12 @@
 # models.py
 
-from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+import contextvars
+import threading
+from datetime import datetime, timezone
 import numpy as np
-from typing import Union
+import time
+from typing import Dict, Optional, Tuple, Union
 import json
 from config import (
     TIME_SLOTS,
@@ -14,83 +18,200 @@ from config import (
     CONCEPT3_MIN_SAMPLES,
     TEMPORAL_DECAY_RATE,
     IQR_OUTLIER_FACTOR,
-    RC_TIME_SLOTS
+    RC_TIME_SLOTS,
+    ESTIMATE_FETCH_WORKERS,
+    SLOT_ESTIMATE_CACHE_TTL_S,
+    SLOT_ESTIMATE_CACHE_MAXSIZE
 )
 from utils import (
-    assign_time_slot,
-    apply_iqr_filter,
-    get_adjacent_slots,
-    slot_boundaries,
-    compute_temporal_weights, 
+    build_minute_plan,
+    compute_temporal_weights_ordinal,
     weighted_median,
-    assign_rc_wait,
-    get_secret
 )
-from data_store import DataStore
+from data_store import DataStore, create_datastore
+from samples import empty_samples
+from cachetools import TTLCache
+from tracing import phase
 import logging
 from zoneinfo import ZoneInfo
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SAO_PAULO = ZoneInfo("America/Sao_Paulo")
+# Slot, blend partners and rc room wait for every local minute of the day;
+# the slot tables are static, so this is built once at import
+MINUTE_PLAN = build_minute_plan(TIME_SLOTS, RC_TIME_SLOTS)
+
+# Runs concept fetches for requests with a deadline, so a slow scan can be
+# abandoned without blocking the request thread
+_fetch_pool = ThreadPoolExecutor(max_workers=ESTIMATE_FETCH_WORKERS, thread_name_prefix="concept-fetch")
+_inflight: Dict[tuple, Future] = {}
+_inflight_lock = threading.Lock()
+
+def _submit_fetch(fetch, args: tuple) -> Future:
+    # the bound method, not its name: two DataStores (or estimators) never share a fetch
+    key = (fetch, args)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is None:
+            future = _fetch_pool.submit(contextvars.copy_context().run, fetch, *args)
+            _inflight[key] = future
+            future.add_done_callback(lambda _: _inflight.pop(key, None))
+    return future
+
 class WaitTimeEstimator:
-    def __init__(self, datastore: DataStore):
+    """
+    Wait time estimates from a DataStore. The tuning knobs default to the
+    values in config.py and can be overridden per instance (backtest.py uses
+    this to compare settings); include_rc_room=False leaves out the rc room
+    wait so the result is comparable with a stored delta_t.
+
+    `cross_unit` answers Concept 4 instead of the DataStore; it needs an
+    iqr_median_color_slot_all_units method like the DataStore's (sharded
+    nodes pass a sharding.CrossUnitHistograms).
+    """
+
+    def __init__(self, datastore: DataStore,
+                 decay_rate: float = TEMPORAL_DECAY_RATE,
+                 iqr_factor: float = IQR_OUTLIER_FACTOR,
+                 smoothing_window_min: float = SLOT_BOUNDARY_SMOOTHING_WINDOW_MIN,
+                 concept1_min_samples: int = CONCEPT1_MIN_SAMPLES,
+                 concept3_min_samples: int = CONCEPT3_MIN_SAMPLES,
+                 include_rc_room: bool = True,
+                 cross_unit=None):
         self.ds = datastore
+        self.cross_unit = cross_unit if cross_unit is not None else datastore
+        self.decay_rate = decay_rate
+        self.iqr_factor = iqr_factor
+        self.smoothing_window_min = smoothing_window_min
+        self.concept1_min_samples = concept1_min_samples
+        self.concept3_min_samples = concept3_min_samples
+        self.include_rc_room = include_rc_room
+        # (unit, color, slot, day, data generation) -> (estimate, concepts used)
+        self._slot_cache = TTLCache(maxsize=SLOT_ESTIMATE_CACHE_MAXSIZE, ttl=SLOT_ESTIMATE_CACHE_TTL_S)
+        self._slot_cache_lock = threading.Lock()
 
-    def estimate_wait_time(self, unit: str, color: str, query_time: datetime) -> Union[float, str]:
-        # 1) Figure out which slot we’re in
-        slot, query_time_sp = assign_time_slot(query_time, TIME_SLOTS)
+    def estimate_wait_time(self, unit: str, color: str, query_time: datetime,
+                           deadline: Optional[float] = None) -> Union[float, str]:
+        return self.estimate_wait_time_detailed(unit, color, query_time, deadline)[0]
+
+    def estimate_wait_time_detailed(self, unit: str, color: str, query_time: datetime,
+                                    deadline: Optional[float] = None) -> Tuple[Union[float, str], Dict]:
+        """
+        Like estimate_wait_time, but also returns which concepts fed the
+        estimate: {"concepts_used": [...], "skipped": [...], "stale": [...]}.
+
+        `deadline` is a time.monotonic() instant. Concept fetches that cannot
+        finish before it fall back to the DataStore's last batch ("stale") or
+        are skipped, so the call returns in roughly the budget even when the
+        backend is slow.
+        """
+        info = {"concepts_used": set(), "skipped": set(), "stale": set()}
+        est = self._estimate(unit, color, query_time, deadline, info)
+        return est, {k: sorted(v) for k, v in info.items()}
 
-        # 2) Fetch that slot’s start/end as datetimes
-        try:
-            slot_start_t, slot_end_t = slot_boundaries(TIME_SLOTS, slot)
-        except ValueError:
+    def _estimate(self, unit: str, color: str, query_time: datetime,
+                  deadline: Optional[float], info: Dict) -> Union[float, str]:
+        # 1) Local time, and the precomputed plan for that minute of the day
+        if query_time.tzinfo is None:
+            # assume naive == UTC
+            query_time = query_time.replace(tzinfo=timezone.utc)
+        query_time_sp = query_time.astimezone(SAO_PAULO)
+        minute = query_time_sp.hour * 60 + query_time_sp.minute
+        plan = MINUTE_PLAN[minute]
+        if plan is None:
             return "off-hours"
+        rc_wait = plan.rc_wait if self.include_rc_room else 0
+
+        # 2) How close are we to the start or end boundary?
+        t = minute + (query_time_sp.second + query_time_sp.microsecond / 1e6) / 60.0
+        delta_to_start = t - plan.start_min
+        delta_to_end = plan.end_min - t
+
+        est_here = self._slot_estimate(unit, color, query_time_sp, plan.slot, deadline, info) + rc_wait
+
+        # 3) If we’re within the smoothing window at the **start** of the slot, blend
+        if 0 <= delta_to_start < self.smoothing_window_min and plan.prev_slot:
+            est_prev = self._slot_estimate(unit, color, query_time_sp, plan.prev_slot, deadline, info) + rc_wait
+            w = delta_to_start / self.smoothing_window_min
+            blended = (1 - w) * est_here + w * est_prev
+            return self._clip(blended)
+
+        # 4) Likewise at the **end** boundary
+        if 0 <= delta_to_end < self.smoothing_window_min and plan.next_slot:
+            est_next = self._slot_estimate(unit, color, query_time_sp, plan.next_slot, deadline, info) + rc_wait
+            w = delta_to_end / self.smoothing_window_min
+            blended = (1 - w) * est_here + w * est_next
+            return self._clip(blended)
+
+        # 5) Otherwise, just use the slot‐based estimate
+        return est_here
+
+    def _slot_estimate(self, unit: str, color: str, query_time_sp: datetime, slot: str,
+                       deadline: Optional[float], info: Dict) -> float:
+        """
+        Clipped Concept 1-4 estimate for (unit, color, slot) on the query's day,
+        memoized until the DataStore sees new data (or SLOT_ESTIMATE_CACHE_TTL_S),
+        so neighbouring slots and later queries of the day reuse it.
+        """
+        generation = getattr(self.ds, "generation", None)
+        if generation is not None:
+            # memo hits skip the fetchers, so pick up other workers' changes here
+            self.ds.sync_changes()
+            generation = self.ds.generation
+        if generation is None:
+            # no change tracking (e.g. backtest.ReplayStore): can't tell when to drop it
+            return self._compute_slot_estimate(unit, color, query_time_sp, slot, deadline, info)
+        key = (unit, color, slot, query_time_sp.date(), generation)
+        with self._slot_cache_lock:
+            hit = self._slot_cache.get(key)
+        if hit is not None:
+            est, concepts = hit
+            info["concepts_used"].update(concepts)
+            return est
+        slot_info = {"concepts_used": set(), "skipped": set(), "stale": set()}
+        est = self._compute_slot_estimate(unit, color, query_time_sp, slot, deadline, slot_info)
+        info["concepts_used"].update(slot_info["concepts_used"])
+        info["skipped"].update(slot_info["skipped"])
+        info["stale"].update(slot_info["stale"])
+        if not slot_info["skipped"] and not slot_info["stale"]:
+            # degraded results are not reused
+            with self._slot_cache_lock:
+                self._slot_cache[key] = (est, frozenset(slot_info["concepts_used"]))
+        return est
+
+    def _fetch(self, concept: str, fetch, *args, deadline: Optional[float], info: Dict, default):
+        """Run a DataStore fetch within the deadline; `default` if it can't make it."""
+        with phase(f"fetch:{concept}"):
+            if deadline is None:
+                return fetch(*args)
+            batch = fetch(*args, mode="cached")
+            if batch is not None:
+                return batch
+            # the fetch keeps running past the deadline and fills the cache for
+            # later requests; concurrent requests share one in-flight fetch per key
+            future = _submit_fetch(fetch, args)
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                try:
+                    return future.result(timeout=remaining)
+                except FuturesTimeout:
+                    pass
+            batch = fetch(*args, mode="stale")
+            if batch is not None:
+                info["stale"].add(concept)
+                return batch
+            info["skipped"].add(concept)
+            return default
 
-        slot_start_dt = query_time_sp.replace(
-            hour=slot_start_t.hour, minute=slot_start_t.minute,
-            second=0, microsecond=0
-        )
-
-        slot_end_dt = query_time_sp.replace(
-            hour=slot_end_t.hour, minute=slot_end_t.minute,
-            second=0, microsecond=0
-        )
-
-        # handle overnight
-        if slot_end_t < slot_start_t:
-            slot_end_dt += timedelta(days=1)
-
-        # 3) How close are we to the start or end boundary?
-        delta_to_start = (query_time_sp - slot_start_dt).total_seconds() / 60.0
-        delta_to_end   = (slot_end_dt - query_time_sp).total_seconds()  / 60.0
-
-        # 4) If we’re within the smoothing window at the **start** of the slot, blend
-        if 0 <= delta_to_start < SLOT_BOUNDARY_SMOOTHING_WINDOW_MIN:
-            prev_slot, _ = get_adjacent_slots(TIME_SLOTS, slot)
-            if prev_slot:
-                est_here = self._estimate_for_slot(unit, color, query_time_sp, slot)
-                est_prev = self._estimate_for_slot(unit, color, query_time_sp, prev_slot)
-                w = delta_to_start / SLOT_BOUNDARY_SMOOTHING_WINDOW_MIN
-                blended = (1 - w) * est_here + w * est_prev
-                return self._clip(blended)
-
-        # 5) Likewise at the **end** boundary
-        if 0 <= delta_to_end < SLOT_BOUNDARY_SMOOTHING_WINDOW_MIN:
-            _, next_slot = get_adjacent_slots(TIME_SLOTS, slot)
-            if next_slot:
-                est_here = self._estimate_for_slot(unit, color, query_time_sp, slot)
-                est_next = self._estimate_for_slot(unit, color, query_time_sp, next_slot)
-                w = delta_to_end / SLOT_BOUNDARY_SMOOTHING_WINDOW_MIN
-                blended = (1 - w) * est_here + w * est_next
-                return self._clip(blended)
-
-        # 6) Otherwise, just use the slot‐based estimate
-        return self._estimate_for_slot(unit, color, query_time_sp, slot)
-
-    def _estimate_for_slot(self, unit: str, color: str, query_time_sp: datetime, slot: str) -> float:
+    def _compute_slot_estimate(self, unit: str, color: str, query_time_sp: datetime, slot: str,
+                               deadline: Optional[float] = None, info: Optional[Dict] = None) -> float:
         """
-        Core Concept 1-4 logic for a specific (unit, color, slot).
+        Core Concept 1-4 logic for a specific (unit, color, slot), clipped,
+        without the rc room wait.
         """
+        if info is None:
+            info = {"concepts_used": set(), "skipped": set(), "stale": set()}
         day_str = query_time_sp.date().isoformat()
         # logger.info(f"day_str: {day_str}")
         weekday = query_time_sp.weekday()
@@ -102,82 +223,77 @@ class WaitTimeEstimator:
         # logger.info(f"debug color: {color}")
         # logger.info(f"debug slot: {slot}")
         # logger.info(f"debug day_str: {day_str}")
-        df1 = self.ds.fetch_samples_unit_day_slot_color_df(unit, color, slot, day_str)
-        # logger.info("df1 as json: %s", df1.to_json(orient="records"))
-        # df1 has columns ["delta_t","day"]; all days == ref_date
-        s1 = apply_iqr_filter(df1["delta_t"].to_numpy(), IQR_OUTLIER_FACTOR)
-        n1 = len(s1)
-        m1 = float(np.median(s1)) if n1 else None
+        n1, m1 = self._fetch("same_day", self.ds.iqr_median_unit_day_slot_color,
+                             unit, color, slot, day_str, self.iqr_factor,
+                             deadline=deadline, info=info, default=(0, None))
 
         # Concept 3: all days, same slot
-        df3 = self.ds.fetch_samples_unit_slot_color_all_days_df(unit, color, slot)
-        # logger.info("df3 as json: %s", df3.to_json(orient="records"))
-        # raw3 = apply_iqr_filter(df3["delta_t"].to_numpy(), IQR_OUTLIER_FACTOR)
+        s3 = self._fetch("all_days", self.ds.fetch_samples_unit_slot_color_all_days,
+                         unit, color, slot, deadline=deadline, info=info, default=empty_samples())
         # temporal weights by day
-        weights3 = compute_temporal_weights(
-            [d for d in df3["day"]], ref_date, TEMPORAL_DECAY_RATE
-        )
-        # logger.info(f"weights3: {weights3}")
-        # align weights to raw3 after filter (simplest: assume df3 already IQR-filtered)
-        raw3 = df3["delta_t"].to_numpy()
+        weights3 = compute_temporal_weights_ordinal(s3["day"], ref_date, self.decay_rate)
+        # align weights to raw3 after filter (simplest: assume s3 already IQR-filtered)
+        raw3 = s3["delta_t"]
         n3 = len(raw3)
-        m3 = float(weighted_median(raw3, weights3)) if n3 else None
+        with phase("weighted_median"):
+            m3 = float(weighted_median(raw3, weights3)) if n3 else None
 
         # Concept 2: same weekday, same slot
-        df2 = self.ds.fetch_samples_unit_color_slot_weekday_df(unit, color, slot, weekday)
-        # logger.info("df2 as json: %s", df2.to_json(orient="records"))
-        # raw2 = apply_iqr_filter(df2["delta_t"].to_numpy(), IQR_OUTLIER_FACTOR)
-        raw2 = df2["delta_t"].to_numpy()
-        weights2 = compute_temporal_weights(
-            [d for d in df2["day"]], ref_date, TEMPORAL_DECAY_RATE
-        )
-        # logger.info(f"weights2: {weights2}")
+        s2 = self._fetch("same_weekday", self.ds.fetch_samples_unit_color_slot_weekday,
+                         unit, color, slot, weekday, deadline=deadline, info=info, default=empty_samples())
+        raw2 = s2["delta_t"]
+        weights2 = compute_temporal_weights_ordinal(s2["day"], ref_date, self.decay_rate)
         n2 = len(raw2)
-        m2 = float(weighted_median(raw2, weights2)) if n2 else None
+        with phase("weighted_median"):
+            m2 = float(weighted_median(raw2, weights2)) if n2 else None
 
         # Concept 4: cross‐unit, same slot
-        df4 = self.ds.fetch_samples_color_slot_all_units_df(color, slot)
-        # logger.info("df4 as json: %s", df4.to_json(orient="records"))
-        s4 = apply_iqr_filter(df4["delta_t"].to_numpy(), IQR_OUTLIER_FACTOR)
-        n4 = len(s4)
-        m4 = float(np.median(s4)) if n4 else DEFAULT_WAIT_BY_SLOT_COLOR[slot][color]
+        n4, m4 = self._fetch("cross_unit", self.cross_unit.iqr_median_color_slot_all_units,
+                             color, slot, self.iqr_factor,
+                             deadline=deadline, info=info, default=(0, None))
+        if not n4:
+            m4 = DEFAULT_WAIT_BY_SLOT_COLOR[slot][color]
 
         # ——————————————————————————————
         # 1) Base: Prefers C1, else C3, else C4
         fallback_to_c3 = False
-        if n1 >= CONCEPT1_MIN_SAMPLES:
+        if n1 >= self.concept1_min_samples:
             # logger.info("using: same day & same slot")
             est, total_n = m1, n1
-            fallback_to_c3 = (n1 == CONCEPT1_MIN_SAMPLES)
+            info["concepts_used"].add("same_day")
+            fallback_to_c3 = (n1 == self.concept1_min_samples)
         elif n3 > 0:
             # logger.info("using: all days, same slot")
             est, total_n = m3, n3
+            info["concepts_used"].add("all_days")
             fallback_to_c3 = True
         else:
             # logger.info("using: cross-unit, same slot")
             est, total_n = m4, n4
+            info["concepts_used"].add("cross_unit" if n4 else "default")
             fallback_to_c3 = False
 
         # 2) Tilt toward C2 if available
         if m2 is not None:
             # logger.info("using: same weekday, same slot")
+            info["concepts_used"].add("same_weekday")
             w2 = n2 / (total_n + n2)
             est = (1 - w2) * est + w2 * m2
             total_n += n2
 
         # 3) Dynamic C3 threshold based on how long we've been collecting
-        threshold3 = max(CONCEPT3_MIN_SAMPLES, n2)
+        threshold3 = max(self.concept3_min_samples, n2)
 
         # 4) If we fell back to C3 but have too few C3 samples, tilt toward C4
         if fallback_to_c3 and n3 < threshold3:
+            if n4:
+                info["concepts_used"].add("cross_unit")
             w4 = n4 / (total_n + n4)
             est = (1 - w4) * est + w4 * m4
             total_n += n4
 
         # 5) Clip to plausible range
-        plausible_delta = self._clip(est)
-        rc_room_wait_slot = assign_rc_wait(query_time_sp, RC_TIME_SLOTS)
-        return plausible_delta + rc_room_wait_slot
+        return self._clip(est)
 
     def _clip(self, value: float) -> float:
         """Ensure we never predict outside [MIN_WAIT, MAX_WAIT]."""
@@ -185,7 +301,7 @@ class WaitTimeEstimator:
 
 
 if __name__ == "__main__":
-    datastore = DataStore()
+    datastore = create_datastore()
     w = WaitTimeEstimator(datastore)
     dt_object = datetime.strptime("2025-06-04T12:05:15.140Z", "%Y-%m-%dT%H:%M:%S.%fZ")
     v = w.estimate_wait_time("UPA Urias Magalhães", "g", dt_object)
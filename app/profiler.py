@@ -0,0 +1,400 @@
+"""
+Sampling profiler and slow-request capture, switched on at runtime through
+the admin endpoints (the X-Admin-Token header must match ADMIN_TOKEN).
+
+    H="X-Admin-Token: $ADMIN_TOKEN"
+    curl -XPOST -H "$H" "$API/admin/profiler/start?seconds=120&fraction=0.25"
+    curl -H "$H" "$API/admin/profiler/stacks?endpoint=GET%20/all_estimates" > stacks.txt
+    flamegraph.pl stacks.txt > all_estimates.svg        # or drop it on speedscope.app
+    curl -H "$H" "$API/admin/profiler/slow?limit=50"
+
+Profiler: while a session runs, a daemon thread in each worker reads
+sys._current_frames() every interval_ms and counts the stack of every thread
+that is serving a request, rooted at its endpoint ("GET /all_estimates;
+main.py:all_estimates;...;utils.py:weighted_median 37"), which is the
+collapsed format flame graph tools read. Busy pool threads (concept fetches,
+shard calls) are counted under "(concept-fetch)" etc. With fraction < 1 only
+that share of requests is sampled; a request is picked by the identity of
+its endpoint frame, so requests themselves pay nothing.
+
+Slow requests: each request carries a tracing.RequestTrace, and code wraps
+the steps worth timing in `with tracing.phase("name"):` (concept fetches,
+weighted_median, Waze, shard calls). Requests slower than SLOW_REQUEST_MS
+are logged with those phase totals, whether or not a profiling session is
+running. The log is written by a background thread, never by the request.
+
+Everything is per worker process. A session is a control file under
+PROFILER_DIR that every worker checks at most once a second; each worker
+writes its stacks and slow requests next to it, and the download endpoints
+merge the files of all the workers of the host.
+"""
+import glob
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+from config import (
+    ADMIN_TOKEN, PROFILER_DIR, PROFILER_INTERVAL_MS, PROFILER_MAX_SECONDS,
+    SLOW_REQUEST_MS, SLOW_REQUEST_LOG_MAX_BYTES
+)
+from tracing import RequestTrace, bind, unbind
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTROL_FILE = "control.json"
+CONTROL_POLL_S = 1.0
+# how often a running sampler writes its counts for the download endpoints
+FLUSH_S = 5.0
+# slow requests waiting for the writer thread; more are dropped (and counted)
+SLOW_QUEUE_MAX = 1000
+
+
+def _picked(frame, fraction: float) -> bool:
+    # the endpoint frame lives as long as the request, so every sample of a
+    # request gets the same answer; frame addresses are 16-byte aligned
+    return ((id(frame) >> 4) * 2654435761) % 4294967296 < fraction * 4294967296
+
+
+def _write_json(path: str, data: Dict):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class Profiler:
+    """This worker's sampler and slow-request log, driven by the shared control file."""
+
+    def __init__(self, directory: str = PROFILER_DIR):
+        self.directory = directory
+        self.app = None
+        self.session: Optional[Dict] = None
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self._endpoints: Dict = {}  # endpoint code object -> "GET /path"
+        self._frames: Dict = {}  # code object -> (collapsed label, is app code)
+        self._control_mtime = None
+        self._checked_at = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # created on first use, so no thread or queue crosses a gunicorn fork
+        self._slow_queue: Optional[queue.Queue] = None
+        self._slow_writer: Optional[threading.Thread] = None
+        self.slow_dropped = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    # ---- sessions
+
+    def read_control(self) -> Optional[Dict]:
+        return _read_json(self._path(CONTROL_FILE))
+
+    def start(self, seconds: float, fraction: float, interval_ms: int) -> Dict:
+        os.makedirs(self.directory, exist_ok=True)
+        for path in glob.glob(self._path("stacks-*.json")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        now = time.time()
+        control = {"session": uuid.uuid4().hex[:12], "started": now, "until": now + seconds,
+                   "fraction": fraction, "interval_ms": interval_ms}
+        _write_json(self._path(CONTROL_FILE), control)
+        self.poll_control(force=True)
+        return control
+
+    def stop(self) -> Optional[Dict]:
+        control = self.read_control()
+        if control is not None and control["until"] > time.time():
+            control["until"] = time.time()
+            _write_json(self._path(CONTROL_FILE), control)
+            self.poll_control(force=True)
+        return control
+
+    def poll_control(self, force: bool = False):
+        """Follow the control file: one stat() per CONTROL_POLL_S at most."""
+        now = time.monotonic()
+        if not force and now - self._checked_at < CONTROL_POLL_S:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self._path(CONTROL_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._control_mtime:
+            return
+        control = self.read_control()
+        if control is None:
+            return  # mid-write; try again next time
+        with self._lock:
+            self._control_mtime = mtime
+            if self.session is None or control["session"] != self.session["session"]:
+                self.counts, self.samples = Counter(), 0
+            self.session = control
+            running = self._thread is not None and self._thread.is_alive()
+            if control["until"] > time.time() and not running:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    # ---- sampling
+
+    def _run(self):
+        own = threading.get_ident()
+        if self.app is not None:
+            for route in self.app.routes:
+                endpoint, methods = getattr(route, "endpoint", None), getattr(route, "methods", None)
+                if hasattr(endpoint, "__code__"):
+                    self._endpoints[endpoint.__code__] = f"{','.join(sorted(methods or ()))} {route.path}"
+        flushed = time.monotonic()
+        while True:
+            self.poll_control()
+            session = self.session
+            if time.time() >= session["until"]:
+                break
+            self._sample(own, session["fraction"])
+            if time.monotonic() - flushed >= FLUSH_S:
+                self.flush()
+                flushed = time.monotonic()
+            time.sleep(session["interval_ms"] / 1000.0)
+        self.flush()
+
+    def _frame(self, code):
+        info = self._frames.get(code)
+        if info is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            info = (f"{os.path.basename(code.co_filename)}:{name}", code.co_filename.startswith(APP_DIR))
+            self._frames[code] = info
+        return info
+
+    def _sample(self, own: int, fraction: float):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            labels, app_depth, root = [], None, None
+            f = frame
+            while f is not None:
+                label, is_app = self._frame(f.f_code)
+                labels.append(label)
+                endpoint = self._endpoints.get(f.f_code)
+                if endpoint is not None:
+                    root = endpoint if fraction >= 1 or _picked(f, fraction) else ""
+                    break
+                if is_app:
+                    app_depth = len(labels)
+                f = f.f_back
+            if root is None:
+                # not serving a request: count pool threads running our code,
+                # skip idle ones (only stdlib/site-packages frames)
+                if app_depth is None or fraction < 1:
+                    continue
+                root = f"({re.sub(r'_[0-9]+$', '', names.get(ident, 'thread'))})"
+                labels = labels[:app_depth]
+            if root:
+                self.counts[";".join([root, *reversed(labels)])] += 1
+        self.samples += 1
+
+    def flush(self):
+        session = self.session
+        if session is None:
+            return
+        _write_json(self._path(f"stacks-{os.getpid()}.json"), {
+            "session": session["session"], "pid": os.getpid(), "samples": self.samples,
+            "flushed_at": time.time(), "stacks": dict(self.counts),
+        })
+
+    # ---- slow requests
+
+    def capture_slow(self, record: Dict):
+        """Queue a slow request for the writer thread; called on the event loop, so it never blocks."""
+        with self._lock:
+            if self._slow_writer is None or not self._slow_writer.is_alive():
+                self._slow_queue = self._slow_queue or queue.Queue(maxsize=SLOW_QUEUE_MAX)
+                self._slow_writer = threading.Thread(target=self._write_slow, name="slow-requests", daemon=True)
+                self._slow_writer.start()
+        try:
+            self._slow_queue.put_nowait(record)
+        except queue.Full:
+            self.slow_dropped += 1
+
+    def _write_slow(self):
+        path = self._path(f"slow-{os.getpid()}.jsonl")
+        while True:
+            record = self._slow_queue.get()
+            logger.warning("slow request: %s %s %.0f ms %s", record["method"], record["endpoint"],
+                           record["duration_ms"], record["phases"])
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+                    size = f.tell()
+                if size > SLOW_REQUEST_LOG_MAX_BYTES:
+                    os.replace(path, path + ".1")
+            except OSError as e:
+                logger.warning("could not record slow request: %s", e)
+
+    # ---- reading back (all workers of the host)
+
+    def read_stacks(self, endpoint: Optional[str] = None) -> Counter:
+        control = self.read_control()
+        total = Counter()
+        for path in glob.glob(self._path("stacks-*.json")):
+            data = _read_json(path)
+            if data is None or control is None or data.get("session") != control["session"]:
+                continue
+            for stack, count in data["stacks"].items():
+                if endpoint is None or stack.split(";", 1)[0] == endpoint:
+                    total[stack] += count
+        return total
+
+    def read_slow(self, limit: int, endpoint: Optional[str] = None) -> List[Dict]:
+        records = []
+        for path in glob.glob(self._path("slow-*.jsonl")) + glob.glob(self._path("slow-*.jsonl.1")):
+            try:
+                with open(path) as f:
+                    lines = f.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a worker is mid-write
+                if endpoint is None or f"{record['method']} {record['endpoint']}" == endpoint:
+                    records.append(record)
+        records.sort(key=lambda r: r["time"], reverse=True)
+        return records[:limit]
+
+    def status(self) -> Dict:
+        control = self.read_control()
+        workers = []
+        for path in glob.glob(self._path("stacks-*.json")):
+            data = _read_json(path)
+            if data is not None and control is not None and data.get("session") == control["session"]:
+                workers.append({"pid": data["pid"], "samples": data["samples"], "flushed_at": data["flushed_at"]})
+        by_endpoint = Counter()
+        for stack, count in self.read_stacks().items():
+            by_endpoint[stack.split(";", 1)[0]] += count
+        return {
+            "session": control,
+            "running": control is not None and control["until"] > time.time(),
+            "workers": workers,
+            "stacks_by_endpoint": dict(by_endpoint.most_common()),
+            "slow_request_ms": SLOW_REQUEST_MS,
+            "slow_dropped": self.slow_dropped,
+        }
+
+
+class ProfilerMiddleware:
+    """ASGI middleware: a RequestTrace per request, slow ones handed to the Profiler."""
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        self.profiler.poll_control()
+        trace = RequestTrace()
+        token = bind(trace)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            unbind(token)
+            duration_ms = (time.perf_counter() - started) * 1000
+            if SLOW_REQUEST_MS and duration_ms >= SLOW_REQUEST_MS:
+                route = scope.get("route")
+                self.profiler.capture_slow({
+                    "time": time.time(),
+                    "pid": os.getpid(),
+                    "method": scope["method"],
+                    # the route template: raw paths can carry phone numbers
+                    "endpoint": route.path if route is not None else "(unmatched)",
+                    "status": status_code,
+                    "duration_ms": round(duration_ms, 3),
+                    "phases": trace.summary(),
+                })
+
+
+profiler = Profiler()
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="admin token required")
+
+
+router = APIRouter(prefix="/admin/profiler", dependencies=[Depends(require_admin)])
+
+
+@router.post("/start")
+def start_profiler(seconds: float = Query(60, gt=0, le=PROFILER_MAX_SECONDS),
+                   fraction: float = Query(1.0, gt=0, le=1),
+                   interval_ms: int = Query(PROFILER_INTERVAL_MS, ge=1, le=1000)):
+    return profiler.start(seconds, fraction, interval_ms)
+
+
+@router.post("/stop")
+def stop_profiler():
+    return {"session": profiler.stop()}
+
+
+@router.get("/status")
+def profiler_status():
+    return profiler.status()
+
+
+@router.get("/stacks", response_class=PlainTextResponse)
+def profiler_stacks(endpoint: Optional[str] = None):
+    """Collapsed stacks ("frame;frame;... count"), for flamegraph.pl, speedscope, etc."""
+    stacks = profiler.read_stacks(endpoint)
+    control = profiler.read_control() or {}
+    body = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+    filename = f"stacks-{control.get('session', 'none')}.txt"
+    return PlainTextResponse(body, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@router.get("/slow")
+def slow_requests(limit: int = Query(100, ge=1, le=5000), endpoint: Optional[str] = None):
+    """Latest requests over SLOW_REQUEST_MS with their phase timings, newest first."""
+    return profiler.read_slow(limit, endpoint)
+
+
+def install(app):
+    """Add the middleware and the admin endpoints to the app."""
+    profiler.app = app
+    app.add_middleware(ProfilerMiddleware, profiler=profiler)
+    app.include_router(router)
@@ -0,0 +1,79 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import Callable, Optional, Tuple
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from byte_cache import ByteTTLCache
+from config import RESPONSE_BUCKET_MIN, RESPONSE_CACHE_TTL_S, RESPONSE_CACHE_MAX_BYTES, RESPONSE_MAX_AGE_S
+
+# orjson (in requirements.txt) is several times faster on the estimate
+# listings; plain json is kept as a fallback for environments without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    """Serialize a response model (or anything jsonable) to compact JSON bytes."""
+    data = jsonable_encoder(content)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def bucket_time(query_time: datetime, minutes: int = RESPONSE_BUCKET_MIN) -> datetime:
+    """query_time rounded down to a `minutes` bucket within its day (same tzinfo)."""
+    if minutes <= 1:
+        return query_time.replace(second=0, microsecond=0)
+    day_minute = query_time.hour * 60 + query_time.minute
+    day_minute -= day_minute % minutes
+    return query_time.replace(hour=day_minute // 60, minute=day_minute % 60, second=0, microsecond=0)
+
+
+class ResponseCache:
+    """
+    Serialized JSON responses keyed by (endpoint arguments, data generation).
+    The body and its ETag are computed once; repeated requests for the same
+    bucket only do a dict lookup, and clients holding the ETag get a 304.
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl_s: float = RESPONSE_CACHE_TTL_S):
+        self._cache = ByteTTLCache(max_bytes, ttl=ttl_s)
+
+    def stats(self):
+        return self._cache.stats()
+
+    def get_or_build(self, key: tuple, build: Callable[[], Tuple[object, bool]]) -> Tuple[bytes, Optional[str]]:
+        """
+        (body, etag) for `key`. `build` returns (content, cacheable); content
+        that isn't cacheable (e.g. a degraded estimate) is served once, without
+        an ETag, and not stored.
+        """
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry
+        content, cacheable = build()
+        body = dumps(content)
+        if not cacheable:
+            return body, None
+        entry = (body, '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest())
+        self._cache[key] = entry
+        return entry
+
+
+def json_response(request: Request, body: bytes, etag: Optional[str]) -> Response:
+    """
+    200 with the body, or 304 when the client already has this ETag.
+    Conditional requests and client caching only apply to GET/HEAD; other
+    methods (POST /estimate) always get the body with no-store.
+    """
+    if etag is None or request.method not in ("GET", "HEAD"):
+        return Response(body, media_type="application/json", headers={"Cache-Control": "no-store"})
+    headers = {"ETag": etag, "Cache-Control": f"max-age={RESPONSE_MAX_AGE_S}"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or
+                          etag in (t.strip().removeprefix("W/") for t in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
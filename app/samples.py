@@ -0,0 +1,44 @@
+from datetime import date
+from typing import Iterable, Mapping, Optional, Tuple
+import numpy as np
+
+# One row per rc event, only what the estimator needs:
+#   delta_t -> cinza->rc wait in minutes
+#   day     -> local (America/Sao_Paulo) date as a proleptic ordinal (date.toordinal())
+#   weekday -> weekday of the rc timestamp (Mon=0 .. Sun=6)
+SAMPLE_DTYPE = np.dtype([
+    ("delta_t", np.float32),
+    ("day", np.int32),
+    ("weekday", np.int8),
+])
+
+# Attributes sample_fields() reads; what DynamoDataStore._query_samples projects
+SAMPLE_ATTRIBUTES = ("delta_t", "day", "rc_time")
+
+
+def empty_samples() -> np.ndarray:
+    return np.empty(0, dtype=SAMPLE_DTYPE)
+
+
+def sample_fields(item: Mapping) -> Optional[Tuple[float, int, int]]:
+    """(delta_t, day ordinal, weekday) for a raw rc item, None if it has no delta_t/day."""
+    delta_t = item.get("delta_t")
+    day = item.get("day")
+    if delta_t is None or day is None:
+        return None
+    day_ord = date.fromisoformat(day[:10]).toordinal()
+    rc_time = item.get("rc_time")
+    # rc_time is ISO-8601 UTC, the date part is enough for the weekday
+    weekday = date.fromisoformat(rc_time[:10]).weekday() if rc_time else date.fromordinal(day_ord).weekday()
+    return float(delta_t), day_ord, weekday
+
+
+def samples_from_items(items: Iterable[Mapping]) -> np.ndarray:
+    """
+    Build a compact sample batch from raw rc items (as returned by DynamoDB).
+    Items missing delta_t or day are skipped.
+    """
+    rows = [f for f in map(sample_fields, items) if f is not None]
+    if not rows:
+        return empty_samples()
+    return np.array(rows, dtype=SAMPLE_DTYPE)
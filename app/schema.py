@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, Literal, List
+from typing import Optional, Literal, List, Dict
 from datetime import datetime
 from decimal import Decimal
 from typing import Union
@@ -14,13 +14,27 @@ class EstimateRequest(BaseModel):
     unit: str
     risk_color: str
     query_time: datetime
+    budget_ms: Optional[int] = None  # defaults to ESTIMATE_BUDGET_MS
 
 class EstimateResponse(BaseModel):
     estimated_wait: float | str
+    concepts_used: List[str] = []
+    # concepts left out because their data didn't arrive within the budget
+    skipped_concepts: List[str] = []
+    # concepts answered from the last batch seen, past its TTL, for the same reason
+    stale_concepts: List[str] = []
+    degraded: bool = False
     
 class HealthCheckResponse(BaseModel):
     status: str
 
+class CacheStatsResponse(BaseModel):
+    # stats are per worker process
+    pid: int
+    est_cache: Dict[str, int]
+    stale_cache: Dict[str, int]
+    response_cache: Dict[str, int]
+
 class UnitEstimates(BaseModel):
     unit: str
     blue: float
@@ -32,6 +46,8 @@ class UnitEstimates(BaseModel):
 class AllEstimatesResponse(BaseModel):
     estimates: List[UnitEstimates]
     query_time: datetime
+    # sharded deployments: units whose node couldn't be reached
+    unavailable_units: List[str] = []
 
 class RegisterUnitRequest(BaseModel):
     unit: str
@@ -59,4 +75,12 @@ class RouteTimeResult(BaseModel):
 
 class RouteTimeResponse(BaseModel):
     user_phone: str
-    results: List[RouteTimeResult]
\ No newline at end of file
+    results: List[RouteTimeResult]
+
+class CepBatchRequest(BaseModel):
+    ceps: List[str]
+
+class CepBatchResponse(BaseModel):
+    # normalized CEP -> CEP Aberto payload (None when unknown or the lookup failed)
+    results: Dict[str, Optional[dict]]
+    invalid: List[str] = []
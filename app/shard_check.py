@@ -0,0 +1,138 @@
+"""
+Run a sharded cluster locally and check it against an unsharded node.
+
+    python shard_check.py                            # 3 shard nodes, 40 units
+    python shard_check.py --nodes 5 --units 100 --clock 17:10
+
+Every node is a uvicorn process on one shared sqlite database, standing in
+for DynamoDB. Data is seeded through the reference (unsharded) node. Then,
+for every unit and color, /estimate is asked of a random shard node (so
+most calls are forwarded) and of the reference; /all_estimates is asked of
+every shard node.
+
+Shards take Concept 4 from merged histograms, so estimates may differ from
+the reference by about half a SHARD_HIST_BIN_MIN bin. Anything beyond
+--tolerance minutes, a missing unit or a failed request exits non-zero.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+import httpx
+from loadtest import COLORS, _free_port, seed, start_server, stop_server
+
+
+def start_cluster(args, workdir: str):
+    """(reference url, shard urls, processes)"""
+    server_args = dict(backend="sqlite", server="uvicorn", workers=args.workers,
+                       startup_timeout=args.startup_timeout, endpoint_url=None)
+    shared = {"SQLITE_PATH": os.path.join(workdir, "chronos.db")}
+    ports = [_free_port() for _ in range(args.nodes + 1)]
+    urls = [f"http://127.0.0.1:{p}" for p in ports]
+    nodes = ",".join(urls[1:])
+    procs = []
+    try:
+        for i, port in enumerate(ports):
+            # own directory per node: separate logs and change logs, like separate hosts
+            node_dir = os.path.join(workdir, f"node{i}")
+            os.makedirs(node_dir)
+            env = dict(shared, SHARD_NODES=nodes, SHARD_SELF=urls[i]) if i else shared
+            procs.append(start_server(SimpleNamespace(**server_args, port=port), node_dir, env))
+    except Exception:
+        for proc in procs:
+            stop_server(proc)
+        raise
+    return urls[0], urls[1:], procs
+
+
+def query_time(clock: str) -> str:
+    hour, minute = map(int, clock.split(":"))
+    local = datetime.now(ZoneInfo("America/Sao_Paulo")).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return local.isoformat()
+
+
+async def check(reference: str, shards: list, args) -> bool:
+    rng = random.Random(args.seed)
+    units = [f"Shard Unit {i:03d}" for i in range(args.units)]
+    when = query_time(args.clock)
+    ok = True
+    async with httpx.AsyncClient(base_url=reference, timeout=60) as client:
+        await seed(client, units, args.seed_events, rng)
+
+    async with httpx.AsyncClient(timeout=60) as client:
+
+        owners = {}
+        for shard in shards:
+            r = await client.get(f"{shard}/all_estimates", params={"query_time": when, "local": "true"})
+            r.raise_for_status()
+            for e in r.json()["estimates"]:
+                owners.setdefault(e["unit"], []).append(shard)
+        print("units per node: " + ", ".join(
+            f"{s.rsplit(':', 1)[1]}={sum(1 for o in owners.values() if s in o)}" for s in shards))
+        if sorted(owners) != units or any(len(o) != 1 for o in owners.values()):
+            print("FAIL: every unit must be owned by exactly one node")
+            ok = False
+
+        worst = 0.0
+        for unit in units:
+            for color in COLORS:
+                body = {"unit": unit, "risk_color": color, "query_time": when}
+                expected, got = await asyncio.gather(client.post(f"{reference}/estimate", json=body),
+                                                     client.post(f"{rng.choice(shards)}/estimate", json=body))
+                if expected.status_code != 200 or got.status_code != 200:
+                    print(f"FAIL: /estimate {unit} {color}: {expected.status_code} vs {got.status_code}")
+                    ok = False
+                    continue
+                e, g = expected.json()["estimated_wait"], got.json()["estimated_wait"]
+                if isinstance(e, str) or isinstance(g, str):
+                    if e != g:
+                        print(f"FAIL: /estimate {unit} {color}: {e!r} vs {g!r}")
+                        ok = False
+                    continue
+                worst = max(worst, abs(e - g))
+        print(f"/estimate: {len(units) * len(COLORS)} queries, max |diff| {worst:.3f} min")
+        ok &= worst <= args.tolerance
+
+        expected = (await client.get(f"{reference}/all_estimates", params={"query_time": when})).json()
+        expected = {e["unit"]: e["green"] for e in expected["estimates"]}
+        for shard in shards:
+            r = await client.get(f"{shard}/all_estimates", params={"query_time": when})
+            payload = r.json()
+            got = {e["unit"]: e["green"] for e in payload["estimates"]}
+            diff = max((abs(expected[u] - got[u]) for u in expected if u in got), default=0.0)
+            print(f"/all_estimates via {shard}: {len(got)}/{len(expected)} units, max |diff| {diff:.3f} min, "
+                  f"unavailable {payload['unavailable_units']}")
+            ok &= r.status_code == 200 and got.keys() == expected.keys() and diff <= args.tolerance
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers per node")
+    parser.add_argument("--units", type=int, default=40)
+    parser.add_argument("--seed-events", type=int, default=30, help="historical cycles per unit")
+    parser.add_argument("--clock", default="09:40", metavar="HH:MM", help="Sao Paulo time of the queries")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="allowed difference (minutes)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="chronos-shards-") as workdir:
+        reference, shards, procs = start_cluster(args, workdir)
+        try:
+            ok = asyncio.run(check(reference, shards, args))
+        finally:
+            for proc in procs:
+                stop_server(proc)
+    print("ok" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
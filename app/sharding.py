@@ -0,0 +1,232 @@
+"""
+Unit sharding across estimator nodes.
+
+With SHARD_NODES set, units are assigned to nodes by consistent hashing
+(HashRing), so adding a node only moves about 1/n of the units. Any node
+takes any request: /estimate is forwarded to the unit's owner and
+/all_estimates gathers every node's own units. A node indexes and caches
+only the events of its own units (DataStore.unit_filter).
+
+Concept 4 (cross-unit) still needs every unit. Each node publishes one
+delta_t histogram per (color, slot) over its own units at /shard/histograms;
+CrossUnitHistograms sums them and takes the IQR-filtered median from the
+merged histogram. It stands in for DataStore.iqr_median_color_slot_all_units
+in the estimator.
+
+shard_check.py runs a few nodes locally and compares them with an unsharded one.
+"""
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from config import (
+    RISK_COLORS, TIME_SLOTS, SHARD_NODES, SHARD_SELF, SHARD_VNODES, SHARD_TIMEOUT_S,
+    SHARD_HIST_REFRESH_S, SHARD_HIST_BIN_MIN, SHARD_HIST_MAX_MIN
+)
+from utils import value_histogram, histogram_iqr_median
+
+logger = logging.getLogger(__name__)
+
+# Set on requests between nodes: the receiver answers locally, never forwards again
+FORWARDED_HEADER = "X-Shard-Forwarded"
+SLOT_NAMES = [f"{start}-{end}" for start, end in TIME_SLOTS]
+N_BINS = int(SHARD_HIST_MAX_MIN / SHARD_HIST_BIN_MIN)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class HashRing:
+    """Consistent hashing of keys (unit names) onto nodes, with virtual nodes."""
+
+    def __init__(self, nodes: List[str], vnodes: int = SHARD_VNODES):
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        self.nodes = list(dict.fromkeys(nodes))
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._points = [p for p, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str) -> str:
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+class ShardRouter:
+    """This node's view of the ring, plus the HTTP client used to reach the others."""
+
+    def __init__(self, nodes: List[str], self_node: str, timeout_s: float = SHARD_TIMEOUT_S):
+        if self_node not in nodes:
+            raise ValueError(f"SHARD_SELF {self_node!r} is not one of SHARD_NODES {nodes}")
+        self.ring = HashRing(nodes)
+        self.self_node = self_node
+        self.peers = [n for n in self.ring.nodes if n != self_node]
+        self.timeout_s = timeout_s
+        # created on first use, so nothing is shared across a gunicorn fork
+        self._client = None
+        self._pool = ThreadPoolExecutor(max_workers=max(4 * len(self.peers), 1), thread_name_prefix="shard")
+
+    @classmethod
+    def from_config(cls) -> Optional["ShardRouter"]:
+        """The router for SHARD_NODES / SHARD_SELF; None when sharding is off."""
+        nodes = [n.strip().rstrip("/") for n in SHARD_NODES.split(",") if n.strip()]
+        if not nodes:
+            return None
+        return cls(nodes, SHARD_SELF.strip().rstrip("/"))
+
+    def owner(self, unit: str) -> str:
+        return self.ring.owner(unit)
+
+    def layout(self) -> Dict:
+        """What decides which units this node owns; a change means a reshard."""
+        return {"nodes": sorted(self.ring.nodes), "self": self.self_node, "vnodes": SHARD_VNODES}
+
+    def owns(self, unit: str) -> bool:
+        return self.ring.owner(unit) == self.self_node
+
+    @property
+    def http(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.Client(
+                timeout=self.timeout_s,
+                limits=httpx.Limits(max_keepalive_connections=32),
+                headers={FORWARDED_HEADER: self.self_node},
+            )
+        return self._client
+
+    def request(self, node: str, method: str, path: str, **kwargs):
+        return self.http.request(method, node + path, **kwargs)
+
+    def _get_json(self, node: str, path: str, params: Optional[Dict]) -> Optional[Dict]:
+        try:
+            response = self.request(node, "GET", path, params=params)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            logger.warning("shard %s: GET %s failed: %s", node, path, e)
+            return None
+
+    def gather_async(self, path: str, params: Optional[Dict] = None) -> Dict[str, Future]:
+        """Start a GET of path on every peer; each future gives the JSON body or None."""
+        return {node: self._pool.submit(self._get_json, node, path, params) for node in self.peers}
+
+    def gather(self, path: str, params: Optional[Dict] = None) -> Dict[str, Optional[Dict]]:
+        return {node: future.result() for node, future in self.gather_async(path, params).items()}
+
+
+def encode_histograms(histograms: Dict[Tuple[str, str], np.ndarray]) -> Dict:
+    """JSON form of per-(color, slot) histograms: only the non-empty bins."""
+    out = {}
+    for (color, slot), counts in histograms.items():
+        bins = np.flatnonzero(counts)
+        out[f"{color}|{slot}"] = {"bins": bins.tolist(), "counts": counts[bins].tolist()}
+    return {"bin_min": SHARD_HIST_BIN_MIN, "n_bins": N_BINS, "histograms": out}
+
+
+def decode_histograms(payload: Dict) -> Optional[Dict[Tuple[str, str], np.ndarray]]:
+    if payload.get("bin_min") != SHARD_HIST_BIN_MIN or payload.get("n_bins") != N_BINS:
+        return None
+    out = {}
+    for key, sparse in payload.get("histograms", {}).items():
+        color, slot = key.split("|", 1)
+        counts = np.zeros(N_BINS, dtype=np.int64)
+        counts[np.asarray(sparse["bins"], dtype=np.int64)] = sparse["counts"]
+        out[(color, slot)] = counts
+    return out
+
+
+class CrossUnitHistograms:
+    """
+    Concept 4 for a sharded node. This node's histograms are rebuilt from its
+    own cached samples when the DataStore generation moves, one rebuild at a
+    time; the other nodes' are refetched every refresh_s. A node that can't
+    be reached keeps contributing its last histograms.
+    """
+
+    def __init__(self, datastore, router: ShardRouter, refresh_s: float = SHARD_HIST_REFRESH_S):
+        self.ds = datastore
+        self.router = router
+        self.refresh_s = refresh_s
+        self._local: Optional[Tuple[int, Dict]] = None  # (generation, histograms)
+        self._peers: Dict[str, Dict] = {}
+        self._merged: Optional[Dict[Tuple[str, str], np.ndarray]] = None
+        self._merged_at = 0.0
+        self._lock = threading.Lock()
+        self._local_lock = threading.Lock()
+
+    def local_histograms(self) -> Dict[Tuple[str, str], np.ndarray]:
+        """delta_t histograms per (color, slot) over this node's units."""
+        local = self._local
+        if local is not None and local[0] == self.ds.generation:
+            return local[1]
+        # one rebuild at a time; while it runs, other callers (peers polling
+        # /shard/histograms) get the previous histograms instead of waiting
+        if not self._local_lock.acquire(blocking=local is None):
+            return local[1]
+        try:
+            local = self._local
+            generation = self.ds.generation
+            if local is not None and local[0] == generation:
+                return local[1]
+            histograms = {}
+            for color in RISK_COLORS:
+                for slot in SLOT_NAMES:
+                    values = self._own_samples(color, slot)
+                    if len(values):
+                        counts = value_histogram(values, SHARD_HIST_BIN_MIN, N_BINS)
+                        if counts.any():
+                            histograms[(color, slot)] = counts
+            self._local = (generation, histograms)
+            return histograms
+        finally:
+            self._local_lock.release()
+
+    def _own_samples(self, color: str, slot: str) -> np.ndarray:
+        if self.ds.events is not None:
+            # the event index only holds this node's units: one cached
+            # cross-unit batch instead of one batch per unit
+            return self.ds.fetch_samples_color_slot_all_units(color, slot)["delta_t"]
+        units = [u for u in self.ds.list_units() if self.router.owns(u)]
+        values = [self.ds.fetch_samples_unit_slot_color_all_days(u, color, slot)["delta_t"] for u in units]
+        return np.concatenate(values) if values else np.empty(0)
+
+    def refresh(self):
+        for node, payload in self.router.gather("/shard/histograms").items():
+            histograms = decode_histograms(payload) if payload is not None else None
+            if histograms is not None:
+                self._peers[node] = histograms
+            elif payload is not None:
+                logger.warning("shard %s: histogram bins differ from ours, ignored", node)
+        merged: Dict[Tuple[str, str], np.ndarray] = {}
+        for histograms in [self.local_histograms(), *self._peers.values()]:
+            for key, counts in histograms.items():
+                merged[key] = merged[key] + counts if key in merged else counts.copy()
+        changed = self._merged is None or merged.keys() != self._merged.keys() or \
+            any(not np.array_equal(counts, self._merged[key]) for key, counts in merged.items())
+        self._merged, self._merged_at = merged, time.monotonic()
+        if changed:
+            # estimates built on the old aggregates are keyed on the generation
+            self.ds.bump_generation()
+
+    def iqr_median_color_slot_all_units(self, color: str, slot: str, factor: float,
+                                        mode: str = "fetch") -> Optional[Tuple[int, Optional[float]]]:
+        """Same contract as DataStore.iqr_median_color_slot_all_units."""
+        fresh = self._merged is not None and time.monotonic() - self._merged_at < self.refresh_s
+        if not fresh:
+            if mode == "cached" or (mode == "stale" and self._merged is None):
+                return None
+            if mode == "fetch":
+                with self._lock:
+                    # another thread may have refreshed while we waited
+                    if self._merged is None or time.monotonic() - self._merged_at >= self.refresh_s:
+                        self.refresh()
+        counts = self._merged.get((color, slot))
+        if counts is None:
+            return 0, None
+        return histogram_iqr_median(counts, SHARD_HIST_BIN_MIN, factor)
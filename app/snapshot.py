@@ -0,0 +1,225 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Mapping, Optional
+import numpy as np
+from samples import SAMPLE_DTYPE, empty_samples, sample_fields
+
+logger = logging.getLogger(__name__)
+
+# One row per rc event. unit/color/slot are indexes into the snapshot's label
+# lists; key identifies the DynamoDB item (pseudonym, event_id) so a newer
+# version of the same item replaces the old one.
+EVENT_DTYPE = np.dtype([
+    ("key", np.uint64),
+    ("unit", np.int32),
+    ("color", np.int8),
+    ("slot", np.int8),
+    ("delta_t", np.float32),
+    ("day", np.int32),
+    ("weekday", np.int8),
+    ("event_time", np.float64),
+])
+
+# Attributes read from DynamoDB to build index rows. ingested_at is the
+# server's clock when the item was written (event_time is the client's);
+# incremental scans select on it
+EVENT_ATTRIBUTES = ("pseudonym", "event_id", "unit", "risk_color", "slot",
+                    "delta_t", "day", "rc_time", "event_time", "ingested_at")
+
+# 2: high_water is the newest ingested_at, not the newest event_time
+SNAPSHOT_VERSION = 2
+
+
+def event_key(pseudonym: str, event_id: str) -> int:
+    digest = hashlib.blake2b(f"{pseudonym}#{event_id}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _epoch(ts: str) -> float:
+    dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class EventIndex:
+    """
+    In-memory index of every rc event, answering the DataStore sample queries
+    without a scan. The bulk of the rows usually comes from a snapshot file
+    that is memory-mapped read-only (`base`); events fetched after boot live
+    in a small in-memory `delta` array and shadow base rows with the same key.
+    """
+
+    def __init__(self, base: Optional[np.ndarray] = None, units: Optional[List[str]] = None,
+                 colors: Optional[List[str]] = None, slots: Optional[List[str]] = None,
+                 shard_layout: Optional[Dict] = None):
+        self.base = base if base is not None else np.empty(0, dtype=EVENT_DTYPE)
+        self.alive = np.ones(len(self.base), dtype=bool)
+        self.delta = np.empty(0, dtype=EVENT_DTYPE)
+        self.units = list(units or [])
+        self.colors = list(colors or [])
+        self.slots = list(slots or [])
+        self._unit_ids = {v: i for i, v in enumerate(self.units)}
+        self._color_ids = {v: i for i, v in enumerate(self.colors)}
+        self._slot_ids = {v: i for i, v in enumerate(self.slots)}
+        # newest ingested_at merged (epoch seconds); rows don't keep it, so a
+        # loaded index takes it from the snapshot meta
+        self.high_water = 0.0
+        self.saved_at = 0.0
+        # ShardRouter.layout() of the node that built it, None when unsharded
+        self.shard_layout = shard_layout
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self.delta)
+
+    @staticmethod
+    def _label_id(labels: List[str], ids: dict, value: str) -> int:
+        if value not in ids:
+            ids[value] = len(labels)
+            labels.append(value)
+        return ids[value]
+
+    def merge(self, items: Iterable[Mapping]) -> int:
+        """
+        Add (or replace) rc events from raw DynamoDB items. Returns the number
+        of rows that changed the index; items already in it as they are (the
+        overlap an incremental fetch reads again) don't count.
+        """
+        rows = []
+        high_water = self.high_water
+        for item in items:
+            fields = sample_fields(item)
+            if fields is None or not item.get("event_time"):
+                continue
+            # items written before ingested_at existed only have their event_time
+            high_water = max(high_water, _epoch(item.get("ingested_at") or item["event_time"]))
+            rows.append((
+                event_key(item["pseudonym"], item["event_id"]),
+                self._label_id(self.units, self._unit_ids, item.get("unit")),
+                self._label_id(self.colors, self._color_ids, item.get("risk_color")),
+                self._label_id(self.slots, self._slot_ids, item.get("slot")),
+                *fields,
+                _epoch(item["event_time"]),
+            ))
+        self.high_water = high_water
+        if not rows:
+            return 0
+        new = np.array(rows, dtype=EVENT_DTYPE)
+        in_base = np.isin(self.base["key"], new["key"]) & self.alive if len(self.base) else None
+        in_delta = np.isin(self.delta["key"], new["key"])
+        known = [self.delta[in_delta]] + ([self.base[in_base]] if in_base is not None else [])
+        known = {row.tobytes() for part in known for row in part}
+        changed = sum(1 for row in new if row.tobytes() not in known) if known else len(new)
+        # newest version of each key wins, across base, delta and this batch
+        merged = np.concatenate([self.delta, new])
+        order = np.lexsort((merged["event_time"], merged["key"]))
+        merged = merged[order]
+        last = np.append(merged["key"][1:] != merged["key"][:-1], True)
+        self.delta = merged[last]
+        if in_base is not None:
+            self.alive &= ~in_base
+        return changed
+
+    def discard(self, pseudonym: str, event_id: str):
+        key = event_key(pseudonym, event_id)
+        if len(self.base):
+            self.alive &= self.base["key"] != key
+        self.delta = self.delta[self.delta["key"] != key]
+
+    def select(self, unit: Optional[str], color: str, slot: str,
+               day_ordinal: Optional[int] = None) -> np.ndarray:
+        """Sample batch for (unit or all units, color, slot[, day])."""
+        color_id = self._color_ids.get(color)
+        slot_id = self._slot_ids.get(slot)
+        unit_id = self._unit_ids.get(unit) if unit is not None else None
+        if color_id is None or slot_id is None or (unit is not None and unit_id is None):
+            return empty_samples()
+        parts = []
+        for rows, alive in ((self.base, self.alive), (self.delta, None)):
+            if not len(rows):
+                continue
+            mask = (rows["color"] == color_id) & (rows["slot"] == slot_id)
+            if alive is not None:
+                mask &= alive
+            if unit_id is not None:
+                mask &= rows["unit"] == unit_id
+            if day_ordinal is not None:
+                mask &= rows["day"] == day_ordinal
+            picked = rows[mask]
+            out = np.empty(len(picked), dtype=SAMPLE_DTYPE)
+            for name in SAMPLE_DTYPE.names:
+                out[name] = picked[name]
+            parts.append(out)
+        return np.concatenate(parts) if parts else empty_samples()
+
+    def high_water_iso(self, margin_s: float = 0.0) -> str:
+        """High-water mark as an ISO string comparable with stored ingested_at values."""
+        ts = datetime.fromtimestamp(max(self.high_water - margin_s, 0.0), tz=timezone.utc)
+        return ts.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def save(self, path: str):
+        """
+        Write the live rows to `<path>.<n>.npy` and then atomically point the
+        `<path>` metadata file at it, so readers never see a half-written file.
+        Every worker saves on shutdown, so saves hold an flock on `<path>.lock`.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            rows = np.concatenate([self.base[self.alive], self.delta])
+            data_name = f"{os.path.basename(path)}.{int(self.high_water)}.{os.getpid()}.npy"
+            data_path = os.path.join(directory, data_name)
+            with open(data_path + ".tmp", "wb") as f:
+                np.save(f, rows)
+            os.replace(data_path + ".tmp", data_path)
+            meta = {
+                "version": SNAPSHOT_VERSION,
+                "data": data_name,
+                "rows": len(rows),
+                "high_water": self.high_water,
+                "saved_at": datetime.now(timezone.utc).timestamp(),
+                "units": self.units,
+                "colors": self.colors,
+                "slots": self.slots,
+                "shard_layout": self.shard_layout,
+            }
+            meta_tmp = f"{path}.{os.getpid()}.tmp"
+            with open(meta_tmp, "w") as f:
+                json.dump(meta, f)
+            os.replace(meta_tmp, path)
+            # every other data file of this snapshot is stale, including ones left
+            # by a save that died; processes still mapping one keep it alive until
+            # they unmap it
+            prefix = f"{os.path.basename(path)}."
+            for name in os.listdir(directory):
+                if name.startswith(prefix) and name.endswith((".npy", ".npy.tmp")) and name != data_name:
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
+        logger.info("snapshot saved: %d rows, high water %s", len(rows), self.high_water_iso())
+
+    @classmethod
+    def load(cls, path: str) -> Optional["EventIndex"]:
+        """Memory-map a snapshot written by save(); None if missing or unreadable."""
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+            if meta.get("version") != SNAPSHOT_VERSION:
+                return None
+            data_path = os.path.join(os.path.dirname(os.path.abspath(path)), meta["data"])
+            base = np.load(data_path, mmap_mode="r")
+        except (OSError, ValueError, KeyError) as e:
+            logger.info("no usable snapshot at %s: %s", path, e)
+            return None
+        if base.dtype != EVENT_DTYPE:
+            return None
+        index = cls(base, meta["units"], meta["colors"], meta["slots"], meta.get("shard_layout"))
+        index.high_water = max(index.high_water, float(meta.get("high_water") or 0.0))
+        index.saved_at = float(meta.get("saved_at") or 0.0)
+        return index
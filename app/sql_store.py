@@ -0,0 +1,317 @@
+import logging
+import math
+import sqlite3
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from config import SQLITE_PATH
+from data_store import DataStore
+from samples import SAMPLE_DTYPE, sample_fields
+from snapshot import EVENT_ATTRIBUTES
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    pseudonym   TEXT NOT NULL,
+    event_id    TEXT NOT NULL,
+    unit        TEXT NOT NULL,
+    event_type  TEXT NOT NULL,
+    event_time  TEXT,
+    cinza_time  TEXT,
+    rc_time     TEXT,
+    risk_color  TEXT,
+    delta_t     REAL,
+    slot        TEXT,
+    day         TEXT,
+    weekday     INTEGER,
+    ingested_at TEXT,
+    PRIMARY KEY (pseudonym, event_id)
+);
+-- delta_t is the trailing column so percentile lookups walk the index in order
+CREATE INDEX IF NOT EXISTS events_unit_color_slot_day
+    ON events (unit, risk_color, slot, day, delta_t) WHERE event_type = 'rc';
+CREATE INDEX IF NOT EXISTS events_color_slot
+    ON events (risk_color, slot, delta_t) WHERE event_type = 'rc';
+
+CREATE TABLE IF NOT EXISTS units (
+    unit        TEXT PRIMARY KEY,
+    lat         REAL,
+    lng         REAL,
+    address     TEXT,
+    postal_code TEXT
+);
+
+CREATE TABLE IF NOT EXISTS user_route_times (
+    user_phone      TEXT NOT NULL,
+    unit            TEXT NOT NULL,
+    travel_time_min REAL,
+    timestamp       TEXT,
+    ttl             INTEGER,
+    PRIMARY KEY (user_phone, unit)
+);
+"""
+
+EVENT_COLUMNS = ("pseudonym", "event_id", "unit", "event_type", "event_time", "cinza_time",
+                 "rc_time", "risk_color", "delta_t", "slot", "day", "weekday", "ingested_at")
+
+# Run after SCHEMA, once databases created before ingested_at have the column
+INGESTED_INDEX = """
+CREATE INDEX IF NOT EXISTS events_ingested
+    ON events (COALESCE(ingested_at, event_time)) WHERE event_type = 'rc';
+DROP INDEX IF EXISTS events_event_time;
+"""
+
+# date.toordinal() of a 'YYYY-MM-DD' text column
+DAY_ORDINAL_SQL = "CAST(julianday(day) - 1721424.5 AS INTEGER)"
+
+
+def _num(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+
+class SqlDataStore(DataStore):
+    """
+    DataStore on an embedded SQLite database, for single-node deployments and
+    fast local runs. Sample queries hit partial indexes on
+    (unit, risk_color, slot, day) and (risk_color, slot) instead of scanning,
+    the weekday filter runs in the engine, and the IQR-filtered median
+    concepts are computed with ordered index lookups rather than by loading
+    every sample into Python.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(events)")}
+            if "ingested_at" not in columns:
+                conn.execute("ALTER TABLE events ADD COLUMN ingested_at TEXT")
+            conn.executescript(INGESTED_INDEX)
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads; one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.path == ":memory:":
+                # a shared in-memory database so every thread sees the same data
+                conn = sqlite3.connect("file:chronos?mode=memory&cache=shared", uri=True)
+            else:
+                conn = sqlite3.connect(self.path, timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def reset_connections(self):
+        self._local = threading.local()
+
+    # ---- events
+
+    def _unit_events(self, hashed_pseudonym: str, unit: str) -> List[Dict]:
+        # event_id is "<unit>#<type>"; '$' sorts right after '#'
+        rows = self._connect().execute(
+            "SELECT * FROM events WHERE pseudonym = ? AND event_id >= ? AND event_id < ?",
+            (hashed_pseudonym, f"{unit}#", f"{unit}$"),
+        ).fetchall()
+        return [{k: row[k] for k in row.keys() if row[k] is not None} for row in rows]
+
+    def _put_event(self, item: Dict):
+        fields = sample_fields(item)
+        row = dict(item, weekday=fields[2] if fields else None)
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO events ({', '.join(EVENT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in EVENT_COLUMNS)})",
+                [_num(row.get(c)) for c in EVENT_COLUMNS],
+            )
+
+    def _delete_event(self, hashed_pseudonym: str, event_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM events WHERE pseudonym = ? AND event_id = ?",
+                         (hashed_pseudonym, event_id))
+
+    def _event_cursor(self, since: Optional[str], attributes: Sequence[str]) -> sqlite3.Cursor:
+        unknown = set(attributes) - set(EVENT_COLUMNS)
+        if unknown:
+            raise ValueError(f"not event columns: {sorted(unknown)}")
+        sql = f"SELECT {', '.join(attributes)} FROM events WHERE event_type = 'rc'"
+        params = ()
+        if since is not None:
+            # rows written before ingested_at existed go by their event_time
+            sql += " AND COALESCE(ingested_at, event_time) > ?"
+            params = (since,)
+        return self._connect().execute(sql, params)
+
+    @staticmethod
+    def _items(rows) -> List[Dict]:
+        # like DynamoDB items: absent attributes are missing, not None
+        return [{k: row[k] for k in row.keys() if row[k] is not None} for row in rows]
+
+    def _scan_events(self, since: Optional[str] = None,
+                     attributes: Sequence[str] = EVENT_ATTRIBUTES) -> List[Dict]:
+        return self._items(self._event_cursor(since, attributes))
+
+    def iter_event_pages(self, since: Optional[str] = None, attributes: Sequence[str] = EVENT_ATTRIBUTES,
+                         page_size: int = 10000) -> Iterator[List[Dict]]:
+        cursor = self._event_cursor(since, attributes)
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            yield self._items(rows)
+
+    def _scan_event_units(self) -> List[str]:
+        return [row[0] for row in self._connect().execute("SELECT DISTINCT unit FROM events")]
+
+    @staticmethod
+    def _where(color: str, slot: str, unit: Optional[str], day_str: Optional[str],
+               weekday: Optional[int] = None) -> Tuple[str, list]:
+        clauses = ["event_type = 'rc'", "risk_color = ?", "slot = ?"]
+        params = [color, slot]
+        if unit is not None:
+            clauses.insert(1, "unit = ?")
+            params.insert(0, unit)
+        if day_str is not None:
+            clauses.append("day = ?")
+            params.append(day_str)
+        if weekday is not None:
+            clauses.append("weekday = ?")
+            params.append(weekday)
+        return " AND ".join(clauses), params
+
+    def _query_samples(self, color: str, slot: str, unit: Optional[str] = None,
+                       day_str: Optional[str] = None, weekday: Optional[int] = None) -> np.ndarray:
+        where, params = self._where(color, slot, unit, day_str, weekday)
+        rows = self._connect().execute(
+            f"SELECT delta_t, {DAY_ORDINAL_SQL}, weekday FROM events WHERE {where}", params
+        ).fetchall()
+        return np.array([tuple(r) for r in rows], dtype=SAMPLE_DTYPE)
+
+    def fetch_samples_unit_color_slot_weekday(self, unit: str, color: str,
+                                              slot: str, weekday: int, mode: str = "fetch") -> Optional[np.ndarray]:
+        if self.events is not None:
+            return super().fetch_samples_unit_color_slot_weekday(unit, color, slot, weekday, mode)
+        # the weekday filter is cheap in the engine, no need to go through the all-days batch
+        self.sync_changes()
+        key = ("unit_color_slot_weekday", unit, color, slot, weekday)
+        batch = self._cached_samples(key, mode)
+        if batch is not None or mode != "fetch":
+            return batch
+        return self._store_samples(key, self._query_samples(color, slot, unit=unit, weekday=weekday))
+
+    # ---- aggregate pushdown
+
+    def _iqr_median(self, where: str, params: list, factor: float) -> Tuple[int, Optional[float]]:
+        """
+        Same result as iqr_median() on the matching delta_t values, using
+        COUNT and ORDER BY ... LIMIT/OFFSET on the delta_t-ordered index.
+        Percentiles use numpy's default linear interpolation.
+        """
+        conn = self._connect()
+        n = conn.execute(f"SELECT COUNT(*) FROM events WHERE {where}", params).fetchone()[0]
+        if n == 0:
+            return 0, None
+
+        def value_at(pos: float, extra: str = "", extra_params=()) -> float:
+            lo = math.floor(pos)
+            rows = conn.execute(
+                f"SELECT delta_t FROM events WHERE {where}{extra} ORDER BY delta_t LIMIT 2 OFFSET ?",
+                [*params, *extra_params, lo],
+            ).fetchall()
+            v0 = rows[0][0]
+            v1 = rows[1][0] if len(rows) > 1 else v0
+            return v0 + (v1 - v0) * (pos - lo)
+
+        q1 = value_at(0.25 * (n - 1))
+        q3 = value_at(0.75 * (n - 1))
+        iqr = q3 - q1
+        bounds = (q1 - factor * iqr, q3 + factor * iqr)
+        extra = " AND delta_t BETWEEN ? AND ?"
+        kept = conn.execute(f"SELECT COUNT(*) FROM events WHERE {where}{extra}", [*params, *bounds]).fetchone()[0]
+        if kept == 0:
+            return 0, None
+        return kept, float(value_at(0.5 * (kept - 1), extra, bounds))
+
+    def _cached_iqr_median(self, key: tuple, mode: str, where: str, params: list,
+                           factor: float) -> Optional[Tuple[int, Optional[float]]]:
+        """
+        _iqr_median with the fetchers' cache and `mode` contract. Results are
+        keyed on the data generation rather than invalidated per key; the
+        stale cache keeps the last one regardless.
+        """
+        self.sync_changes()
+        key = (*key, factor)
+        current = (*key, self.generation)
+        result = self.est_cache.get(current)
+        if result is not None:
+            return result
+        if mode == "stale":
+            return self.stale_cache.get(key)
+        if mode != "fetch":
+            return None
+        result = self._iqr_median(where, params, factor)
+        self.est_cache[current] = result
+        self.stale_cache[key] = result
+        return result
+
+    def iqr_median_unit_day_slot_color(self, unit: str, color: str, slot: str, day_str: str,
+                                       factor: float, mode: str = "fetch") -> Optional[Tuple[int, Optional[float]]]:
+        if self.events is not None:
+            return super().iqr_median_unit_day_slot_color(unit, color, slot, day_str, factor, mode)
+        where, params = self._where(color, slot, unit, day_str)
+        return self._cached_iqr_median(("iqr_unit_day_slot_color", unit, color, slot, day_str),
+                                       mode, where, params, factor)
+
+    def iqr_median_color_slot_all_units(self, color: str, slot: str, factor: float,
+                                        mode: str = "fetch") -> Optional[Tuple[int, Optional[float]]]:
+        if self.events is not None:
+            return super().iqr_median_color_slot_all_units(color, slot, factor, mode)
+        where, params = self._where(color, slot, None, None)
+        return self._cached_iqr_median(("iqr_color_slot_all_units", color, slot), mode, where, params, factor)
+
+    # ---- units and route times
+
+    def _put_route_times(self, user_phone: str, results: List[Dict], timestamp: str, ttl: int):
+        # One transaction per user, replacing all of the user's rows (units no
+        # longer in the results must not linger); expired rows are filtered on read
+        with self._connect() as conn:
+            conn.execute("DELETE FROM user_route_times WHERE user_phone = ?", (user_phone,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_route_times (user_phone, unit, travel_time_min, timestamp, ttl) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(user_phone, r["unit"], r["travel_time_min"], timestamp, ttl) for r in results],
+            )
+
+    def register_unit(self, unit: str, address: Optional[str] = None,
+                      postal_code: Optional[str] = None,
+                      latitude: Optional[float] = None,
+                      longitude: Optional[float] = None) -> Dict:
+        item = {"unit": unit}
+        if latitude is not None and longitude is not None:
+            item.update({"lat": latitude, "lng": longitude})
+        if address:
+            item["address"] = address
+        if postal_code:
+            item["postal_code"] = postal_code
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO units (unit, lat, lng, address, postal_code) VALUES (?, ?, ?, ?, ?)",
+                (unit, _num(item.get("lat")), _num(item.get("lng")), address, postal_code),
+            )
+        return item
+
+    def get_all_units_with_locations(self) -> List[Dict]:
+        rows = self._connect().execute("SELECT * FROM units").fetchall()
+        return [{k: row[k] for k in row.keys() if row[k] is not None} for row in rows]
+
+    def _get_route_times(self, user_phone: str) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT unit, travel_time_min, timestamp FROM user_route_times WHERE user_phone = ? AND ttl > ?",
+            (user_phone, int(time.time())),
+        ).fetchall()
+        return [dict(row) for row in rows]
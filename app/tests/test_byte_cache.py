@@ -0,0 +1,64 @@
+"""ByteTTLCache / ByteLRUCache under concurrent use from several threads."""
+import sys
+import threading
+import numpy as np
+import pytest
+from byte_cache import ByteLRUCache, ByteTTLCache, entry_size
+
+
+@pytest.fixture
+def frequent_switches():
+    # switch threads far more often than the default 5 ms, so races show up
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+def hammer(cache, threads=8, ops=20000):
+    errors = []
+
+    def worker(seed):
+        rng = np.random.default_rng(seed)
+        try:
+            for _ in range(ops):
+                key, op = int(rng.integers(100)), rng.integers(5)
+                if op == 0:
+                    cache[key] = np.zeros(int(rng.integers(1, 1000)))
+                elif op == 1:
+                    cache.get(key)
+                elif op == 2:
+                    cache.pop(key, None)
+                elif op == 3:
+                    if key in cache:
+                        cache.get(key)
+                else:
+                    cache.stats()
+        except Exception as e:  # any error fails the test
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert errors == []
+
+
+def test_ttl_cache_is_thread_safe(frequent_switches):
+    cache = ByteTTLCache(100_000, ttl=0.002)
+    hammer(cache)
+    cache.expire(time=float("inf"))
+    assert len(cache) == 0 and cache.currsize == 0
+
+
+def test_lru_cache_is_thread_safe(frequent_switches):
+    cache = ByteLRUCache(100_000)
+    hammer(cache)
+    assert cache.currsize == sum(entry_size(v) for v in cache.values()) <= cache.maxsize
+
+
+def test_oversized_value_is_rejected():
+    cache = ByteLRUCache(1000)
+    cache["big"] = np.zeros(1000)
+    assert "big" not in cache and cache.stats()["rejected"] == 1
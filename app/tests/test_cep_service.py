@@ -0,0 +1,107 @@
+"""CepService against a fake CEP Aberto (httpx.MockTransport)."""
+import asyncio
+import httpx
+import pytest
+from cep_service import CepCache, CepService
+
+PAYLOAD = {"cep": "74463330", "latitude": "-16.6265", "longitude": "-49.3185"}
+
+
+class FakeCepAberto:
+    """Answers /cep from `known`; `failures` are served (in order) before that."""
+
+    def __init__(self, known=None, failures=(), delay_s=0.0):
+        self.known = known if known is not None else {"74463330": PAYLOAD}
+        self.failures = list(failures)
+        self.delay_s = delay_s
+        self.calls = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        cep = request.url.params["cep"]
+        self.calls.append(cep)
+        await asyncio.sleep(self.delay_s)
+        if self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, Exception):
+                raise failure
+            return httpx.Response(failure)
+        return httpx.Response(200, json=self.known.get(cep, {}))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CepCache(str(tmp_path / "cep.db"))
+
+
+def service(fake, cache, **kwargs):
+    kwargs.setdefault("retry_backoff_s", 0)
+    return CepService("http://cep.test", "token", cache=cache, transport=httpx.MockTransport(fake), **kwargs)
+
+
+def test_lookup_hits_cache(cache):
+    fake = FakeCepAberto()
+    svc = service(fake, cache)
+    assert asyncio.run(svc.lookup("74463-330")) == PAYLOAD
+    assert asyncio.run(service(fake, cache).lookup(" 74463330 ")) == PAYLOAD
+    assert fake.calls == ["74463330"]
+
+
+def test_geocode(cache):
+    svc = service(FakeCepAberto(), cache)
+    assert asyncio.run(svc.geocode("74463-330")) == (-16.6265, -49.3185)
+
+
+def test_unknown_cep_is_cached_briefly(cache):
+    fake = FakeCepAberto()
+    svc = service(fake, cache, negative_ttl_s=0.2)
+
+    async def lookups():
+        first = await svc.lookup("01001-000")
+        second = await svc.lookup("01001000")
+        await asyncio.sleep(0.3)
+        third = await svc.lookup("01001000")
+        return first, second, third
+
+    assert asyncio.run(lookups()) == (None, None, None)
+    assert fake.calls == ["01001000", "01001000"]
+    assert cache.get("01001000") is None
+
+
+def test_batch_dedups_concurrent_lookups(cache):
+    fake = FakeCepAberto(delay_s=0.05)
+    svc = service(fake, cache)
+    results = asyncio.run(svc.lookup_many(["74463-330", "74463330", "01001000", "74463330"]))
+    assert results == {"74463-330": PAYLOAD, "74463330": PAYLOAD, "01001000": None}
+    assert sorted(fake.calls) == ["01001000", "74463330"]
+
+
+@pytest.mark.parametrize("failure", [503, 429, httpx.ConnectError("refused"), httpx.ReadTimeout("slow")])
+def test_transient_failures_are_retried(cache, failure):
+    fake = FakeCepAberto(failures=[failure])
+    svc = service(fake, cache, retries=2)
+    assert asyncio.run(svc.lookup("74463330")) == PAYLOAD
+    assert fake.calls == ["74463330", "74463330"]
+
+
+def test_client_errors_are_not_retried(cache):
+    fake = FakeCepAberto(failures=[401])
+    svc = service(fake, cache, retries=2)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(svc.lookup("74463330"))
+    assert len(fake.calls) == 1
+
+
+def test_timeout_after_retries(cache):
+    fake = FakeCepAberto(failures=[httpx.ReadTimeout("slow")] * 3)
+    svc = service(fake, cache, retries=2)
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(svc.lookup("74463330"))
+    assert len(fake.calls) == 3
+    assert cache.get("74463330") is None
+
+
+def test_batch_maps_failures_to_none(cache):
+    fake = FakeCepAberto(failures=[httpx.ReadTimeout("slow")] * 2)
+    svc = service(fake, cache, retries=1)
+    assert asyncio.run(svc.lookup_many(["74463330"])) == {"74463330": None}
+
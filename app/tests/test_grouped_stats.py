@@ -0,0 +1,56 @@
+"""The grouped kernels in utils.py against the per-array functions, group by group."""
+import numpy as np
+import pytest
+from bench_grouped_stats import make_data, loop_iqr_median, loop_weighted_median
+from utils import grouped_iqr_median, grouped_weighted_median
+
+FACTOR = 1.5
+
+
+def assert_same(expected, got):
+    (e_med, e_n), (g_med, g_n) = expected, got
+    np.testing.assert_array_equal(g_n, e_n)
+    np.testing.assert_allclose(g_med, e_med, rtol=1e-12, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize("seed,n_groups,per_group", [(0, 2000, 50), (1, 500, 3), (2, 50, 400), (3, 3, 5)])
+def test_grouped_iqr_median_matches_loop(seed, n_groups, per_group):
+    values, _, group_ids = make_data(np.random.default_rng(seed), n_groups, per_group)
+    assert_same(loop_iqr_median(values, group_ids, n_groups, FACTOR),
+                grouped_iqr_median(values, group_ids, n_groups, FACTOR))
+
+
+@pytest.mark.parametrize("seed,n_groups,per_group", [(0, 2000, 50), (1, 500, 3), (2, 50, 400), (3, 3, 5)])
+def test_grouped_weighted_median_matches_loop(seed, n_groups, per_group):
+    values, weights, group_ids = make_data(np.random.default_rng(seed), n_groups, per_group)
+    assert_same(loop_weighted_median(values, weights, group_ids, n_groups),
+                grouped_weighted_median(values, weights, group_ids, n_groups))
+
+
+@pytest.mark.parametrize("values,group_ids", [
+    ([], []),                                           # nothing at all
+    ([7.0], [1]),                                       # single value, empty groups around it
+    ([5.0, 5.0, 5.0, 5.0], [0, 0, 0, 0]),               # all tied
+    ([1.0, 2.0, 2.0, 2.0, 3.0, 500.0], [2] * 6),        # outlier dropped by the IQR filter
+    ([4.0, 1.0, 3.0, 2.0], [3, 3, 0, 0]),               # even counts, unsorted input
+])
+def test_edge_cases(values, group_ids):
+    values, group_ids, n_groups = np.asarray(values, dtype=float), np.asarray(group_ids, dtype=np.int64), 4
+    weights = np.linspace(0.2, 1.0, len(values))
+    assert_same(loop_iqr_median(values, group_ids, n_groups, FACTOR),
+                grouped_iqr_median(values, group_ids, n_groups, FACTOR))
+    assert_same(loop_weighted_median(values, weights, group_ids, n_groups),
+                grouped_weighted_median(values, weights, group_ids, n_groups))
+
+
+@pytest.mark.parametrize("weight", [0.1, 0.3, 0.7, 0.9 ** 7])
+def test_equal_weight_group_after_another_group(weight):
+    # same-day samples share a weight, so the running sum often lands on half
+    rng = np.random.default_rng(4)
+    for _ in range(200):
+        n0, n1 = rng.integers(1, 20), rng.integers(1, 30)
+        values = np.round(rng.lognormal(3.5, 0.6, n0 + n1), 1)
+        weights = np.concatenate([rng.uniform(0.05, 1.0, n0), np.full(n1, weight)])
+        group_ids = np.repeat([0, 1], [n0, n1])
+        assert_same(loop_weighted_median(values, weights, group_ids, 2),
+                    grouped_weighted_median(values, weights, group_ids, 2))
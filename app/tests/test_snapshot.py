@@ -0,0 +1,82 @@
+"""EventIndex merges, high-water mark and snapshot round trip."""
+import multiprocessing
+import os
+from snapshot import EventIndex
+
+
+def rc_item(pseudonym, delta_t=30, event_time="2025-06-04T11:00:00Z", ingested_at="2025-06-04T11:00:01.000000Z"):
+    item = {"pseudonym": pseudonym, "event_id": "UPA Campinas#rc", "unit": "UPA Campinas",
+            "risk_color": "green", "slot": "07:00-13:00", "delta_t": delta_t, "day": "2025-06-04",
+            "rc_time": event_time, "event_time": event_time}
+    if ingested_at is not None:
+        item["ingested_at"] = ingested_at
+    return item
+
+
+def test_merge_counts_only_changed_rows():
+    index = EventIndex()
+    assert index.merge([rc_item("a"), rc_item("b")]) == 2
+    # an incremental fetch reads the overlap again
+    assert index.merge([rc_item("a"), rc_item("b")]) == 0
+    assert index.merge([rc_item("a"), rc_item("b", delta_t=45), rc_item("c")]) == 2
+    assert len(index) == 3
+
+
+def test_merge_counts_against_a_loaded_snapshot(tmp_path):
+    index = EventIndex()
+    index.merge([rc_item("a"), rc_item("b")])
+    index.save(str(tmp_path / "events.json"))
+    loaded = EventIndex.load(str(tmp_path / "events.json"))
+    assert len(loaded) == 2
+    assert loaded.merge([rc_item("a"), rc_item("b")]) == 0
+    assert loaded.merge([rc_item("a", delta_t=50)]) == 1
+    assert len(loaded) == 2
+
+
+def test_high_water_follows_ingest_time():
+    index = EventIndex()
+    index.merge([rc_item("a", ingested_at="2025-06-04T11:00:01.000000Z")])
+    # written long after its own (client) event_time
+    index.merge([rc_item("late", event_time="2020-01-01T10:00:00Z",
+                         ingested_at="2025-06-05T08:00:00.000000Z")])
+    assert index.high_water_iso() == "2025-06-05T08:00:00"
+    # items from before ingested_at existed fall back to their event_time
+    index.merge([rc_item("legacy", event_time="2025-06-06T09:00:00Z", ingested_at=None)])
+    assert index.high_water_iso(60) == "2025-06-06T08:59:00"
+
+
+def test_high_water_survives_save_and_load(tmp_path):
+    index = EventIndex()
+    index.merge([rc_item("late", event_time="2020-01-01T10:00:00Z",
+                         ingested_at="2025-06-05T08:00:00.000000Z")])
+    index.save(str(tmp_path / "events.json"))
+    assert EventIndex.load(str(tmp_path / "events.json")).high_water_iso() == "2025-06-05T08:00:00"
+
+
+def _save_repeatedly(path, n):
+    index = EventIndex()
+    index.merge([rc_item(f"p{i}") for i in range(n)])
+    for _ in range(20):
+        index.save(path)
+
+
+def test_concurrent_saves_leave_one_loadable_snapshot(tmp_path):
+    # gunicorn workers all save on shutdown
+    path = str(tmp_path / "events.json")
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_save_repeatedly, args=(path, n)) for n in range(1, 7)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+    assert EventIndex.load(path) is not None
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".npy")]) == 1
+
+
+def test_shard_layout_survives_save_and_load(tmp_path):
+    layout = {"nodes": ["http://a:8000", "http://b:8000"], "self": "http://a:8000", "vnodes": 64}
+    index = EventIndex(shard_layout=layout)
+    index.merge([rc_item("a")])
+    index.save(str(tmp_path / "events.json"))
+    assert EventIndex.load(str(tmp_path / "events.json")).shard_layout == layout
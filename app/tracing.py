@@ -0,0 +1,58 @@
+"""
+Per-request phase timings, with no dependencies so any module can mark its
+steps: `with phase("name"):` adds the block's time to the current request's
+RequestTrace, and does nothing outside a traced request (scripts, tests).
+profiler.ProfilerMiddleware binds a trace to every request and logs the
+phases of slow ones.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class RequestTrace:
+    """Time spent per phase during one request: name -> (seconds, calls)."""
+    __slots__ = ("phases", "_lock")
+
+    def __init__(self):
+        self.phases: Dict[str, tuple] = {}
+        # phases also run on concept-fetch threads (they copy the request context)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            total, calls = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (total + seconds, calls + 1)
+
+    def summary(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: {"ms": round(total * 1000, 3), "calls": calls}
+                    for name, (total, calls) in self.phases.items()}
+
+
+_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("request_trace", default=None)
+
+
+def bind(trace: RequestTrace) -> contextvars.Token:
+    """Make `trace` the current request's trace; undo with unbind(token)."""
+    return _trace.set(trace)
+
+
+def unbind(token: contextvars.Token):
+    _trace.reset(token)
+
+
+@contextmanager
+def phase(name: str):
+    """Add the time spent in the block to phase `name` of the current request."""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
@@ -1,18 +1,21 @@
-from datetime import datetime, time, timedelta, date
-from fastapi import HTTPException, Request, status
+from datetime import datetime, time, date
+from functools import lru_cache
 import numpy as np
-from typing import List, Tuple, Optional
-from WazeRouteCalculator import WazeRouteCalculator
+from typing import List, NamedTuple, Tuple, Optional
 import logging
 from zoneinfo import ZoneInfo
-from botocore.exceptions import ClientError
-import boto3
 import json
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
     
+@lru_cache(maxsize=None)
 def get_secret(secret_name: str):
+    # Cached for the life of the process; boto3 is imported here, not at module
+    # level, so the sqlite backend never loads it
+    import boto3
+    from botocore.exceptions import ClientError
+
     region_name = "us-east-1"
 
     # Create a Secrets Manager client
@@ -34,6 +37,11 @@ def get_secret(secret_name: str):
     secret = get_secret_value_response['SecretString']
     return json.loads(secret)
 
+@lru_cache(maxsize=None)
+def parse_hhmm(value: str) -> time:
+    """Parse a "HH:MM" slot bound once; slot tables are static."""
+    return datetime.strptime(value, "%H:%M").time()
+
 def assign_time_slot(ts: datetime, slots: list[tuple[str,str]]) -> str:
     """
     Given a timezone-aware or naive UTC datetime `ts`, first convert it
@@ -47,8 +55,8 @@ def assign_time_slot(ts: datetime, slots: list[tuple[str,str]]) -> str:
     # 2) Extract local time and match against your slots
     t = local_ts.time()
     for start_str, end_str in slots:
-        start = datetime.strptime(start_str, "%H:%M").time()
-        end   = datetime.strptime(end_str,   "%H:%M").time()
+        start = parse_hhmm(start_str)
+        end   = parse_hhmm(end_str)
         # normal same-day slot
         if start <= t < end:
             return f"{start_str}-{end_str}", local_ts
@@ -56,22 +64,6 @@ def assign_time_slot(ts: datetime, slots: list[tuple[str,str]]) -> str:
         # for now your slots are all same-day so we skip that.
     return "off-hours", local_ts
 
-def assign_rc_wait(local_ts: datetime, slots: list[tuple[str,str,int]]) -> str:
-    """
-    Given a ts from local Brazil time (America/Sao_Paulo), pick the correct slot.
-    """
-    # 2) Extract local time and match against your slots
-    t = local_ts.time()
-    for start_str, end_str, def_wait in slots:
-        start = datetime.strptime(start_str, "%H:%M").time()
-        end   = datetime.strptime(end_str,   "%H:%M").time()
-        # normal same-day slot
-        if start <= t < end:
-            return def_wait
-        # if you ever have overnight slots (end < start), handle here—
-        # for now your slots are all same-day so we skip that.
-    return 0
-
 def compute_iqr(values: np.ndarray) -> float:
     if len(values) == 0:
         return 0.0
@@ -81,46 +73,65 @@ def compute_iqr(values: np.ndarray) -> float:
 def apply_iqr_filter(values: np.ndarray, factor: float = 1.5):
     if len(values) == 0:
         return np.array([])   # not 0.0!
-    iqr = compute_iqr(values)
     q1, q3 = np.percentile(values, [25, 75])
+    iqr = q3 - q1
     lower = q1 - factor * iqr
     upper = q3 + factor * iqr
     return values[(values >= lower) & (values <= upper)]
 
-def compute_temporal_weights(dates: List[date], reference: date, decay_rate: float) -> np.ndarray:
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def compute_temporal_weights_ordinal(day_ordinals: np.ndarray, reference: date, decay_rate: float) -> np.ndarray:
     """
-    For each sample date d in `dates`, compute decay_rate ** business_days_between(d, reference).
-    Returns an array of weights aligned with dates.
+    Weight decay_rate ** (Mon–Fri days from each sample day to `reference`,
+    inclusive) for day ordinals (date.toordinal()), as stored in sample
+    batches; 0 for days after the reference.
     """
-    w = []
-    for d in dates:
-        # count Mon–Fri days between d and reference
-        # logger.info(f"business days between: {d} and {reference}")
-        days = business_days_between(d, reference)
-        # logger.info(f"days: {days}")
-        if days <= 0:
-            w.append(0)
-        else:
-            w.append(decay_rate ** days)
-        # logger.info(f"weights loading: {w}")
-    return np.array(w)
-
-def get_adjacent_slots(slots: List[Tuple[str, str]], slot_label: str) -> Tuple[Optional[str], Optional[str]]:
-    """Given a slot label, returns (previous_slot, next_slot) labels if exist."""
-    slot_labels = [f"{start}-{end}" for start, end in slots]
-    idx = slot_labels.index(slot_label) if slot_label in slot_labels else -1
-    prev_slot = slot_labels[idx - 1] if idx > 0 else None
-    next_slot = slot_labels[idx + 1] if idx >= 0 and idx + 1 < len(slot_labels) else None
-    return prev_slot, next_slot
-
-def slot_boundaries(slots: List[Tuple[str, str]], slot_label: str) -> Tuple[time, time]:
-    """Returns (start_time, end_time) for the given slot label."""
-    for start_str, end_str in slots:
-        if slot_label == f"{start_str}-{end_str}":
-            start = datetime.strptime(start_str, "%H:%M").time()
-            end = datetime.strptime(end_str, "%H:%M").time()
-            return start, end
-    raise ValueError("Slot label not found")
+    if len(day_ordinals) == 0:
+        return np.empty(0)
+    starts = (np.asarray(day_ordinals, dtype=np.int64) - _EPOCH_ORDINAL).astype("datetime64[D]")
+    end = np.datetime64(reference, "D") + np.timedelta64(1, "D")
+    # Mon–Fri days in [start, reference]; negative when start is after the reference
+    days = np.busday_count(starts, end)
+    return np.where(days > 0, np.power(decay_rate, days, dtype=float), 0.0)
+
+class MinutePlan(NamedTuple):
+    """What the estimator needs for a local minute of the day (see build_minute_plan)."""
+    slot: str
+    start_min: int            # slot start, minutes since local midnight
+    end_min: int              # slot end (past 1440 for overnight slots)
+    prev_slot: Optional[str]  # blend partner near the start
+    next_slot: Optional[str]  # blend partner near the end
+    rc_wait: int              # rc room wait (RC_TIME_SLOTS) for this minute
+
+def build_minute_plan(slots: List[Tuple[str, str]],
+                      rc_slots: List[Tuple[str, str, int]]) -> List[Optional[MinutePlan]]:
+    """
+    One entry per local minute of the day (index hour * 60 + minute), None
+    off-hours. Slot bounds are whole minutes, so a query's slot and rc room
+    wait only depend on its minute; the blend weight still uses the exact
+    time against start_min/end_min.
+    """
+    labels = [f"{start}-{end}" for start, end in slots]
+    plan = []
+    for minute in range(24 * 60):
+        t = time(minute // 60, minute % 60)
+        entry = None
+        for i, (start_str, end_str) in enumerate(slots):
+            start, end = parse_hhmm(start_str), parse_hhmm(end_str)
+            if start <= t < end:
+                start_min = start.hour * 60 + start.minute
+                end_min = end.hour * 60 + end.minute
+                if end < start:
+                    end_min += 24 * 60
+                rc_wait = next((w for rs, re, w in rc_slots if parse_hhmm(rs) <= t < parse_hhmm(re)), 0)
+                entry = MinutePlan(labels[i], start_min, end_min,
+                                   labels[i - 1] if i > 0 else None,
+                                   labels[i + 1] if i + 1 < len(labels) else None,
+                                   rc_wait)
+                break
+        plan.append(entry)
+    return plan
 
 from dateutil import parser 
 
@@ -132,22 +143,9 @@ def to_date(d):
     # handles ISO strings with “Z” or offsets:
     return parser.isoparse(d).date()
 
-def business_days_between(start_date, end_date) -> int:
-    """Count Mon–Fri days from start_date to end_date inclusive."""
-    start = to_date(start_date)
-    end   = to_date(end_date)
-    if start > end:
-        return 0
-
-    total_days = (end - start).days + 1
-    business_days = 0
-    for i in range(total_days):
-        if (start + timedelta(days=i)).weekday() < 5:
-            business_days += 1
-    return business_days
-
-
 def get_route_time(start_lat, start_lng, end_lat, end_lng):
+    # Deferred: WazeRouteCalculator pulls in requests and is only needed here
+    from WazeRouteCalculator import WazeRouteCalculator
     try:
         start = f"{start_lat},{start_lng}"
         end = f"{end_lat},{end_lng}"
@@ -160,8 +158,128 @@ def get_route_time(start_lat, start_lng, end_lat, end_lng):
         return None
 
 def weighted_median(data: np.ndarray, weights: np.ndarray) -> float:
-    sorter = np.argsort(data)
+    # stable sort and the cutoff from the same running sum, so the result
+    # doesn't depend on rounding when the cumulative weight lands on half
+    # (equal weights are common: every sample of a day weighs the same)
+    sorter = np.argsort(data, kind="stable")
     data, weights = data[sorter], weights[sorter]
     cum_weights = np.cumsum(weights)
-    cutoff = weights.sum() / 2.0
+    cutoff = cum_weights[-1] / 2.0
     return data[cum_weights >= cutoff][0]
+
+# ---- grouped kernels
+# The functions below compute the same statistics as apply_iqr_filter +
+# np.median and weighted_median, but for many groups at once: values come as
+# one flat array with an integer group id per value (0 <= id < n_groups),
+# everything is sorted once and each group is a contiguous run. Groups with
+# no values get NaN and a count of 0.
+
+def _sort_groups(values: np.ndarray, group_ids: np.ndarray, n_groups: int):
+    order = np.lexsort((values, group_ids))
+    counts = np.bincount(group_ids, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    return order, counts, starts
+
+def _grouped_percentile(sorted_values: np.ndarray, starts: np.ndarray, counts: np.ndarray, q: float) -> np.ndarray:
+    """Per-group percentile q (0-1) with np.percentile's default linear interpolation."""
+    out = np.full(len(counts), np.nan)
+    has = counts > 0
+    pos = q * (counts[has] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts[has] - 1)
+    v_lo = sorted_values[starts[has] + lo]
+    v_hi = sorted_values[starts[has] + hi]
+    out[has] = v_lo + (v_hi - v_lo) * (pos - lo)
+    return out
+
+def _grouped_cumsum(values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Running sum restarting at each group. Not a global cumsum minus the sum
+    before the group: that rounds differently from summing the group alone.
+    Groups of the same size are summed together as rows of a 2-D array.
+    """
+    out = np.empty(len(values))
+    for size in np.unique(counts[counts > 0]):
+        idx = starts[counts == size][:, None] + np.arange(size)
+        out[idx] = np.cumsum(values[idx], axis=1)
+    return out
+
+def grouped_iqr_median(values: np.ndarray, group_ids: np.ndarray, n_groups: int,
+                       factor: float = 1.5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per group: median of the values kept by apply_iqr_filter(values, factor).
+    Returns (medians, kept_counts), both of length n_groups.
+    """
+    values = np.asarray(values, dtype=float)
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    order, counts, starts = _sort_groups(values, group_ids, n_groups)
+    v, g = values[order], group_ids[order]
+
+    q1 = _grouped_percentile(v, starts, counts, 0.25)
+    q3 = _grouped_percentile(v, starts, counts, 0.75)
+    iqr = q3 - q1
+    keep = (v >= (q1 - factor * iqr)[g]) & (v <= (q3 + factor * iqr)[g])
+
+    # still sorted within each group after dropping outliers
+    v, g = v[keep], g[keep]
+    kept = np.bincount(g, minlength=n_groups)
+    kept_starts = np.cumsum(kept) - kept
+    return _grouped_percentile(v, kept_starts, kept, 0.5), kept
+
+def grouped_weighted_median(values: np.ndarray, weights: np.ndarray, group_ids: np.ndarray,
+                            n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per group: weighted_median(values, weights) of the group's values.
+    Returns (medians, counts), both of length n_groups.
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    group_ids = np.asarray(group_ids, dtype=np.int64)
+    order, counts, starts = _sort_groups(values, group_ids, n_groups)
+    v, w, g = values[order], weights[order], group_ids[order]
+
+    # cumulative weight within each group, summed in the same order as
+    # weighted_median; the cutoff is half of each group's last running sum
+    cum_in_group = _grouped_cumsum(w, starts, counts)
+    cutoff = np.zeros(n_groups)
+    has = counts > 0
+    cutoff[has] = cum_in_group[starts[has] + counts[has] - 1] / 2.0
+
+    # first value per group whose cumulative weight reaches the cutoff
+    reached = np.flatnonzero(cum_in_group >= cutoff[g])
+    groups_reached, first = np.unique(g[reached], return_index=True)
+    out = np.full(n_groups, np.nan)
+    out[groups_reached] = v[reached[first]]
+    return out, counts
+
+# ---- histograms: mergeable summaries of delta_t (see sharding.py). Bin i
+# covers [i * bin_width, (i + 1) * bin_width) and stands for its center.
+
+def value_histogram(values: np.ndarray, bin_width: float, n_bins: int) -> np.ndarray:
+    """Counts per bin; values outside the range land in the first/last bin."""
+    bins = np.clip(np.floor(np.asarray(values, dtype=float) / bin_width), 0, n_bins - 1).astype(np.int64)
+    return np.bincount(bins, minlength=n_bins)
+
+def _histogram_percentile(centers: np.ndarray, counts: np.ndarray, q: float) -> float:
+    """np.percentile(np.repeat(centers, counts), q * 100) without the repeat."""
+    cum = np.cumsum(counts)
+    pos = q * (cum[-1] - 1)
+    lo = int(np.floor(pos))
+    v_lo, v_hi = centers[np.searchsorted(cum, [lo, min(lo + 1, cum[-1] - 1)], side="right")]
+    return float(v_lo + (v_hi - v_lo) * (pos - lo))
+
+def histogram_iqr_median(counts: np.ndarray, bin_width: float,
+                         factor: float = 1.5) -> Tuple[int, Optional[float]]:
+    """
+    (count, median) left by apply_iqr_filter over a histogram, taking every
+    value at its bin center.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.sum() == 0:
+        return 0, None
+    centers = (np.arange(len(counts)) + 0.5) * bin_width
+    q1 = _histogram_percentile(centers, counts, 0.25)
+    q3 = _histogram_percentile(centers, counts, 0.75)
+    iqr = q3 - q1
+    kept = np.where((centers >= q1 - factor * iqr) & (centers <= q3 + factor * iqr), counts, 0)
+    return int(kept.sum()), _histogram_percentile(centers, kept, 0.5)